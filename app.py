@@ -1,6 +1,7 @@
 import json
 import os
 import logging
+import time
 import uuid
 import httpx
 import asyncio
@@ -21,15 +22,52 @@ from azure.identity.aio import (
     DefaultAzureCredential,
     get_bearer_token_provider
 )
+from azure.core.exceptions import HttpResponseError, ResourceExistsError
 from backend.auth.auth_utils import get_authenticated_user_details
+from backend.auth.graph import GraphGroupResolver
 from backend.security.ms_defender_utils import get_msdefender_user_json
 from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.sqlitedbservice import SqliteConversationClient
+from backend.history.writebehind import HistoryWriteBehindQueue
+from backend.history.partitioning import get_partition_strategy
+from backend.history.compression import ContentCompression
+from backend.history.archive import (
+    ARCHIVED_FIELD,
+    BlobArchiveStore,
+    ConversationArchiver,
+    LocalArchiveStore,
+)
+from backend.history.search import HistorySearchIndex
+from backend.history.feedback import MAX_FEEDBACK_BATCH_SIZE, feedback_summary
+from backend.history.conversationindex import ConversationIndexConsumer, CosmosChangeFeedSource
+from backend.history import cosmosmetrics
+from backend.search.gateway import search_gateway
+from backend.analytics.columnar import ChunkedScanner, ClaimsStore
+from backend.analytics.rollup import RollupStore
+from backend.analytics.router import QueryRouter, compact_system_message, replace_reference_data
+from backend.analytics.tools import RESTRICTED_DATA_SECTION, TOOLS_DATA_SECTION, ToolRunner
+from backend.analytics.service import (
+    AggregationParams,
+    AnalyticsAccessError,
+    AnalyticsParams,
+    AnalyticsRequestError,
+    AnalyticsService,
+    AnalyticsUnavailableError,
+    DirectSearchParams,
+    INDEX,
+    LatencyTracker,
+    IndexVersion,
+    ResultCache,
+)
+from backend.search.gateway import SearchTimeoutError
+from backend.readiness import DISABLED, DependencyUnavailableError, Readiness
 from backend.settings import (
     app_settings,
     MINIMUM_SUPPORTED_AZURE_OPENAI_PREVIEW_API_VERSION
 )
 from backend.utils import (
     format_as_ndjson,
+    gzip_stream,
     format_stream_response,
     format_non_streaming_response,
     convert_to_pf_format,
@@ -49,7 +87,19 @@ logger = logging.getLogger(__name__)  # Use __name__ for proper module hierarchy
 
 bp = Blueprint("routes", __name__, static_folder="static", template_folder="static")
 
-cosmos_db_ready = asyncio.Event()
+history_partition_strategy = get_partition_strategy(
+    app_settings.history_storage.partition_strategy,
+    app_settings.history_storage.partition_buckets,
+)
+
+history_content_compression = (
+    ContentCompression(
+        threshold=app_settings.history_storage.compression_threshold,
+        algorithm=app_settings.history_storage.compression_algorithm,
+    )
+    if app_settings.history_storage.compression_threshold
+    else None
+)
 
 
 def create_app():
@@ -57,17 +107,105 @@ def create_app():
     app.asgi_app = OpenTelemetryMiddleware(app.asgi_app)
     app.register_blueprint(bp)
     app.config["TEMPLATES_AUTO_RELOAD"] = True
+    app.history_search_index = HistorySearchIndex(
+        max_users=app_settings.history_storage.search_max_cached_users,
+        catch_up_interval=app_settings.history_storage.search_catch_up_interval,
+        reconcile_interval=app_settings.history_storage.search_reconcile_interval,
+    )
     
+    app.readiness = Readiness(
+        warm_timeout=app_settings.readiness.warm_timeout,
+        retry_interval=app_settings.readiness.retry_interval,
+    )
+    app.conversation_client = None
+    app.history_write_queue = None
+    app.conversation_index_consumer = None
+    app.history_archiver = None
+    app.history_archive_task = None
+    app.azure_openai_client = None
+    app.group_resolver = init_group_resolver()
+    app.claims_store = init_claims_store() if app_settings.claims_store.enabled else None
+    app.claims_store_task = None
+    app.analytics_service = AnalyticsService(
+        claims_store=app.claims_store,
+        index=claims_index(),
+        cache=ResultCache(
+            max_entries=app_settings.analytics.cache_max_entries,
+            ttl=app_settings.analytics.cache_ttl,
+            max_bytes=app_settings.analytics.cache_max_bytes,
+        ),
+        latency=LatencyTracker(
+            slo_ms={
+                "direct_search": app_settings.analytics.direct_search_slo_ms,
+                "aggregation": app_settings.analytics.aggregation_slo_ms,
+                "analytics": app_settings.analytics.analytics_slo_ms,
+            },
+            window=app_settings.analytics.latency_window,
+        ),
+        timeout=app_settings.search.request_timeout,
+        index_version=init_index_version(),
+        page_size=app_settings.analytics.direct_search_page_size,
+        buffer_pages=app_settings.analytics.direct_search_buffer_pages,
+        rollup=RollupStore(
+            app_settings.analytics.rollup_path,
+            interval=app_settings.analytics.index_version_interval,
+        ) if app_settings.analytics.rollup_path else None,
+    )
+    app.query_router = QueryRouter(
+        app.analytics_service,
+        direct_answers=app_settings.analytics.router_direct_answers,
+    ) if app_settings.analytics.router_enabled else None
+    app.tool_runner = ToolRunner(
+        app.analytics_service,
+        max_rounds=app_settings.analytics.tools_max_rounds,
+        result_max_chars=app_settings.analytics.tools_result_max_chars,
+        extra_tools=[tool.model_dump() for tool in app_settings.azure_openai.tools or []],
+    ) if app_settings.analytics.tools_enabled else None
+    search_gateway.timeout = app_settings.search.request_timeout
+
     @app.before_serving
     async def init():
-        try:
-            app.cosmos_conversation_client = await init_cosmosdb_client()
-            cosmos_db_ready.set()
-        except Exception as e:
-            logger.exception("Failed to initialize CosmosDB client")
-            app.cosmos_conversation_client = None
-            raise e
-    
+        ## warm every dependency before the worker takes traffic; routes check
+        ## app.readiness and fail fast with 503 while a dependency is down
+        if app_settings.history_storage.backend == "sqlite" or app_settings.chat_history:
+            app.readiness.register("history", lambda: warm_history(app))
+        else:
+            app.readiness.disable("history", "CosmosDB is not configured")
+
+        if app_settings.base_settings.use_promptflow:
+            app.readiness.disable("openai", "chat is served by promptflow")
+        else:
+            app.readiness.register("openai", lambda: warm_openai(app))
+
+        app.readiness.register("system_prompt", warm_system_prompt)
+
+        if app_settings.claims_store.enabled:
+            ## chat doesn't read the claims store, only the analytics routes require it
+            app.readiness.register("claims_store", lambda: warm_claims_store(app), required=False)
+        else:
+            app.readiness.disable("claims_store", "CLAIMS_STORE_ENABLED is not set")
+
+        if app.analytics_service.rollup:
+            await app.analytics_service.rollup.reload()
+
+        await app.readiness.warm_all()
+        app.readiness.start_retries()
+
+    @app.after_serving
+    async def shutdown():
+        await app.readiness.stop()
+        await close_history(app)
+        if app.claims_store_task:
+            app.claims_store_task.cancel()
+            await asyncio.gather(app.claims_store_task, return_exceptions=True)
+        if app.claims_store:
+            app.claims_store.close()
+        if app.azure_openai_client:
+            await app.azure_openai_client.close()
+        await search_gateway.close()
+        if app.group_resolver:
+            await app.group_resolver.close()
+
     return app
 
 
@@ -101,8 +239,9 @@ USER_AGENT = "GitHubSampleWebApp/AsyncAzureOpenAI/1.0.0"
 frontend_settings = {
     "auth_enabled": app_settings.base_settings.auth_enabled,
     "feedback_enabled": (
-        app_settings.chat_history and
-        app_settings.chat_history.enable_feedback
+        app_settings.history_storage.enable_feedback
+        if app_settings.history_storage.backend == "sqlite"
+        else app_settings.chat_history and app_settings.chat_history.enable_feedback
     ),
     "ui": {
         "title": app_settings.ui.title,
@@ -186,7 +325,7 @@ async def init_openai_client():
 
 
 async def init_cosmosdb_client():
-    cosmos_conversation_client = None
+    conversation_client = None
     if app_settings.chat_history:
         try:
             cosmos_endpoint = (
@@ -200,34 +339,378 @@ async def init_cosmosdb_client():
             else:
                 credential = app_settings.chat_history.account_key
 
-            cosmos_conversation_client = CosmosConversationClient(
+            fallback_client = None
+            if app_settings.chat_history.migration_source_container:
+                ## serve documents that haven't been copied to the new container yet
+                fallback_client = CosmosConversationClient(
+                    cosmosdb_endpoint=cosmos_endpoint,
+                    credential=credential,
+                    database_name=app_settings.chat_history.database,
+                    container_name=app_settings.chat_history.migration_source_container,
+                    enable_message_feedback=app_settings.chat_history.enable_feedback,
+                    partition_strategy=get_partition_strategy(
+                        app_settings.chat_history.migration_source_partition_strategy,
+                        app_settings.history_storage.partition_buckets,
+                    ),
+                    content_compression=history_content_compression,
+                )
+
+            conversation_client = CosmosConversationClient(
                 cosmosdb_endpoint=cosmos_endpoint,
                 credential=credential,
                 database_name=app_settings.chat_history.database,
                 container_name=app_settings.chat_history.conversations_container,
                 enable_message_feedback=app_settings.chat_history.enable_feedback,
+                partition_strategy=history_partition_strategy,
+                fallback=fallback_client,
+                conversation_index_enabled=app_settings.chat_history.conversation_index_enabled,
+                content_compression=history_content_compression,
             )
         except Exception as e:
             logger.exception("Exception in CosmosDB initialization", e)
-            cosmos_conversation_client = None
+            conversation_client = None
             raise e
     else:
         logging.debug("CosmosDB not configured")
 
-    return cosmos_conversation_client
+    return conversation_client
+
+
+def init_sqlite_client():
+    return SqliteConversationClient(
+        database_path=app_settings.history_storage.sqlite_path,
+        enable_message_feedback=app_settings.history_storage.enable_feedback,
+        max_workers=app_settings.history_storage.sqlite_max_workers,
+        content_compression=history_content_compression,
+    )
+
+
+async def init_conversation_client():
+    if app_settings.history_storage.backend == "sqlite":
+        return init_sqlite_client()
+
+    return await init_cosmosdb_client()
+
+
+async def warm_history(app):
+    ## also used to retry, so drop whatever a failed attempt left behind
+    await close_history(app)
+
+    conversation_client = await init_conversation_client()
+    success, err = await conversation_client.ensure()
+    if not success:
+        await conversation_client.close()
+        raise RuntimeError(err)
+
+    app.conversation_client = conversation_client
+    app.history_write_queue = await init_history_write_queue(conversation_client)
+    app.conversation_index_consumer = await init_conversation_index_consumer(conversation_client)
+    app.history_archiver = await init_history_archiver(conversation_client)
+    if app.history_archiver and app_settings.history_archive.scheduler_enabled:
+        app.history_archive_task = asyncio.create_task(
+            app.history_archiver.run_forever(app_settings.history_archive.interval_seconds)
+        )
+    return err
+
+
+async def close_history(app):
+    ## flush pending history writes (or spill them to disk) before the worker is recycled
+    if app.history_archive_task:
+        app.history_archive_task.cancel()
+        await asyncio.gather(app.history_archive_task, return_exceptions=True)
+    if app.history_archiver:
+        await app.history_archiver.store.close()
+    if app.conversation_index_consumer:
+        await app.conversation_index_consumer.stop()
+    if app.history_write_queue:
+        await app.history_write_queue.close()
+    if app.conversation_client:
+        await app.conversation_client.close()
+    app.conversation_client = None
+    app.history_write_queue = None
+    app.conversation_index_consumer = None
+    app.history_archiver = None
+    app.history_archive_task = None
+
+
+async def warm_openai(app):
+    azure_openai_client = await init_openai_client()
+    if app_settings.readiness.openai_probe:
+        ## opens the connection pool and fetches the Entra ID token before the first chat request
+        try:
+            await azure_openai_client.models.list()
+        except Exception:
+            await azure_openai_client.close()
+            raise
+
+    if app.azure_openai_client:
+        await app.azure_openai_client.close()
+    app.azure_openai_client = azure_openai_client
+    return f"deployment {app_settings.azure_openai.model}"
+
+
+async def warm_system_prompt():
+    ## the system message carries the claims dataset (CSV rows, see terraform/system-prompt.tpl)
+    system_message = app_settings.azure_openai.system_message
+    if not system_message or not system_message.strip():
+        raise ValueError("AZURE_OPENAI_SYSTEM_MESSAGE is empty")
+    data_rows = sum(1 for line in system_message.splitlines() if line.count(",") >= 10)
+    return f"{len(system_message)} characters, {data_rows} data rows"
+
+
+def claims_index():
+    ## (endpoint, key, index name) of the claims index, the AZURE_SEARCH_* datasource unless CLAIMS_STORE_INDEX_* is set
+    settings = app_settings.claims_store
+    endpoint, key, index_name = settings.index_endpoint, settings.index_key, settings.index_name
+    if not endpoint and app_settings.datasource and app_settings.base_settings.datasource_type == "AzureCognitiveSearch":
+        endpoint = app_settings.datasource.endpoint
+        key = app_settings.datasource.key
+        index_name = index_name or app_settings.datasource.index
+    return (endpoint, key, index_name) if endpoint and index_name else None
+
+
+def init_claims_store():
+    settings = app_settings.claims_store
+    endpoint, key, index_name = claims_index() or (None, None, None)
+    return ClaimsStore(
+        snapshot_path=settings.snapshot_path,
+        endpoint=endpoint if settings.load_from_index else None,
+        key=key,
+        index_name=index_name,
+        timeout=app_settings.search.request_timeout,
+        scanner=ChunkedScanner(
+            chunk_rows=settings.scan_chunk_rows,
+            processes=settings.scan_processes,
+            process_min_rows=settings.scan_process_min_rows,
+        ) if settings.scan_chunk_rows else None,
+    )
+
+
+def init_group_resolver():
+    ## only document-level security needs the user's groups
+    if not getattr(app_settings.datasource, "permitted_groups_column", None):
+        return None
+    settings = app_settings.graph
+    return GraphGroupResolver(
+        base_url=settings.base_url,
+        ttl=settings.groups_ttl,
+        stale_ttl=settings.groups_stale_ttl,
+        timeout=settings.request_timeout,
+        max_users=settings.groups_max_users,
+        max_connections=settings.max_connections,
+    )
+
+
+def init_index_version():
+    ## cached answers are dropped when the claims index changes
+    index = claims_index()
+    if not index:
+        return None
+    endpoint, key, index_name = index
+    return IndexVersion(
+        endpoint, key, index_name,
+        interval=app_settings.analytics.index_version_interval,
+        timeout=app_settings.search.request_timeout,
+    )
+
+
+async def warm_claims_store(app):
+    store = app.claims_store
+    interval = app_settings.claims_store.refresh_interval
+
+    ## start from the snapshot when there is one, the index load then runs in the background
+    from_snapshot = store.columns is None and store.has_snapshot and store.has_index
+    columns = await store.refresh("snapshot" if from_snapshot else None)
+    if app.claims_store_task is None and store.has_index and (interval or from_snapshot):
+        app.claims_store_task = asyncio.create_task(store.run_forever(interval, refresh_first=from_snapshot))
+    return f"{columns.size} claims from {columns.source}, version {columns.version}"
+
+
+async def get_openai_client():
+    ## reuse the client warmed in before_serving so requests share its connection pool
+    return current_app.azure_openai_client or await init_openai_client()
+
+
+async def init_history_write_queue(conversation_client):
+    ## the embedded store is local, only remote backends benefit from write-behind
+    if (
+        not isinstance(conversation_client, CosmosConversationClient)
+        or not app_settings.chat_history.write_behind_enabled
+    ):
+        return None
+
+    history_write_queue = HistoryWriteBehindQueue(
+        conversation_client,
+        batch_size=app_settings.chat_history.write_behind_batch_size,
+        flush_interval=app_settings.chat_history.write_behind_flush_interval,
+        max_pending=app_settings.chat_history.write_behind_max_pending,
+        spill_dir=app_settings.chat_history.write_behind_spill_dir,
+        max_spill_bytes=app_settings.chat_history.write_behind_max_spill_bytes,
+        flush_timeout=app_settings.chat_history.write_behind_flush_timeout,
+    )
+    await history_write_queue.start()
+    return history_write_queue
+
+
+async def init_conversation_index_consumer(conversation_client):
+    if (
+        not isinstance(conversation_client, CosmosConversationClient)
+        or not conversation_client.conversation_index_enabled
+        or not app_settings.chat_history.conversation_index_consumer_enabled
+    ):
+        return None
+
+    ## every worker tails the feed; applying a change twice is harmless
+    consumer = ConversationIndexConsumer(
+        CosmosChangeFeedSource(conversation_client.container_client),
+        conversation_client,
+        poll_interval=app_settings.chat_history.conversation_index_poll_interval,
+    )
+    await consumer.start()
+    return consumer
+
+
+async def init_history_archiver(conversation_client):
+    settings = app_settings.history_archive
+    if not settings.enabled or not conversation_client:
+        return None
+
+    if settings.local_path:
+        store = LocalArchiveStore(settings.local_path)
+    else:
+        from azure.storage.blob.aio import BlobServiceClient
+
+        if settings.storage_connection_string:
+            blob_service_client = BlobServiceClient.from_connection_string(settings.storage_connection_string)
+        elif settings.storage_account:
+            blob_service_client = BlobServiceClient(
+                account_url=f"https://{settings.storage_account}.blob.core.windows.net",
+                credential=DefaultAzureCredential(),
+            )
+        else:
+            raise ValueError("History archival needs HISTORY_ARCHIVE_LOCAL_PATH, HISTORY_ARCHIVE_STORAGE_ACCOUNT or HISTORY_ARCHIVE_STORAGE_CONNECTION_STRING")
+
+        container_client = blob_service_client.get_container_client(settings.container)
+        try:
+            await container_client.create_container()
+        except ResourceExistsError:
+            pass
+        store = BlobArchiveStore(container_client)
+
+    return ConversationArchiver(
+        conversation_client,
+        store,
+        idle_days=settings.idle_days,
+        batch_size=settings.batch_size,
+    )
+
+
+async def rehydrate_history_conversation(conversation):
+    ## bring an archived conversation's messages back before they're read or changed
+    if not conversation or not conversation.get(ARCHIVED_FIELD):
+        return conversation
+    if not current_app.history_archiver:
+        raise Exception("Conversation is archived but history archival is not configured")
+    return await current_app.history_archiver.rehydrate(conversation)
+
+
+async def discard_history_archive(user_id, conversation_id, keep_conversation=False):
+    ## the archived messages are being deleted along with (or without) their conversation
+    if not current_app.history_archiver:
+        return
+    conversation = await current_app.conversation_client.get_conversation(user_id, conversation_id)
+    if conversation and conversation.get(ARCHIVED_FIELD):
+        await current_app.history_archiver.discard(conversation)
+        if keep_conversation:
+            conversation.pop(ARCHIVED_FIELD)
+            await current_app.conversation_client.upsert_conversation(conversation)
+
+
+async def create_history_conversation(user_id, title):
+    history_write_queue = current_app.history_write_queue
+    if not history_write_queue:
+        conversation = await current_app.conversation_client.create_conversation(
+            user_id=user_id, title=title
+        )
+    else:
+        ## build the document locally and let the write-behind queue persist it,
+        ## so the chat completion doesn't wait on a Cosmos round trip
+        conversation = current_app.conversation_client.build_conversation(
+            user_id=user_id, title=title
+        )
+        await history_write_queue.wait_for_capacity()
+        history_write_queue.enqueue_upsert(user_id, conversation)
+
+    if conversation:
+        current_app.history_search_index.conversation_added(user_id, conversation)
+    return conversation
+
+
+async def create_history_message(user_id, conversation_id, input_message, message_id=None):
+    message_id = message_id or str(uuid.uuid4())
+    history_write_queue = current_app.history_write_queue
+    if not history_write_queue:
+        message = await current_app.conversation_client.create_message(
+            uuid=message_id,
+            conversation_id=conversation_id,
+            user_id=user_id,
+            input_message=input_message,
+        )
+    elif not (
+        history_write_queue.has_pending_upsert(user_id, conversation_id)
+        or await current_app.conversation_client.get_conversation(user_id, conversation_id)
+    ):
+        ## same answer create_message gives, rather than queueing a message nobody can list
+        return "Conversation not found"
+    else:
+        message = current_app.conversation_client.build_message(
+            uuid=message_id,
+            conversation_id=conversation_id,
+            user_id=user_id,
+            input_message=input_message,
+        )
+        await history_write_queue.wait_for_capacity()
+        history_write_queue.enqueue_upsert(user_id, message)
+        if not current_app.conversation_client.conversation_index_enabled:
+            history_write_queue.enqueue_touch(user_id, conversation_id, message["createdAt"])
+
+    if isinstance(message, dict):
+        ## the stored document may be compressed, index the text as sent
+        current_app.history_search_index.message_added(
+            user_id, conversation_id, {**message, "content": input_message["content"]}
+        )
+    return message
+
+
+def get_history_user_id(authenticated_user):
+    ## the identity history documents are stored under, see HISTORY_STORAGE_PARTITION_STRATEGY
+    return history_partition_strategy.user_key(authenticated_user)
+
+
+async def flush_history_writes(user_id):
+    ## make reads and deletes observe writes still sitting in the write-behind queue
+    if current_app.history_write_queue:
+        await current_app.history_write_queue.flush(user_id)
 
 
-def prepare_model_args(request_body, request_headers):
+def prepare_model_args(request_body, request_headers, security_filter=None):
     request_messages = request_body.get("messages", [])
     messages = []
 
     has_system_message = any(message.get("role") == "system" for message in request_messages if isinstance(message, dict))
 
     if not has_system_message:
+        system_message = app_settings.azure_openai.system_message
+        if current_app.tool_runner and (app_settings.analytics.tools_strip_dataset or security_filter):
+            ## the model reads the claims through the tools instead
+            system_message = replace_reference_data(system_message, TOOLS_DATA_SECTION)
+        elif security_filter:
+            ## the dataset holds every claim, whatever the user's groups
+            system_message = replace_reference_data(system_message, RESTRICTED_DATA_SECTION)
         messages = [
             {
                 "role": "system",
-                "content": app_settings.azure_openai.system_message
+                "content": system_message
             }
         ]
 
@@ -289,6 +772,9 @@ def prepare_model_args(request_body, request_headers):
         "model": app_settings.azure_openai.model,
         "user": user_json
     }
+    if current_app.tool_runner:
+        model_args["tools"] = current_app.tool_runner.definitions
+        model_args["tool_choice"] = app_settings.azure_openai.tool_choice or "auto"
     
     # We no longer use datasource - directly sending to OpenAI
     logging.debug(f"REQUEST BODY: {json.dumps(model_args, indent=4)}")
@@ -329,7 +815,7 @@ async def promptflow_request(request):
         logging.error(f"An error occurred while making promptflow_request: {e}")
 
 
-async def send_chat_request(request_body, request_headers):
+async def send_chat_request(request_body, request_headers, security_filter=None):
     # Validation 1: Check if request body exists
     if not request_body:
         raise ValueError("Empty request body")
@@ -420,13 +906,19 @@ async def send_chat_request(request_body, request_headers):
         filtered_messages = [{"role": "user", "content": "Hello"}]
     
     request_body['messages'] = filtered_messages
-    model_args = prepare_model_args(request_body, request_headers)
+    model_args = prepare_model_args(request_body, request_headers, security_filter)
 
     try:
-        azure_openai_client = await init_openai_client()
+        azure_openai_client = await get_openai_client()
         raw_response = await azure_openai_client.chat.completions.with_raw_response.create(**model_args)
         response = raw_response.parse()
         apim_request_id = raw_response.headers.get("apim-request-id") 
+        if current_app.tool_runner:
+            ## later rounds of a stream run while the response streams, outside the app context
+            if model_args["stream"]:
+                response = current_app.tool_runner.stream(azure_openai_client, model_args, response, security_filter)
+            else:
+                response = await current_app.tool_runner.complete(azure_openai_client, model_args, response, security_filter)
     except Exception as e:
         logger.exception("Exception in send_chat_request")
         raise e
@@ -434,7 +926,7 @@ async def send_chat_request(request_body, request_headers):
     return response, apim_request_id
 
 
-async def complete_chat_request(request_body, request_headers):
+async def complete_chat_request(request_body, request_headers, security_filter=None):
     if app_settings.base_settings.use_promptflow:
         response = await promptflow_request(request_body)
         history_metadata = request_body.get("history_metadata", {})
@@ -445,13 +937,13 @@ async def complete_chat_request(request_body, request_headers):
             app_settings.promptflow.citations_field_name
         )
     else:
-        response, apim_request_id = await send_chat_request(request_body, request_headers)
+        response, apim_request_id = await send_chat_request(request_body, request_headers, security_filter)
         history_metadata = request_body.get("history_metadata", {})
         return format_non_streaming_response(response, history_metadata, apim_request_id)
 
 
-async def stream_chat_request(request_body, request_headers):
-    response, apim_request_id = await send_chat_request(request_body, request_headers)
+async def stream_chat_request(request_body, request_headers, security_filter=None):
+    response, apim_request_id = await send_chat_request(request_body, request_headers, security_filter)
     history_metadata = request_body.get("history_metadata", {})
     
     async def generate():
@@ -462,15 +954,31 @@ async def stream_chat_request(request_body, request_headers):
 
 
 async def conversation_internal(request_body, request_headers):
+    try:
+        security_filter = await get_security_filter()
+    except AnalyticsAccessError as e:
+        return jsonify({"error": str(e)}), 401
+
+    ## exact figures for analytics questions come from the claims data, not the model
+    routed = await current_app.query_router.route(
+        request_body.get("messages", []), security_filter
+    ) if current_app.query_router else None
+    if routed and routed.direct:
+        return await routed_answer_response(routed, request_body)
+
+    if not app_settings.base_settings.use_promptflow:
+        current_app.readiness.require("openai")
+        if routed:
+            request_body = with_computed_context(request_body, routed)
     try:
         if app_settings.azure_openai.stream and not app_settings.base_settings.use_promptflow:
-            result = await stream_chat_request(request_body, request_headers)
+            result = await stream_chat_request(request_body, request_headers, security_filter)
             response = await make_response(format_as_ndjson(result))
             response.timeout = None
             response.mimetype = "application/json-lines"
             return response
         else:
-            result = await complete_chat_request(request_body, request_headers)
+            result = await complete_chat_request(request_body, request_headers, security_filter)
             return jsonify(result)
 
     except Exception as ex:
@@ -481,6 +989,40 @@ async def conversation_internal(request_body, request_headers):
             return jsonify({"error": str(ex)}), 500
 
 
+async def routed_answer_response(routed, request_body):
+    ## shaped like a model reply, streamed as one ndjson chunk when streaming is on
+    stream = app_settings.azure_openai.stream and not app_settings.base_settings.use_promptflow
+    response_obj = {
+        "id": str(uuid.uuid4()),
+        "model": app_settings.azure_openai.model,
+        "created": int(time.time()),
+        "object": "chat.completion.chunk" if stream else "chat.completion",
+        "choices": [{"messages": [{"role": "assistant", "content": routed.text}]}],
+        "history_metadata": request_body.get("history_metadata", {}),
+        "apim-request-id": None,
+    }
+    if not stream:
+        return jsonify(response_obj)
+
+    async def generate():
+        yield response_obj
+
+    response = await make_response(format_as_ndjson(generate()))
+    response.mimetype = "application/json-lines"
+    return response
+
+
+def with_computed_context(request_body, routed):
+    ## the model gets the computed table in place of the whole dataset
+    messages = request_body.get("messages", [])
+    if any(isinstance(message, dict) and message.get("role") == "system" for message in messages):
+        return request_body
+    system_message = compact_system_message(
+        app_settings.azure_openai.system_message, routed.table, routed.result.get("total_documents")
+    )
+    return {**request_body, "messages": [{"role": "system", "content": system_message}] + messages}
+
+
 @bp.route("/conversation", methods=["POST"])
 async def conversation():
     if not request.is_json:
@@ -494,6 +1036,22 @@ async def health():
     return "", 200
 
 
+@bp.route("/ready", methods=["GET"])
+async def ready():
+    ## App Service health check target: 200 only once every required dependency is warm
+    snapshot = current_app.readiness.snapshot()
+    return jsonify(snapshot), 200 if current_app.readiness.ready else 503
+
+
+@bp.app_errorhandler(DependencyUnavailableError)
+async def dependency_unavailable(e):
+    return (
+        jsonify({"error": str(e), "component": e.component}),
+        503,
+        {"Retry-After": str(int(app_settings.readiness.retry_interval))},
+    )
+
+
 @bp.route("/frontend_settings", methods=["GET"])
 def get_frontend_settings():
     try:
@@ -505,44 +1063,123 @@ def get_frontend_settings():
 
 @bp.route("/direct_search", methods=["POST"])
 async def direct_search():
-    """
-    This endpoint is disabled as we now use OpenAI directly.
-    All data is provided in the system prompt.
-    """
-    return jsonify({
-        "error": "This endpoint is disabled as we now use OpenAI directly. All data is provided in the system prompt."
-    }), 501
+    ## documents straight from the index, no model round trip, streamed as NDJSON a page per line
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 415
+
+    started = time.perf_counter()
+    try:
+        params = DirectSearchParams.parse(await request.get_json()).restricted_to(await get_security_filter())
+        pages = current_app.analytics_service.stream_direct_search(params)
+        ## the first page is read before the response starts, so a rejected query still gets its status code
+        first = await pages.__anext__()
+    except Exception as e:
+        return analytics_error_response("direct_search", e)
+
+    async def generate():
+        yield first
+        async for page in pages:
+            yield page
+
+    response = await make_response(format_as_ndjson(generate()))
+    response.mimetype = "application/json-lines"
+    response.headers["Server-Timing"] = f"{INDEX};dur={(time.perf_counter() - started) * 1000:.1f}"
+    response.headers["X-Cache"] = "miss"
+    return response
 
 
 @bp.route("/aggregation", methods=["POST"])
 async def aggregation():
-    """
-    This endpoint is disabled as we now use OpenAI directly.
-    All data is provided in the system prompt.
-    """
-    return jsonify({
-        "error": "This endpoint is disabled as we now use OpenAI directly. All data is provided in the system prompt."
-    }), 501
+    return await answer_analytics_request("aggregation", AggregationParams)
 
 
 @bp.route("/analytics", methods=["POST"])
 async def analytics():
-    """
-    This endpoint is disabled as we now use OpenAI directly.
-    All data is provided in the system prompt.
-    """
-    return jsonify({
-        "error": "This endpoint is disabled as we now use OpenAI directly. All data is provided in the system prompt."
-    }), 501
+    return await answer_analytics_request("analytics", AnalyticsParams)
+
+
+@bp.route("/analytics/stats", methods=["GET"])
+async def analytics_stats():
+    stats = current_app.analytics_service.stats()
+    stats["router"] = current_app.query_router.stats() if current_app.query_router else None
+    stats["tools"] = current_app.tool_runner.stats() if current_app.tool_runner else None
+    return jsonify(stats), 200
+
+
+async def answer_analytics_request(route, params_model):
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 415
+
+    try:
+        params = params_model.parse(await request.get_json()).restricted_to(await get_security_filter())
+        result, served = await current_app.analytics_service.answer(route, params)
+    except Exception as e:
+        return analytics_error_response(route, e)
+
+    response = jsonify(result)
+    response.headers["Server-Timing"] = f"{served['source']};dur={served['elapsed_ms']:.1f}"
+    response.headers["X-Cache"] = "hit" if served["cached"] else "miss"
+    return response, 200
+
+
+async def get_security_filter():
+    ## document-level security: the caller's permitted groups filter, ANDed into every claims query
+    if not current_app.group_resolver:
+        return None
+    try:
+        return await app_settings.datasource._set_filter_string(request, current_app.group_resolver)
+    except ValueError as e:
+        raise AnalyticsAccessError(str(e))
+
+
+def analytics_error_response(route, e):
+    if isinstance(e, AnalyticsRequestError):
+        return jsonify({"error": str(e)}), 400
+    if isinstance(e, AnalyticsAccessError):
+        return jsonify({"error": str(e)}), 401
+    if isinstance(e, AnalyticsUnavailableError):
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(int(app_settings.readiness.retry_interval))}
+    if isinstance(e, SearchTimeoutError):
+        return jsonify({"error": str(e)}), 504
+    if isinstance(e, HttpResponseError):
+        ## the index rejected the query (a bad filter, or a field it can't filter, sort or select)
+        if e.status_code != 400:
+            logger.exception(f"Exception in /{route}")
+        return jsonify({"error": e.message}), 400 if e.status_code == 400 else 502
+    logger.exception(f"Exception in /{route}")
+    return jsonify({"error": str(e)}), 500
 
 
 ## Conversation History API ##
+@bp.before_request
+async def begin_history_request_charges():
+    if request.path.startswith("/history/"):
+        route = request.url_rule.rule if request.url_rule else request.path
+        cosmosmetrics.begin_request(route)
+
+
+@bp.after_request
+async def add_history_request_charge_headers(response):
+    ## per-request Cosmos totals are only exposed while debugging
+    if DEBUG.lower() == "true" and request.path.startswith("/history/"):
+        request_charges = cosmosmetrics.current_request_charges()
+        if request_charges:
+            response.headers.update(request_charges.as_headers())
+    return response
+
+
+@bp.route("/history/metrics", methods=["GET"])
+async def history_metrics():
+    if DEBUG.lower() != "true":
+        return jsonify({"error": "Not found"}), 404
+    return jsonify(cosmosmetrics.snapshot()), 200
+
+
 @bp.route("/history/generate", methods=["POST"])
 async def add_conversation():
-    await cosmos_db_ready.wait()
+    current_app.readiness.require("history")
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user["user_principal_id"]
-    client_ip = authenticated_user["client_ip"]
+    user_id = get_history_user_id(authenticated_user)
 
     ## check request for conversation_id
     request_json = await request.get_json()
@@ -550,16 +1187,14 @@ async def add_conversation():
 
     try:
         # make sure cosmos is configured
-        if not current_app.cosmos_conversation_client:
+        if not current_app.conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
         # check for the conversation_id, if the conversation is not set, we will create a new one
         history_metadata = {}
         if not conversation_id:
             title = await generate_title(request_json["messages"])
-            conversation_dict = await current_app.cosmos_conversation_client.create_conversation(
-                user_id=client_ip, title=title
-            )
+            conversation_dict = await create_history_conversation(user_id, title)
             conversation_id = conversation_dict["id"]
             history_metadata["title"] = title
             history_metadata["date"] = conversation_dict["createdAt"]
@@ -568,11 +1203,8 @@ async def add_conversation():
         ## then write it to the conversation history in cosmos
         messages = request_json["messages"]
         if len(messages) > 0 and messages[-1]["role"] == "user":
-            createdMessageValue = await current_app.cosmos_conversation_client.create_message(
-                uuid=str(uuid.uuid4()),
-                conversation_id=conversation_id,
-                user_id=client_ip,
-                input_message=messages[-1],
+            createdMessageValue = await create_history_message(
+                user_id, conversation_id, messages[-1]
             )
             if createdMessageValue == "Conversation not found":
                 raise Exception(
@@ -596,10 +1228,9 @@ async def add_conversation():
 
 @bp.route("/history/update", methods=["POST"])
 async def update_conversation():
-    await cosmos_db_ready.wait()
+    current_app.readiness.require("history")
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user["user_principal_id"]
-    client_ip = authenticated_user["client_ip"]
+    user_id = get_history_user_id(authenticated_user)
 
     ## check request for conversation_id
     request_json = await request.get_json()
@@ -607,7 +1238,7 @@ async def update_conversation():
 
     try:
         # make sure cosmos is configured
-        if not current_app.cosmos_conversation_client:
+        if not current_app.conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
         # check for the conversation_id, if the conversation is not set, we will create a new one
@@ -620,18 +1251,10 @@ async def update_conversation():
         if len(messages) > 0 and messages[-1]["role"] == "assistant":
             if len(messages) > 1 and messages[-2].get("role", None) == "tool":
                 # write the tool message first
-                await current_app.cosmos_conversation_client.create_message(
-                    uuid=str(uuid.uuid4()),
-                    conversation_id=conversation_id,
-                    user_id=client_ip,
-                    input_message=messages[-2],
-                )
+                await create_history_message(user_id, conversation_id, messages[-2])
             # write the assistant message
-            await current_app.cosmos_conversation_client.create_message(
-                uuid=messages[-1]["id"],
-                conversation_id=conversation_id,
-                user_id=client_ip,
-                input_message=messages[-1],
+            await create_history_message(
+                user_id, conversation_id, messages[-1], message_id=messages[-1]["id"]
             )
         else:
             raise Exception("No bot messages found")
@@ -647,14 +1270,16 @@ async def update_conversation():
 
 @bp.route("/history/message_feedback", methods=["POST"])
 async def update_message():
-    await cosmos_db_ready.wait()
+    current_app.readiness.require("history")
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user["user_principal_id"]
-    client_ip = authenticated_user["client_ip"]
+    user_id = get_history_user_id(authenticated_user)
+    await flush_history_writes(user_id)
     ## check request for message_id
     request_json = await request.get_json()
     message_id = request_json.get("message_id", None)
     message_feedback = request_json.get("message_feedback", None)
+    ## optional, saves a cross-partition lookup when history is partitioned by conversation
+    conversation_id = request_json.get("conversation_id", None)
     try:
         if not message_id:
             return jsonify({"error": "message_id is required"}), 400
@@ -663,8 +1288,8 @@ async def update_message():
             return jsonify({"error": "message_feedback is required"}), 400
 
         ## update the message in cosmos
-        updated_message = await current_app.cosmos_conversation_client.update_message_feedback(
-            client_ip, message_id, message_feedback
+        updated_message = await current_app.conversation_client.update_message_feedback(
+            user_id, message_id, message_feedback, conversation_id
         )
         if updated_message:
             return (
@@ -691,13 +1316,53 @@ async def update_message():
         return jsonify({"error": str(e)}), 500
 
 
+@bp.route("/history/message_feedback/batch", methods=["POST"])
+async def update_messages():
+    current_app.readiness.require("history")
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = get_history_user_id(authenticated_user)
+    await flush_history_writes(user_id)
+    ## check request for a list of {message_id, message_feedback, conversation_id?}
+    request_json = await request.get_json()
+    feedback_list = request_json.get("feedback", None)
+    try:
+        if not isinstance(feedback_list, list) or not feedback_list:
+            return jsonify({"error": "feedback must be a non-empty list"}), 400
+
+        if len(feedback_list) > MAX_FEEDBACK_BATCH_SIZE:
+            return jsonify({"error": f"feedback is limited to {MAX_FEEDBACK_BATCH_SIZE} messages per request"}), 400
+
+        ratings = []
+        for item in feedback_list:
+            if not isinstance(item, dict) or not item.get("message_id") or not item.get("message_feedback"):
+                return jsonify({"error": "each feedback item needs a message_id and message_feedback"}), 400
+            ratings.append((item["message_id"], item["message_feedback"], item.get("conversation_id")))
+
+        ## update the messages in cosmos
+        updated_messages = await current_app.conversation_client.update_messages_feedback(user_id, ratings)
+        updated_ids = {message["id"] for message in updated_messages}
+        return (
+            jsonify(
+                {
+                    "updated": [message_id for message_id, _, _ in ratings if message_id in updated_ids],
+                    "not_found": [message_id for message_id, _, _ in ratings if message_id not in updated_ids],
+                }
+            ),
+            200,
+        )
+
+    except Exception as e:
+        logger.exception("Exception in /history/message_feedback/batch")
+        return jsonify({"error": str(e)}), 500
+
+
 @bp.route("/history/delete", methods=["DELETE"])
 async def delete_conversation():
-    await cosmos_db_ready.wait()
+    current_app.readiness.require("history")
     ## get the user id from the request headers
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user["user_principal_id"]
-    client_ip = authenticated_user["client_ip"]
+    user_id = get_history_user_id(authenticated_user)
+    await flush_history_writes(user_id)
 
     ## check request for conversation_id
     request_json = await request.get_json()
@@ -708,18 +1373,21 @@ async def delete_conversation():
             return jsonify({"error": "conversation_id is required"}), 400
 
         ## make sure cosmos is configured
-        if not current_app.cosmos_conversation_client:
+        if not current_app.conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
+        await discard_history_archive(user_id, conversation_id)
+
         ## delete the conversation messages from cosmos first
-        deleted_messages = await current_app.cosmos_conversation_client.delete_messages(
-            conversation_id, client_ip
+        deleted_messages = await current_app.conversation_client.delete_messages(
+            conversation_id, user_id
         )
 
         ## Now delete the conversation
-        deleted_conversation = await current_app.cosmos_conversation_client.delete_conversation(
-            client_ip, conversation_id
+        deleted_conversation = await current_app.conversation_client.delete_conversation(
+            user_id, conversation_id
         )
+        current_app.history_search_index.conversation_deleted(user_id, conversation_id)
 
         return (
             jsonify(
@@ -737,34 +1405,115 @@ async def delete_conversation():
 
 @bp.route("/history/list", methods=["GET"])
 async def list_conversations():
-    await cosmos_db_ready.wait()
-    offset = request.args.get("offset", 0)
+    current_app.readiness.require("history")
+    offset = request.args.get("offset", 0, type=int)
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user["user_principal_id"]
-    client_ip = authenticated_user["client_ip"]
+    user_id = get_history_user_id(authenticated_user)
+    await flush_history_writes(user_id)
 
     ## make sure cosmos is configured
-    if not current_app.cosmos_conversation_client:
+    if not current_app.conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
     ## get the conversations from cosmos
-    conversations = await current_app.cosmos_conversation_client.get_conversations(
-        client_ip, offset=offset, limit=25
+    conversations = await current_app.conversation_client.get_conversations(
+        user_id, offset=offset, limit=25
     )
     if not isinstance(conversations, list):
-        return jsonify({"error": f"No conversations for {client_ip} were found"}), 404
+        return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
     ## return the conversation ids
 
     return jsonify(conversations), 200
 
 
+async def export_history_records(conversation_client, history_archiver, user_id):
+    ## one record per line: each conversation followed by its messages, streamed page by page.
+    ## runs while the response streams, outside the app context, so clients are passed in
+    async for conversation in conversation_client.iter_conversations(user_id):
+        yield {
+            "type": "conversation",
+            "id": conversation["id"],
+            "title": conversation.get("title"),
+            "createdAt": conversation.get("createdAt"),
+            "updatedAt": conversation.get("updatedAt"),
+        }
+
+        if conversation.get(ARCHIVED_FIELD) and history_archiver:
+            ## read archived messages straight from the blob, exporting shouldn't rehydrate
+            messages = await history_archiver.read_messages(conversation)
+        else:
+            messages = [message async for message in conversation_client.iter_messages(user_id, conversation["id"])]
+
+        for message in messages:
+            yield {
+                "type": "message",
+                "id": message["id"],
+                "conversationId": conversation["id"],
+                "role": message["role"],
+                "content": message["content"],
+                "createdAt": message["createdAt"],
+                "feedback": message.get("feedback"),
+            }
+
+
+@bp.route("/history/export", methods=["GET"])
+async def export_conversations():
+    current_app.readiness.require("history")
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = get_history_user_id(authenticated_user)
+    await flush_history_writes(user_id)
+
+    ## make sure cosmos is configured
+    if not current_app.conversation_client:
+        raise Exception("CosmosDB is not configured or not working")
+
+    compress = request.args.get("gzip", "false").lower() in ("1", "true")
+    body = format_as_ndjson(
+        export_history_records(current_app.conversation_client, current_app.history_archiver, user_id)
+    )
+    if compress:
+        body = gzip_stream(body)
+
+    response = await make_response(body)
+    response.timeout = None
+    if compress:
+        response.mimetype = "application/gzip"
+        response.headers["Content-Disposition"] = 'attachment; filename="history.ndjson.gz"'
+    else:
+        response.mimetype = "application/json-lines"
+        response.headers["Content-Disposition"] = 'attachment; filename="history.ndjson"'
+    return response
+
+
+@bp.route("/history/search", methods=["GET"])
+async def search_conversations():
+    current_app.readiness.require("history")
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = get_history_user_id(authenticated_user)
+    await flush_history_writes(user_id)
+
+    query = request.args.get("q", "").strip()
+    limit = min(max(request.args.get("limit", 20, type=int), 1), 100)
+    if not query:
+        return jsonify({"error": "q is required"}), 400
+
+    ## make sure cosmos is configured
+    if not current_app.conversation_client:
+        raise Exception("CosmosDB is not configured or not working")
+
+    results = await current_app.history_search_index.search(
+        current_app.conversation_client, user_id, query, limit
+    )
+    return jsonify(results), 200
+
+
 @bp.route("/history/read", methods=["POST"])
 async def get_conversation():
-    await cosmos_db_ready.wait()
+    current_app.readiness.require("history")
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user["user_principal_id"]
-    client_ip = authenticated_user["client_ip"]
+    user_id = get_history_user_id(authenticated_user)
+    await flush_history_writes(user_id)
 
     ## check request for conversation_id
     request_json = await request.get_json()
@@ -774,12 +1523,12 @@ async def get_conversation():
         return jsonify({"error": "conversation_id is required"}), 400
 
     ## make sure cosmos is configured
-    if not current_app.cosmos_conversation_client:
+    if not current_app.conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
     ## get the conversation object and the related messages from cosmos
-    conversation = await current_app.cosmos_conversation_client.get_conversation(
-        client_ip, conversation_id
+    conversation = await current_app.conversation_client.get_conversation(
+        user_id, conversation_id
     )
     ## return the conversation id and the messages in the bot frontend format
     if not conversation:
@@ -792,9 +1541,11 @@ async def get_conversation():
             404,
         )
 
+    conversation = await rehydrate_history_conversation(conversation)
+
     # get the messages for the conversation from cosmos
-    conversation_messages = await current_app.cosmos_conversation_client.get_messages(
-        client_ip, conversation_id
+    conversation_messages = await current_app.conversation_client.get_messages(
+        user_id, conversation_id
     )
 
     ## format the messages in the bot frontend format
@@ -809,15 +1560,18 @@ async def get_conversation():
         for msg in conversation_messages
     ]
 
-    return jsonify({"conversation_id": conversation_id, "messages": messages}), 200
+    response = {"conversation_id": conversation_id, "messages": messages}
+    if current_app.conversation_client.enable_message_feedback:
+        response["feedback_summary"] = feedback_summary(conversation)
+    return jsonify(response), 200
 
 
 @bp.route("/history/rename", methods=["POST"])
 async def rename_conversation():
-    await cosmos_db_ready.wait()
+    current_app.readiness.require("history")
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user["user_principal_id"]
-    client_ip = authenticated_user["client_ip"]
+    user_id = get_history_user_id(authenticated_user)
+    await flush_history_writes(user_id)
 
     ## check request for conversation_id
     request_json = await request.get_json()
@@ -827,12 +1581,12 @@ async def rename_conversation():
         return jsonify({"error": "conversation_id is required"}), 400
 
     ## make sure cosmos is configured
-    if not current_app.cosmos_conversation_client:
+    if not current_app.conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
     ## get the conversation from cosmos
-    conversation = await current_app.cosmos_conversation_client.get_conversation(
-        client_ip, conversation_id
+    conversation = await current_app.conversation_client.get_conversation(
+        user_id, conversation_id
     )
     if not conversation:
         return (
@@ -849,48 +1603,52 @@ async def rename_conversation():
     if not title:
         return jsonify({"error": "title is required"}), 400
     conversation["title"] = title
-    updated_conversation = await current_app.cosmos_conversation_client.upsert_conversation(
+    updated_conversation = await current_app.conversation_client.upsert_conversation(
         conversation
     )
+    current_app.history_search_index.conversation_added(user_id, updated_conversation)
 
     return jsonify(updated_conversation), 200
 
 
 @bp.route("/history/delete_all", methods=["DELETE"])
 async def delete_all_conversations():
-    await cosmos_db_ready.wait()
+    current_app.readiness.require("history")
     ## get the user id from the request headers
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user["user_principal_id"]
-    client_ip = authenticated_user["client_ip"]
+    user_id = get_history_user_id(authenticated_user)
+    await flush_history_writes(user_id)
 
     # get conversations for user
     try:
         ## make sure cosmos is configured
-        if not current_app.cosmos_conversation_client:
+        if not current_app.conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
-        conversations = await current_app.cosmos_conversation_client.get_conversations(
-            client_ip, offset=0, limit=None
+        conversations = await current_app.conversation_client.get_conversations(
+            user_id, offset=0, limit=None
         )
         if not conversations:
-            return jsonify({"error": f"No conversations for {client_ip} were found"}), 404
+            return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
         # delete each conversation
         for conversation in conversations:
+            await discard_history_archive(user_id, conversation["id"])
+
             ## delete the conversation messages from cosmos first
-            deleted_messages = await current_app.cosmos_conversation_client.delete_messages(
-                conversation["id"], client_ip
+            deleted_messages = await current_app.conversation_client.delete_messages(
+                conversation["id"], user_id
             )
 
             ## Now delete the conversation
-            deleted_conversation = await current_app.cosmos_conversation_client.delete_conversation(
-                client_ip, conversation["id"]
+            deleted_conversation = await current_app.conversation_client.delete_conversation(
+                user_id, conversation["id"]
             )
+            current_app.history_search_index.conversation_deleted(user_id, conversation["id"])
         return (
             jsonify(
                 {
-                    "message": f"Successfully deleted conversation and messages for user {client_ip}"
+                    "message": f"Successfully deleted conversation and messages for user {user_id}"
                 }
             ),
             200,
@@ -903,11 +1661,11 @@ async def delete_all_conversations():
 
 @bp.route("/history/clear", methods=["POST"])
 async def clear_messages():
-    await cosmos_db_ready.wait()
+    current_app.readiness.require("history")
     ## get the user id from the request headers
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user["user_principal_id"]
-    client_ip = authenticated_user["client_ip"]
+    user_id = get_history_user_id(authenticated_user)
+    await flush_history_writes(user_id)
 
     ## check request for conversation_id
     request_json = await request.get_json()
@@ -918,13 +1676,16 @@ async def clear_messages():
             return jsonify({"error": "conversation_id is required"}), 400
 
         ## make sure cosmos is configured
-        if not current_app.cosmos_conversation_client:
+        if not current_app.conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
+        await discard_history_archive(user_id, conversation_id, keep_conversation=True)
+
         ## delete the conversation messages from cosmos
-        deleted_messages = await current_app.cosmos_conversation_client.delete_messages(
-            conversation_id, client_ip
+        deleted_messages = await current_app.conversation_client.delete_messages(
+            conversation_id, user_id
         )
+        current_app.history_search_index.messages_cleared(user_id, conversation_id)
 
         return (
             jsonify(
@@ -942,13 +1703,15 @@ async def clear_messages():
 
 @bp.route("/history/ensure", methods=["GET"])
 async def ensure_cosmos():
-    await cosmos_db_ready.wait()
-    if not app_settings.chat_history:
+    if not current_app.conversation_client:
+        state = current_app.readiness.components.get("history")
+        if state and state.status != DISABLED:
+            return jsonify({"error": f"Chat history is {state.status}: {state.detail}"}), 503
         return jsonify({"error": "CosmosDB is not configured"}), 404
 
     try:
-        success, err = await current_app.cosmos_conversation_client.ensure()
-        if not current_app.cosmos_conversation_client or not success:
+        success, err = await current_app.conversation_client.ensure()
+        if not current_app.conversation_client or not success:
             if err:
                 return jsonify({"error": err}), 422
             return jsonify({"error": "CosmosDB is not configured or not working"}), 500
@@ -992,7 +1755,7 @@ async def generate_title(conversation_messages) -> str:
     messages.append({"role": "user", "content": title_prompt})
 
     try:
-        azure_openai_client = await init_openai_client()
+        azure_openai_client = await get_openai_client()
         response = await azure_openai_client.chat.completions.create(
             model=app_settings.azure_openai.model, messages=messages, temperature=1, max_tokens=64
         )
@@ -0,0 +1,926 @@
+import os
+import re
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+import logging
+import operator
+import tempfile
+import functools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from backend.search.gateway import SearchGateway, search_gateway
+from backend.search.groupby import METRIC_FUNCTIONS, keyset_pages, metric_name, sort_rows
+from backend.search.sketches import DISTINCT_FUNCTION, QUANTILE_FUNCTIONS
+
+logger = logging.getLogger(__name__)
+
+## the analytical fields of the claims index (create_cms1500_healthcare_index in
+## scripts/indexdata.py); content, the vector, names, addresses and member ids aren't loaded
+NUMERIC_FIELDS = ("claimAmount", "lineItemCharge", "amountPaid", "balanceDue")
+DATE_FIELDS = ("serviceStartDate", "serviceEndDate", "patientDOB")
+CATEGORICAL_FIELDS = (
+    "patientSex", "patientState", "patientCity", "providerName", "providerNPI",
+    "insuranceCompany", "insurancePlan", "diagnosisCodes", "procedureCode", "placeOfService",
+)
+BOOLEAN_FIELDS = ("isAggregationCandidate",)
+CLAIM_FIELDS = NUMERIC_FIELDS + DATE_FIELDS + CATEGORICAL_FIELDS + BOOLEAN_FIELDS
+
+## dictionary code of a missing categorical value
+MISSING = -1
+SNAPSHOT_FORMAT = 1
+MANIFEST_KEY = "__manifest__"
+## a snapshot directory holds a directory of .npy columns per version and names the live one in CURRENT
+MAPPED_SNAPSHOT_FORMAT = 2
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+NAT = np.datetime64("NaT", "ms")
+
+COMPARISONS = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "gt": operator.gt,
+    "ge": operator.ge,
+    "lt": operator.lt,
+    "le": operator.le,
+}
+
+
+def parse_date(value: Any) -> np.datetime64:
+    ## Edm.DateTimeOffset comes back as ISO 8601 text; columns hold naive UTC milliseconds
+    if value is None:
+        return NAT
+    try:
+        if not isinstance(value, datetime):
+            value = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return np.datetime64(value, "ms")
+    except (ValueError, TypeError):
+        return NAT
+
+
+def format_dates(values: np.ndarray) -> List[str]:
+    return [f"{value}Z" for value in np.datetime_as_string(values, unit="s")]
+
+
+def _float(value: Any) -> float:
+    if value is None:
+        return np.nan
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return np.nan
+
+
+class ColumnsBuilder():
+    """Collects documents a page at a time and encodes them into ``ClaimsColumns``."""
+
+    def __init__(self):
+        self.numeric: Dict[str, List[float]] = {field: [] for field in NUMERIC_FIELDS}
+        self.dates: Dict[str, List[Any]] = {field: [] for field in DATE_FIELDS}
+        self.codes: Dict[str, List[int]] = {field: [] for field in CATEGORICAL_FIELDS + BOOLEAN_FIELDS}
+        ## value -> code, in first-seen order; booleans are always [False, True]
+        self.dictionaries: Dict[str, Dict[Any, int]] = {field: {} for field in CATEGORICAL_FIELDS}
+        self.dictionaries.update({field: {False: 0, True: 1} for field in BOOLEAN_FIELDS})
+        self.size = 0
+
+    def add_page(self, documents: Iterable[dict]):
+        documents = list(documents)
+        self.size += len(documents)
+        for field, values in self.numeric.items():
+            values.extend(_float(document.get(field)) for document in documents)
+        for field, values in self.dates.items():
+            values.extend(document.get(field) for document in documents)
+        for field, codes in self.codes.items():
+            dictionary = self.dictionaries[field]
+            for document in documents:
+                value = document.get(field)
+                if value is None:
+                    codes.append(MISSING)
+                elif field in BOOLEAN_FIELDS:
+                    codes.append(int(bool(value)))
+                else:
+                    code = dictionary.get(value)
+                    if code is None:
+                        code = dictionary[value] = len(dictionary)
+                    codes.append(code)
+
+    def build(self, source: str) -> "ClaimsColumns":
+        dates = {}
+        for field, values in self.dates.items():
+            ## service dates repeat heavily, parse each distinct string once
+            parsed = {}
+            dates[field] = np.array(
+                [parsed[value] if value in parsed else parsed.setdefault(value, parse_date(value)) for value in values],
+                dtype="datetime64[ms]",
+            ).reshape(-1)
+        return ClaimsColumns(
+            numeric={field: np.array(values, dtype=np.float64).reshape(-1) for field, values in self.numeric.items()},
+            dates=dates,
+            categorical={
+                field: (np.array(codes, dtype=np.int32).reshape(-1), list(self.dictionaries[field]))
+                for field, codes in self.codes.items()
+            },
+            source=source,
+        )
+
+
+class ClaimsColumns():
+    """
+    One immutable version of the claims, a NumPy array per field.
+
+    Amounts are float64 with NaN for missing values, dates datetime64[ms]
+    with NaT, and categoricals (booleans included) int32 dictionary codes
+    with ``MISSING`` for null. Filters compile to boolean masks and
+    group-bys are ``bincount`` over the codes, so queries touch only the
+    columns they name.
+    """
+
+    def __init__(self, numeric: Dict[str, np.ndarray], dates: Dict[str, np.ndarray],
+                 categorical: Dict[str, Tuple[np.ndarray, List[Any]]], source: str,
+                 loaded_at: float = None, version: str = None):
+        self.numeric = numeric
+        self.dates = dates
+        self.categorical = categorical
+        self.source = source
+        self.loaded_at = loaded_at or time.time()
+        self.size = len(next(iter(numeric.values()))) if numeric else 0
+        self.version = version or self.fingerprint()
+        ## group keys of numeric and date fields, built on first use
+        self._group_keys: Dict[str, Tuple[np.ndarray, List[Any]]] = {}
+        ## the version directory the columns are mapped from, when loaded from a snapshot directory
+        self.snapshot_dir: Optional[str] = None
+        self.scanner: Optional["ChunkedScanner"] = None
+
+    @property
+    def fields(self) -> List[str]:
+        return list(self.numeric) + list(self.dates) + list(self.categorical)
+
+    def fingerprint(self) -> str:
+        ## same data, same version, whichever worker loaded it
+        digest = hashlib.blake2b(digest_size=8)
+        for field in sorted(self.fields):
+            digest.update(field.encode())
+            if field in self.categorical:
+                codes, categories = self.categorical[field]
+                digest.update(codes.tobytes())
+                digest.update(json.dumps(categories, default=str).encode())
+            else:
+                digest.update((self.numeric.get(field) if field in self.numeric else self.dates[field]).tobytes())
+        return digest.hexdigest()
+
+    def describe(self) -> dict:
+        return {
+            "source": self.source,
+            "version": self.version,
+            "loaded_at": self.loaded_at,
+            "claims": self.size,
+            "memory_mapped": self.snapshot_dir is not None,
+            "chunked": self.chunked,
+            "categories": {field: len(categories) for field, (_, categories) in self.categorical.items()},
+        }
+
+    @property
+    def chunked(self) -> bool:
+        """Whether scans run a chunk at a time, and so are worth running off the event loop."""
+        return self.scanner is not None and self.size > self.scanner.chunk_rows
+
+    def slice(self, start: int, stop: int) -> "ClaimsColumns":
+        """Claims ``start`` to ``stop``, as views of these columns; categories are shared."""
+        return ClaimsColumns(
+            numeric={field: column[start:stop] for field, column in self.numeric.items()},
+            dates={field: column[start:stop] for field, column in self.dates.items()},
+            categorical={field: (codes[start:stop], categories) for field, (codes, categories) in self.categorical.items()},
+            source=self.source,
+            loaded_at=self.loaded_at,
+            version=self.version,
+        )
+
+    def filter(self, filter_str: Optional[str]) -> Optional[np.ndarray]:
+        """Boolean mask of the claims matching an OData ``$filter``, None for no filter."""
+        if not filter_str or not filter_str.strip():
+            return None
+        return _FilterCompiler(self, filter_str).compile()
+
+    def count(self, filter_str: Optional[str] = None) -> int:
+        mask = self.filter(filter_str)
+        return self.size if mask is None else int(mask.sum())
+
+    def group_keys(self, field: str) -> Tuple[np.ndarray, List[Any]]:
+        """An int code per claim (``MISSING`` for null) and the value of each code."""
+        if field in self.categorical:
+            return self.categorical[field]
+        if field not in self._group_keys:
+            if field in self.numeric:
+                column, missing = self.numeric[field], np.isnan(self.numeric[field])
+            elif field in self.dates:
+                column, missing = self.dates[field], np.isnat(self.dates[field])
+            else:
+                raise ValueError(f"Unknown field: {field}")
+            keys = np.full(self.size, MISSING, dtype=np.int32)
+            values, inverse = np.unique(column[~missing], return_inverse=True)
+            keys[~missing] = inverse.reshape(-1)
+            labels = format_dates(values) if field in self.dates else values.tolist()
+            self._group_keys[field] = (keys, labels)
+        return self._group_keys[field]
+
+    def metric_values(self, field: str) -> np.ndarray:
+        if field not in self.numeric:
+            raise ValueError(f"Metrics need a numeric field, got: {field}")
+        return self.numeric[field]
+
+    def group_by(self, group_by_field: str, metrics: Iterable[Tuple[str, str]] = (), filter_str: Optional[str] = None,
+                 sort_by: Optional[str] = None, order: str = "desc", top: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Rows shaped like ``GroupByAccumulator.results``: ``group``, ``count``
+        and a ``metrics`` dict keyed by ``metric_name``. Percentiles and
+        distinct counts are exact here, the columns hold every value.
+        """
+        metrics = [(field, function) for field, function in metrics]
+        for field, function in metrics:
+            if function not in METRIC_FUNCTIONS:
+                raise ValueError(f"Unsupported metric function: {function}")
+            if function == DISTINCT_FUNCTION:
+                self.group_keys(field)
+            else:
+                self.metric_values(field)
+
+        labels = self.group_keys(group_by_field)[1]
+        if self.chunked and self.scanner.handles(self, group_by_field, metrics):
+            counts, columns, documents = self.scanner.group_stats(self, group_by_field, metrics, filter_str)
+        else:
+            counts, columns, documents = _scan_chunk(self, group_by_field, metrics, filter_str).finish()
+
+        rows = []
+        for code in np.flatnonzero(counts):
+            rows.append({
+                "group": labels[code],
+                "count": int(counts[code]),
+                "metrics": {
+                    metric_name(field, function): _stat(columns[field], function, code)
+                    for field, function in metrics
+                },
+            })
+        return {
+            "results": sort_rows(rows, sort_by, order, top),
+            "total_groups": len(rows),
+            "total_documents": documents,
+            "strategy": "columnar",
+            "exact": True,
+        }
+
+    def aggregate(self, field: str, aggregation_type: str, filter_str: Optional[str] = None) -> Dict[str, Any]:
+        """Same result shape as ``AggregationPlanner.aggregate``."""
+        aggregation_type = aggregation_type.lower()
+        if aggregation_type not in METRIC_FUNCTIONS:
+            return {"error": f"Unsupported aggregation type: {aggregation_type}"}
+
+        if self.chunked and field in self.numeric and aggregation_type != DISTINCT_FUNCTION:
+            ## one group holding every claim
+            _, stats, _ = self.scanner.group_stats(self, None, [(field, aggregation_type)], filter_str)
+            count = int(stats[field]["count"][0])
+            result = _stat(stats[field], aggregation_type, 0)
+            return self._aggregation(field, aggregation_type, result, count)
+
+        mask = self.filter(filter_str)
+        if aggregation_type == DISTINCT_FUNCTION or (aggregation_type == "count" and field not in self.numeric):
+            keys, _ = self.group_keys(field)
+            present = keys != MISSING if mask is None else mask & (keys != MISSING)
+            count = int(present.sum())
+            result = len(np.unique(keys[present])) if aggregation_type == DISTINCT_FUNCTION else count
+        else:
+            values = self.metric_values(field)
+            values = values[~np.isnan(values) if mask is None else mask & ~np.isnan(values)]
+            count = len(values)
+            if count and aggregation_type in QUANTILE_FUNCTIONS:
+                result = float(np.quantile(values, QUANTILE_FUNCTIONS[aggregation_type]))
+            elif count:
+                result = {
+                    "count": count,
+                    "sum": float(values.sum()),
+                    "avg": float(values.mean()),
+                    "min": float(values.min()),
+                    "max": float(values.max()),
+                }[aggregation_type]
+        return self._aggregation(field, aggregation_type, result if count else None, count)
+
+    def _aggregation(self, field: str, aggregation_type: str, result: Any, count: int) -> Dict[str, Any]:
+        if not count:
+            return {"error": f"No numeric values found for field '{field}'"}
+
+        return {
+            "result": result,
+            "count": count,
+            "aggregation_type": aggregation_type,
+            "field": field,
+            "strategy": "columnar",
+            "exact": True,
+        }
+
+    def save(self, path: str):
+        """
+        Write a snapshot: an ``.npz`` file, replacing ``path`` atomically,
+        or for any other path a snapshot directory the columns can be
+        memory-mapped from.
+        """
+        if not path.endswith(".npz"):
+            return self._save_directory(path)
+
+        arrays = {}
+        manifest = {
+            "format": SNAPSHOT_FORMAT,
+            "source": self.source,
+            "version": self.version,
+            "loaded_at": self.loaded_at,
+            "size": self.size,
+            "numeric": list(self.numeric),
+            "dates": list(self.dates),
+            "categorical": list(self.categorical),
+        }
+        arrays.update(self.numeric)
+        arrays.update({field: column.astype(np.int64) for field, column in self.dates.items()})
+        for field, (codes, categories) in self.categorical.items():
+            arrays[field] = codes
+            if field not in BOOLEAN_FIELDS:
+                arrays[f"{field}.categories"] = np.array([str(category) for category in categories], dtype=str)
+        arrays[MANIFEST_KEY] = np.array(json.dumps(manifest))
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _save_directory(self, path: str):
+        ## each version is written to a temporary directory and renamed into place, then CURRENT
+        ## is replaced to point at it, so a reader maps either the old version or the new one
+        os.makedirs(path, exist_ok=True)
+        version_dir = os.path.join(path, self.version)
+        if not os.path.isdir(version_dir):
+            temp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=path)
+            try:
+                categories = {}
+                for field, column in self.numeric.items():
+                    np.save(os.path.join(temp_dir, f"{field}.npy"), np.ascontiguousarray(column, dtype=np.float64))
+                for field, column in self.dates.items():
+                    np.save(os.path.join(temp_dir, f"{field}.npy"), np.ascontiguousarray(column, dtype="datetime64[ms]"))
+                for field, (codes, field_categories) in self.categorical.items():
+                    np.save(os.path.join(temp_dir, f"{field}.npy"), np.ascontiguousarray(codes, dtype=np.int32))
+                    if field not in BOOLEAN_FIELDS:
+                        categories[field] = [str(category) for category in field_categories]
+                with open(os.path.join(temp_dir, MANIFEST_FILE), "w") as f:
+                    json.dump({
+                        "format": MAPPED_SNAPSHOT_FORMAT,
+                        "source": self.source,
+                        "version": self.version,
+                        "loaded_at": self.loaded_at,
+                        "size": self.size,
+                        "numeric": list(self.numeric),
+                        "dates": list(self.dates),
+                        "categorical": list(self.categorical),
+                        "categories": categories,
+                    }, f)
+                os.rename(temp_dir, version_dir)
+            except OSError:
+                ## another worker renamed the same version into place first
+                if not os.path.isdir(version_dir):
+                    raise
+            finally:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+        current_path = os.path.join(path, CURRENT_FILE)
+        temp_path = f"{current_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(self.version)
+        os.replace(temp_path, current_path)
+        _prune_versions(path, self.version)
+
+    @classmethod
+    def load(cls, path: str) -> "ClaimsColumns":
+        if os.path.isdir(path):
+            return cls._load_directory(path)
+
+        with np.load(path, allow_pickle=False) as snapshot:
+            manifest = json.loads(str(snapshot[MANIFEST_KEY]))
+            if manifest.get("format") != SNAPSHOT_FORMAT:
+                raise ValueError(f"Unsupported claims snapshot format {manifest.get('format')} in {path}")
+            categorical = {}
+            for field in manifest["categorical"]:
+                categories = [False, True] if field in BOOLEAN_FIELDS else snapshot[f"{field}.categories"].tolist()
+                categorical[field] = (snapshot[field], categories)
+            return cls(
+                numeric={field: snapshot[field] for field in manifest["numeric"]},
+                dates={field: snapshot[field].astype("datetime64[ms]") for field in manifest["dates"]},
+                categorical=categorical,
+                source=f"snapshot {path} ({manifest['source']})",
+                loaded_at=manifest["loaded_at"],
+                version=manifest["version"],
+            )
+
+    @classmethod
+    def _load_directory(cls, path: str) -> "ClaimsColumns":
+        ## the arrays are mapped read-only, so every worker mapping a version shares its pages
+        ## through the page cache instead of holding a copy
+        version_dir = path
+        if not os.path.exists(os.path.join(path, MANIFEST_FILE)):
+            with open(os.path.join(path, CURRENT_FILE)) as f:
+                version_dir = os.path.join(path, f.read().strip())
+        with open(os.path.join(version_dir, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        if manifest.get("format") != MAPPED_SNAPSHOT_FORMAT:
+            raise ValueError(f"Unsupported claims snapshot format {manifest.get('format')} in {version_dir}")
+
+        def column(field: str) -> np.ndarray:
+            return np.load(os.path.join(version_dir, f"{field}.npy"), mmap_mode="r", allow_pickle=False)
+
+        categorical = {}
+        for field in manifest["categorical"]:
+            categories = [False, True] if field in BOOLEAN_FIELDS else manifest["categories"][field]
+            categorical[field] = (column(field), categories)
+        columns = cls(
+            numeric={field: column(field) for field in manifest["numeric"]},
+            dates={field: column(field) for field in manifest["dates"]},
+            categorical=categorical,
+            source=f"snapshot {path} ({manifest['source']})",
+            loaded_at=manifest["loaded_at"],
+            version=manifest["version"],
+        )
+        columns.snapshot_dir = version_dir
+        return columns
+
+
+def _prune_versions(path: str, current: str, keep: int = 2):
+    ## a worker may still be mapping a recent version, so the newest few stay; deleting a
+    ## mapped file is safe on POSIX, the pages live until the last mapping closes
+    versions = [
+        entry for entry in os.scandir(path)
+        if entry.is_dir() and not entry.name.startswith(".") and entry.name != current
+    ]
+    versions.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in versions[keep:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def _group_stats(groups: np.ndarray, values: np.ndarray, size: int, functions: set) -> Dict[str, np.ndarray]:
+    stats = {
+        "count": np.bincount(groups, minlength=size),
+        "sum": np.bincount(groups, weights=values, minlength=size),
+    }
+    if "min" in functions:
+        stats["min"] = np.full(size, np.inf)
+        np.minimum.at(stats["min"], groups, values)
+    if "max" in functions:
+        stats["max"] = np.full(size, -np.inf)
+        np.maximum.at(stats["max"], groups, values)
+    quantiles = [function for function in functions if function in QUANTILE_FUNCTIONS]
+    if quantiles:
+        ## each group's values sorted and contiguous, then read at the quantile's position
+        ordered = values[np.lexsort((values, groups))]
+        counts = stats["count"]
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+        present = counts > 0
+        for function in quantiles:
+            position = QUANTILE_FUNCTIONS[function] * (counts[present] - 1)
+            low, high = np.floor(position).astype(np.int64), np.ceil(position).astype(np.int64)
+            low_values, high_values = ordered[starts[present] + low], ordered[starts[present] + high]
+            stats[function] = np.full(size, np.nan)
+            stats[function][present] = low_values + (high_values - low_values) * (position - low)
+    return stats
+
+
+class _Partial():
+    """
+    Group-by statistics over some of the claims, which merge with the
+    statistics of the rest: counts, sums, minima and maxima add up, while
+    percentiles keep their raw values and distinct counts their distinct
+    (group, value) pairs until ``finish``.
+    """
+
+    def __init__(self, size: int, documents: int, counts: np.ndarray):
+        self.size = size
+        self.documents = documents
+        self.counts = counts
+        ## field -> "stats", or "groups" and "values", and "pairs" and "base" for distinct
+        self.fields: Dict[str, Dict[str, Any]] = {}
+        self.functions: Dict[str, set] = {}
+
+    def merge(self, other: "_Partial") -> "_Partial":
+        self.documents += other.documents
+        self.counts = self.counts + other.counts
+        for field, entry in other.fields.items():
+            mine = self.fields[field]
+            for key in ("pairs", "groups", "values"):
+                if key in entry:
+                    mine[key] = mine[key] + entry[key]
+            if "stats" in entry:
+                stats = mine["stats"]
+                for function, values in entry["stats"].items():
+                    if function == "min":
+                        stats[function] = np.minimum(stats[function], values)
+                    elif function == "max":
+                        stats[function] = np.maximum(stats[function], values)
+                    else:
+                        stats[function] = stats[function] + values
+        return self
+
+    def finish(self) -> Tuple[np.ndarray, Dict[str, Dict[str, np.ndarray]], int]:
+        """Claims per group, the statistics of each metric field and the matching documents."""
+        stats = {}
+        for field, entry in self.fields.items():
+            stats[field] = {}
+            if "pairs" in entry:
+                pairs = np.unique(np.concatenate(entry["pairs"]))
+                stats[field][DISTINCT_FUNCTION] = np.bincount(pairs // entry["base"], minlength=self.size)
+            if "values" in entry:
+                stats[field].update(_group_stats(
+                    np.concatenate(entry["groups"]), np.concatenate(entry["values"]), self.size, self.functions[field],
+                ))
+            if "stats" in entry:
+                stats[field].update(entry["stats"])
+        return self.counts, stats, self.documents
+
+
+def _scan_chunk(columns: ClaimsColumns, group_by_field: Optional[str], metrics: List[Tuple[str, str]],
+                filter_str: Optional[str]) -> _Partial:
+    ## no group field puts every claim in one group
+    if group_by_field is None:
+        keys, labels = np.zeros(columns.size, dtype=np.int32), [None]
+    else:
+        keys, labels = columns.group_keys(group_by_field)
+    mask = columns.filter(filter_str)
+    selected = keys != MISSING if mask is None else mask & (keys != MISSING)
+    groups = keys[selected]
+    size = len(labels)
+    partial = _Partial(size, columns.size if mask is None else int(mask.sum()), np.bincount(groups, minlength=size))
+
+    functions: Dict[str, set] = {}
+    for field, function in metrics:
+        functions.setdefault(field, set()).add(function)
+    for field, field_functions in functions.items():
+        entry = partial.fields[field] = {}
+        partial.functions[field] = field_functions
+        if DISTINCT_FUNCTION in field_functions:
+            field_keys, field_labels = columns.group_keys(field)
+            field_keys = field_keys[selected]
+            present = field_keys != MISSING
+            entry["base"] = len(field_labels) + 1
+            entry["pairs"] = [np.unique(groups[present].astype(np.int64) * entry["base"] + field_keys[present])]
+        if field_functions - {DISTINCT_FUNCTION}:
+            values = columns.metric_values(field)[selected]
+            present = ~np.isnan(values)
+            if field_functions & set(QUANTILE_FUNCTIONS):
+                entry["groups"], entry["values"] = [groups[present]], [values[present]]
+            else:
+                entry["stats"] = _group_stats(groups[present], values[present], size, field_functions)
+    return partial
+
+
+## this pool process's mapped snapshot, so each chunk it scans doesn't open the files again
+_mapped_columns: Dict[str, ClaimsColumns] = {}
+
+
+def _scan_snapshot_chunk(snapshot_dir: str, start: int, stop: int, group_by_field: Optional[str],
+                         metrics: List[Tuple[str, str]], filter_str: Optional[str]) -> _Partial:
+    columns = _mapped_columns.get(snapshot_dir)
+    if columns is None:
+        _mapped_columns.clear()
+        columns = _mapped_columns[snapshot_dir] = ClaimsColumns.load(snapshot_dir)
+    return _scan_chunk(columns.slice(start, stop), group_by_field, metrics, filter_str)
+
+
+class ChunkedScanner():
+    """
+    Runs group-bys over ``chunk_rows`` claims at a time and merges the
+    partial results, so a filter's masks and a group's values never take
+    more than a chunk's worth of memory.
+
+    With ``processes`` set, columns mapped from a snapshot directory of at
+    least ``process_min_rows`` claims are scanned by a process pool: each
+    process maps the same files, so the chunks are read from the shared
+    page cache rather than copied to the processes.
+    """
+
+    def __init__(self, chunk_rows: int = 1_000_000, processes: int = 0, process_min_rows: int = 5_000_000):
+        self.chunk_rows = chunk_rows
+        self.processes = processes
+        self.process_min_rows = process_min_rows
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+
+    def handles(self, columns: ClaimsColumns, group_by_field: Optional[str], metrics: List[Tuple[str, str]]) -> bool:
+        ## the codes of categorical fields mean the same in every chunk; the group keys of
+        ## amounts and dates are numbered per chunk and can't be merged
+        return (group_by_field is None or group_by_field in columns.categorical) and all(
+            field in columns.categorical for field, function in metrics if function == DISTINCT_FUNCTION
+        )
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                ## spawned, not forked, so a process doesn't inherit the event loop and its sockets
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.processes, mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._pool
+
+    def group_stats(self, columns: ClaimsColumns, group_by_field: Optional[str], metrics: List[Tuple[str, str]],
+                    filter_str: Optional[str]) -> Tuple[np.ndarray, Dict[str, Dict[str, np.ndarray]], int]:
+        bounds = [(start, min(start + self.chunk_rows, columns.size)) for start in range(0, columns.size, self.chunk_rows)]
+        if self.processes and columns.snapshot_dir and columns.size >= self.process_min_rows:
+            executor = self._executor()
+            futures = [
+                executor.submit(_scan_snapshot_chunk, columns.snapshot_dir, start, stop, group_by_field, metrics, filter_str)
+                for start, stop in bounds
+            ]
+            partials = (future.result() for future in futures)
+        else:
+            partials = (_scan_chunk(columns.slice(start, stop), group_by_field, metrics, filter_str) for start, stop in bounds)
+
+        merged = None
+        for partial in partials:
+            merged = partial if merged is None else merged.merge(partial)
+        return merged.finish()
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+
+def _stat(stats: Dict[str, np.ndarray], function: str, code: int) -> Optional[float]:
+    if function == DISTINCT_FUNCTION:
+        return int(stats[DISTINCT_FUNCTION][code])
+    ## None for a group with no values of the field, as MetricAccumulator does
+    count = int(stats["count"][code])
+    if not count:
+        return None
+    if function == "count":
+        return count
+    if function == "avg":
+        return float(stats["sum"][code] / count)
+    return float(stats[function][code])
+
+
+_TOKEN = re.compile(r"""
+    \s*(?:
+        (?P<string>'(?:[^']|'')*')
+      | (?P<date>\d{4}-\d{2}-\d{2}(?:T[\d:.]+(?:Z|[+-]\d{2}:\d{2})?)?)
+      | (?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+      | (?P<name>[A-Za-z_][\w.]*)
+      | (?P<punct>[(),])
+    )""", re.VERBOSE)
+
+_LITERALS = {"null": None, "true": True, "false": False}
+
+
+class _FilterCompiler():
+    """
+    The subset of OData ``$filter`` the analytics queries use: ``eq``,
+    ``ne``, ``gt``, ``ge``, ``lt`` and ``le`` against a literal, ``and``,
+    ``or``, ``not``, parentheses and ``search.in(field, 'a,b')``.
+    """
+
+    def __init__(self, columns: ClaimsColumns, filter_str: str):
+        self.columns = columns
+        self.filter_str = filter_str
+        self.tokens = self._tokenize(filter_str)
+        self.position = 0
+
+    def _tokenize(self, filter_str: str) -> List[Tuple[str, Any]]:
+        tokens, position = [], 0
+        while position < len(filter_str):
+            if not filter_str[position:].strip():
+                break
+            match = _TOKEN.match(filter_str, position)
+            if not match or match.end() == position:
+                raise ValueError(f"Invalid filter near: {filter_str[position:position + 20]!r}")
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind == "string":
+                value = value[1:-1].replace("''", "'")
+            elif kind == "number":
+                value = float(value)
+            tokens.append((kind, value))
+            position = match.end()
+        return tokens
+
+    def _peek(self) -> Tuple[Optional[str], Any]:
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def _next(self, *kinds: str) -> Any:
+        kind, value = self._peek()
+        if kind is None or (kinds and kind not in kinds):
+            raise ValueError(f"Invalid filter: {self.filter_str}")
+        self.position += 1
+        return value
+
+    def _accept(self, kind: str, value: Any) -> bool:
+        if self._peek() == (kind, value):
+            self.position += 1
+            return True
+        return False
+
+    def _expect(self, punctuation: str):
+        if not self._accept("punct", punctuation):
+            raise ValueError(f"Invalid filter: {self.filter_str}")
+
+    def compile(self) -> np.ndarray:
+        mask = self._or()
+        if self.position != len(self.tokens):
+            raise ValueError(f"Invalid filter: {self.filter_str}")
+        return mask
+
+    def _or(self) -> np.ndarray:
+        mask = self._and()
+        while self._accept("name", "or"):
+            mask = mask | self._and()
+        return mask
+
+    def _and(self) -> np.ndarray:
+        mask = self._unary()
+        while self._accept("name", "and"):
+            mask = mask & self._unary()
+        return mask
+
+    def _unary(self) -> np.ndarray:
+        if self._accept("name", "not"):
+            return ~self._unary()
+        if self._accept("punct", "("):
+            mask = self._or()
+            self._expect(")")
+            return mask
+        field = self._next("name")
+        if field == "search.in":
+            return self._search_in()
+        operation = self._next("name")
+        if operation not in COMPARISONS:
+            raise ValueError(f"Unsupported filter operator: {operation}")
+        return self._compare(field, operation, self._literal())
+
+    def _literal(self) -> Any:
+        kind, value = self._peek()
+        if kind == "name" and value in _LITERALS:
+            self.position += 1
+            return _LITERALS[value]
+        return self._next("string", "number", "date")
+
+    def _search_in(self) -> np.ndarray:
+        self._expect("(")
+        field = self._next("name")
+        self._expect(",")
+        values = self._next("string")
+        delimiters = " ,"
+        if self._accept("punct", ","):
+            delimiters = self._next("string")
+        self._expect(")")
+        values = [value for value in re.split("[" + re.escape(delimiters) + "]", values) if value]
+        mask = np.zeros(self.columns.size, dtype=bool)
+        for value in values:
+            mask |= self._compare(field, "eq", value)
+        return mask
+
+    def _compare(self, field: str, operation: str, value: Any) -> np.ndarray:
+        columns = self.columns
+        compare = COMPARISONS[operation]
+        if field in columns.numeric:
+            column = columns.numeric[field]
+            if value is None:
+                return self._null(np.isnan(column), operation)
+            return compare(column, _float(value))
+        if field in columns.dates:
+            column = columns.dates[field]
+            if value is None:
+                return self._null(np.isnat(column), operation)
+            return compare(column, parse_date(value))
+        if field in columns.categorical:
+            codes, categories = columns.categorical[field]
+            if value is None:
+                return self._null(codes == MISSING, operation)
+            try:
+                ## evaluate on the dictionary once; the extra last entry is what MISSING (-1) picks up
+                matches = [bool(compare(category, value)) for category in categories] + [operation == "ne"]
+            except TypeError:
+                raise ValueError(f"Can't compare {field} with {value!r}")
+            return np.array(matches, dtype=bool)[codes]
+        raise ValueError(f"Unknown or unsupported filter field: {field}")
+
+    def _null(self, missing: np.ndarray, operation: str) -> np.ndarray:
+        if operation == "eq":
+            return missing
+        if operation == "ne":
+            return ~missing
+        raise ValueError(f"Can't use {operation} with null")
+
+
+class ClaimsStore():
+    """
+    The claims columns this worker answers analytics from.
+
+    ``refresh`` builds a complete new ``ClaimsColumns`` to one side, from
+    the search index or from the snapshot file, and then swaps the
+    ``columns`` reference, so a query always reads one whole version and
+    never waits on a load. Each index load is saved to the snapshot so the
+    next worker can start from it; a snapshot directory is then mapped
+    back, so the workers of a host share one copy of the columns.
+    """
+
+    def __init__(self, snapshot_path: Optional[str] = None, endpoint: Optional[str] = None, key: Optional[str] = None,
+                 index_name: Optional[str] = None, timeout: float = None, gateway: SearchGateway = None,
+                 scanner: Optional[ChunkedScanner] = None):
+        self.snapshot_path = snapshot_path
+        self.scanner = scanner
+        self.endpoint = endpoint
+        self.key = key
+        self.index_name = index_name
+        self.timeout = timeout
+        self.gateway = gateway or search_gateway
+        self._columns: Optional[ClaimsColumns] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def columns(self) -> Optional[ClaimsColumns]:
+        return self._columns
+
+    @property
+    def has_index(self) -> bool:
+        return bool(self.endpoint and self.index_name)
+
+    @property
+    def has_snapshot(self) -> bool:
+        return bool(self.snapshot_path and os.path.exists(self.snapshot_path))
+
+    async def load_from_index(self) -> ClaimsColumns:
+        builder = ColumnsBuilder()
+        search = functools.partial(
+            self.gateway.search, self.endpoint, self.key, self.index_name, timeout=self.timeout, search_text="*"
+        )
+        async for page in keyset_pages(search, None, list(CLAIM_FIELDS)):
+            builder.add_page(page)
+        return await asyncio.to_thread(builder.build, f"index {self.index_name}")
+
+    async def refresh(self, source: str = None) -> ClaimsColumns:
+        """
+        Load a new version from ``source`` ("index" or "snapshot"); by
+        default the index when one is configured. A first load that can't
+        read the index falls back to the snapshot.
+        """
+        source = source or ("index" if self.has_index else "snapshot")
+        async with self._lock:
+            if source == "index":
+                try:
+                    columns = await self.load_from_index()
+                except Exception:
+                    if self._columns is not None or not self.has_snapshot:
+                        raise
+                    logger.exception(f"Loading claims from index {self.index_name} failed, using the snapshot")
+                    source = "snapshot"
+                else:
+                    if self.snapshot_path:
+                        await asyncio.to_thread(columns.save, self.snapshot_path)
+                        if os.path.isdir(self.snapshot_path):
+                            columns = await asyncio.to_thread(ClaimsColumns.load, self.snapshot_path)
+
+            if source == "snapshot":
+                if not self.has_snapshot:
+                    raise ValueError(f"No claims index configured and no snapshot at {self.snapshot_path}")
+                columns = await asyncio.to_thread(ClaimsColumns.load, self.snapshot_path)
+
+            columns.scanner = self.scanner
+            if self._columns is None or columns.version != self._columns.version:
+                logger.info(f"Claims store loaded {columns.size} claims from {columns.source}, version {columns.version}")
+            self._columns = columns
+            return columns
+
+    async def run_forever(self, interval: float, refresh_first: bool = False):
+        ## interval 0 refreshes once (when refresh_first) and stops
+        delay = 0 if refresh_first else interval
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Claims store refresh failed, still serving the previous version")
+            if not interval:
+                return
+            delay = interval
+
+    def close(self):
+        if self.scanner is not None:
+            self.scanner.close()
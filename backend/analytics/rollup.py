@@ -0,0 +1,404 @@
+import os
+import re
+import gzip
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from itertools import combinations
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from backend.analytics.columnar import NUMERIC_FIELDS
+from backend.search.aggregation import with_error_bound
+from backend.search.groupby import MetricAccumulator, metric_name, sort_rows
+from backend.search.sketches import (
+    DISTINCT_FUNCTION,
+    QUANTILE_FUNCTIONS,
+    SKETCH_FUNCTIONS,
+    DistinctSketch,
+    QuantileSketch,
+    error_bound,
+)
+
+logger = logging.getLogger(__name__)
+
+## the dimensions dashboards group and filter claims by, and the month of
+## serviceStartDate ("2024-03"), which only the rollup knows
+SERVICE_MONTH = "serviceMonth"
+ROLLUP_DIMENSIONS = ("patientState", "providerName", "insuranceCompany", "procedureCode", "placeOfService", SERVICE_MONTH)
+ROLLUP_MEASURES = NUMERIC_FIELDS
+## counted distinct per cell, "how many patients per provider"
+ROLLUP_DISTINCT_FIELDS = ("patientName",)
+EXACT_FUNCTIONS = ("count", "sum", "avg", "min", "max")
+ROLLUP_FORMAT = 2
+## the grand total, each dimension, and each pair of dimensions
+CUBOIDS = [()] + [(dimension,) for dimension in ROLLUP_DIMENSIONS] + list(combinations(ROLLUP_DIMENSIONS, 2))
+
+MONTH_REGEX = re.compile(r"^\d{4}-\d{2}")
+EQUALITY_REGEX = re.compile(r"\s*([A-Za-z_]\w*)\s+eq\s+'((?:[^']|'')*)'\s*")
+AND_REGEX = re.compile(r"and\s", re.I)
+
+
+def dimension_value(document: dict, dimension: str) -> Optional[str]:
+    if dimension == SERVICE_MONTH:
+        month = MONTH_REGEX.match(str(document.get("serviceStartDate") or ""))
+        return month.group(0) if month else None
+    value = document.get(dimension)
+    return None if value is None else str(value)
+
+
+def equalities(filter_str: Optional[str]) -> Optional[Dict[str, str]]:
+    """
+    ``{field: value}`` for a filter that is only ``field eq 'value'``
+    conditions joined by ``and``, None for any other filter.
+    """
+    found: Dict[str, str] = {}
+    if not filter_str:
+        return found
+    position = 0
+    while True:
+        match = EQUALITY_REGEX.match(filter_str, position)
+        if not match:
+            return None
+        field, value = match.group(1), match.group(2).replace("''", "'")
+        if found.get(field, value) != value:
+            return None
+        found[field] = value
+        position = match.end()
+        if position == len(filter_str):
+            return found
+        joined = AND_REGEX.match(filter_str, position)
+        if not joined:
+            return None
+        position = joined.end()
+
+
+def answerable(metrics: Iterable[Tuple[str, str]], sketched: bool) -> bool:
+    """Whether cells (with sketches or not) hold every (field, function) metric."""
+    for field, function in metrics:
+        if function in EXACT_FUNCTIONS and field in ROLLUP_MEASURES:
+            continue
+        if sketched and ((function in QUANTILE_FUNCTIONS and field in ROLLUP_MEASURES)
+                         or (function == DISTINCT_FUNCTION and field in ROLLUP_DISTINCT_FIELDS)):
+            continue
+        return False
+    return True
+
+
+class _Cell():
+    """
+    One cell's claim count and a ``MetricAccumulator`` per measure; a
+    ``sketched`` cell also keeps quantile and distinct sketches.
+    """
+    __slots__ = ("count", "measures", "sketched")
+
+    def __init__(self, sketched: bool = False):
+        self.count = 0
+        self.sketched = sketched
+        self.measures = {measure: MetricAccumulator(quantiles=sketched) for measure in ROLLUP_MEASURES}
+        if sketched:
+            self.measures.update({field: MetricAccumulator(distinct=True) for field in ROLLUP_DISTINCT_FIELDS})
+
+    def dump(self) -> list:
+        values = [self.count]
+        for measure in ROLLUP_MEASURES:
+            accumulator = self.measures[measure]
+            values += [accumulator.count, accumulator.sum, accumulator.min, accumulator.max]
+        if self.sketched:
+            sketches = {measure: self.measures[measure].quantiles.to_dict() for measure in ROLLUP_MEASURES}
+            sketches.update({field: self.measures[field].distinct.to_dict() for field in ROLLUP_DISTINCT_FIELDS})
+            values.append(sketches)
+        return values
+
+    @classmethod
+    def load(cls, values: list) -> "_Cell":
+        sketched = len(values) > 1 + 4 * len(ROLLUP_MEASURES)
+        cell = cls()
+        cell.count = values[0]
+        cell.sketched = sketched
+        for index, measure in enumerate(ROLLUP_MEASURES):
+            accumulator = cell.measures[measure]
+            accumulator.count, accumulator.sum, accumulator.min, accumulator.max = values[1 + 4 * index:5 + 4 * index]
+        if sketched:
+            sketches = values[-1]
+            for measure in ROLLUP_MEASURES:
+                cell.measures[measure].quantiles = QuantileSketch.from_dict(sketches[measure])
+            for field in ROLLUP_DISTINCT_FIELDS:
+                cell.measures[field] = MetricAccumulator()
+                cell.measures[field].distinct = DistinctSketch.from_dict(sketches[field])
+        return cell
+
+
+class RollupBuilder():
+    """
+    Count, sum, min and max of every measure per value of each rollup
+    dimension and per pair of values of two dimensions, accumulated one
+    claim document at a time. The total and the single dimension cells
+    also keep quantile sketches of the measures and a distinct sketch of
+    each ``ROLLUP_DISTINCT_FIELDS`` field; pair cells don't, to keep the
+    artifact small.
+    """
+
+    def __init__(self):
+        self.cuboids: Dict[Tuple[str, ...], Dict[Tuple[str, ...], _Cell]] = {cuboid: {} for cuboid in CUBOIDS}
+        self.documents = 0
+
+    def add(self, document: dict):
+        self.documents += 1
+        values = {dimension: dimension_value(document, dimension) for dimension in ROLLUP_DIMENSIONS}
+        measures = []
+        for measure in ROLLUP_MEASURES:
+            try:
+                value = document.get(measure)
+                measures.append((measure, None if value is None else float(value)))
+            except (ValueError, TypeError):
+                measures.append((measure, None))
+
+        for cuboid, cells in self.cuboids.items():
+            key = tuple(values[dimension] for dimension in cuboid)
+            ## a claim without a dimension's value isn't in that dimension's groups, as in a group-by
+            if None in key:
+                continue
+            cell = cells.get(key)
+            if cell is None:
+                cell = cells[key] = _Cell(sketched=len(cuboid) <= 1)
+            cell.count += 1
+            for measure, value in measures:
+                if value is not None:
+                    cell.measures[measure].add(value)
+            if cell.sketched:
+                for field in ROLLUP_DISTINCT_FIELDS:
+                    if document.get(field) is not None:
+                        cell.measures[field].distinct.add(document[field])
+
+    def add_documents(self, documents: Iterable[dict]):
+        for document in documents:
+            self.add(document)
+
+    def build(self, source: str) -> "RollupCube":
+        return RollupCube(self.cuboids, self.documents, source)
+
+
+class RollupCube():
+    """
+    The rollup computed by scripts/indexdata.py when it prepares the claims.
+
+    Answers a group-by on a rollup dimension filtered by at most one
+    ``eq`` condition on another, and an aggregation of a measure filtered
+    by ``eq`` conditions on up to two dimensions, without reading a claim.
+    Percentiles and distinct counts come from the cells' sketches, so only
+    for an unfiltered group-by or an aggregation with one condition. Any
+    other query gets None, for the next engine to answer.
+    """
+
+    def __init__(self, cuboids: Dict[Tuple[str, ...], Dict[Tuple[str, ...], _Cell]], documents: int, source: str,
+                 built_at: float = None, version: str = None):
+        self.cuboids = cuboids
+        self.documents = documents
+        self.source = source
+        self.built_at = built_at or time.time()
+        self.version = version or self.fingerprint()
+
+    def _payload(self) -> dict:
+        return {
+            "format": ROLLUP_FORMAT,
+            "source": self.source,
+            "built_at": self.built_at,
+            "documents": self.documents,
+            "dimensions": list(ROLLUP_DIMENSIONS),
+            "measures": list(ROLLUP_MEASURES),
+            "distinct_fields": list(ROLLUP_DISTINCT_FIELDS),
+            "cuboids": {
+                "|".join(cuboid): [list(key) + cell.dump() for key, cell in sorted(cells.items())]
+                for cuboid, cells in self.cuboids.items()
+            },
+        }
+
+    def fingerprint(self) -> str:
+        payload = self._payload()
+        payload.pop("built_at")
+        payload.pop("source")
+        return hashlib.blake2b(json.dumps(payload, sort_keys=True).encode(), digest_size=8).hexdigest()
+
+    def describe(self) -> dict:
+        return {
+            "source": self.source,
+            "version": self.version,
+            "documents": self.documents,
+            "built_at": self.built_at,
+            "cells": sum(len(cells) for cells in self.cuboids.values()),
+        }
+
+    def save(self, path: str):
+        """Write the rollup as gzipped JSON, replacing ``path`` atomically."""
+        payload = self._payload()
+        payload["version"] = self.version
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with gzip.open(temp_path, "wt", encoding="utf-8") as f:
+                json.dump(payload, f, separators=(",", ":"))
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    @classmethod
+    def load(cls, path: str) -> "RollupCube":
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            payload = json.load(f)
+        if payload.get("format") != ROLLUP_FORMAT:
+            raise ValueError(f"Unsupported rollup format {payload.get('format')} in {path}")
+        if (tuple(payload["dimensions"]) != ROLLUP_DIMENSIONS or tuple(payload["measures"]) != ROLLUP_MEASURES
+                or tuple(payload["distinct_fields"]) != ROLLUP_DISTINCT_FIELDS):
+            raise ValueError(f"Rollup {path} was built for other dimensions or measures, rebuild it with scripts/indexdata.py")
+        cuboids = {}
+        for name, rows in payload["cuboids"].items():
+            cuboid = tuple(name.split("|")) if name else ()
+            cuboids[cuboid] = {tuple(row[:len(cuboid)]): _Cell.load(row[len(cuboid):]) for row in rows}
+        return cls(cuboids, payload["documents"], f"rollup {path} ({payload['source']})",
+                   built_at=payload["built_at"], version=payload["version"])
+
+    def _cells(self, dimensions: Iterable[str]) -> Optional[Tuple[Tuple[str, ...], Dict[Tuple[str, ...], _Cell]]]:
+        ## the cuboid holding exactly these dimensions, in CUBOIDS order
+        dimensions = set(dimensions)
+        if not dimensions <= set(ROLLUP_DIMENSIONS) or len(dimensions) > 2:
+            return None
+        cuboid = tuple(dimension for dimension in ROLLUP_DIMENSIONS if dimension in dimensions)
+        return cuboid, self.cuboids[cuboid]
+
+    def _total(self, conditions: Dict[str, str]) -> Optional[_Cell]:
+        found = self._cells(conditions)
+        if found is None:
+            return None
+        cuboid, cells = found
+        return cells.get(tuple(conditions[dimension] for dimension in cuboid)) or _Cell(sketched=len(cuboid) <= 1)
+
+    def group_by(self, group_by_field: str, metrics: Iterable[Tuple[str, str]] = (), filter_str: Optional[str] = None,
+                 sort_by: Optional[str] = None, order: str = "desc", top: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """Same result shape as ``ClaimsColumns.group_by``, or None."""
+        metrics = [(field, function) for field, function in metrics]
+        conditions = equalities(filter_str)
+        if conditions is None or len(conditions) > 1:
+            return None
+        found = self._cells({group_by_field, *conditions})
+        total = self._total(conditions)
+        if found is None or total is None:
+            return None
+        cuboid, cells = found
+        if not answerable(metrics, sketched=len(cuboid) <= 1):
+            return None
+
+        group_at = cuboid.index(group_by_field)
+        condition_at = {cuboid.index(field): value for field, value in conditions.items()}
+        rows = []
+        for key, cell in cells.items():
+            if any(key[index] != value for index, value in condition_at.items()):
+                continue
+            rows.append({
+                "group": key[group_at],
+                "count": cell.count,
+                "metrics": {
+                    metric_name(field, function): cell.measures[field].result(function) for field, function in metrics
+                },
+            })
+        return {
+            "results": sort_rows(rows, sort_by, order, top),
+            "total_groups": len(rows),
+            "total_documents": total.count,
+            "strategy": "rollup",
+            "exact": True,
+            "error_bounds": {
+                metric_name(field, function): error_bound(function)
+                for field, function in metrics if function in SKETCH_FUNCTIONS
+            },
+        }
+
+    def aggregate(self, field: str, aggregation_type: str, filter_str: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Same result shape as ``ClaimsColumns.aggregate``, or None."""
+        conditions = equalities(filter_str)
+        if conditions is None:
+            return None
+        if answerable([(field, aggregation_type)], sketched=len(conditions) <= 1):
+            cell = self._total(conditions)
+            if cell is None:
+                return None
+            accumulator = cell.measures[field]
+            ## a distinct count is over the cell's claims, the others over the measure's values
+            count = cell.count if aggregation_type == DISTINCT_FUNCTION else accumulator.count
+            result = accumulator.result(aggregation_type)
+        elif aggregation_type == "count" and field in ROLLUP_DIMENSIONS:
+            ## claims with a value for the field
+            found = self._cells({field, *conditions})
+            if found is None:
+                return None
+            cuboid, cells = found
+            condition_at = {cuboid.index(name): value for name, value in conditions.items()}
+            result = count = sum(
+                cell.count for key, cell in cells.items()
+                if all(key[index] == value for index, value in condition_at.items())
+            )
+        else:
+            return None
+
+        if not count:
+            return {"error": f"No numeric values found for field '{field}'"}
+        return with_error_bound({
+            "result": result,
+            "count": count,
+            "aggregation_type": aggregation_type,
+            "field": field,
+            "strategy": "rollup",
+            "exact": True,
+        })
+
+
+class RollupStore():
+    """
+    The rollup artifact at ``path``, reloaded when the file changes; its
+    modification time is checked at most every ``interval`` seconds.
+    """
+
+    def __init__(self, path: str, interval: float = 60.0):
+        self.path = path
+        self.interval = interval
+        self._cube: Optional[RollupCube] = None
+        self._mtime: Optional[float] = None
+        self._checked = 0.0
+        self._lock = asyncio.Lock()
+
+    @property
+    def cube(self) -> Optional[RollupCube]:
+        return self._cube
+
+    def _due(self) -> bool:
+        return not self._checked or time.monotonic() >= self._checked + self.interval
+
+    async def current(self) -> Optional[RollupCube]:
+        if self._due():
+            async with self._lock:
+                if self._due():
+                    await self.reload()
+        return self._cube
+
+    async def reload(self) -> Optional[RollupCube]:
+        self._checked = time.monotonic()
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            if self._cube is not None:
+                logger.warning(f"Rollup {self.path} is gone, no longer answering from it")
+            self._cube, self._mtime = None, None
+            return None
+        if mtime == self._mtime:
+            return self._cube
+        try:
+            cube = await asyncio.to_thread(RollupCube.load, self.path)
+        except Exception:
+            logger.exception(f"Loading rollup {self.path} failed, still serving the previous version")
+            return self._cube
+        logger.info(f"Rollup loaded from {self.path}: {cube.documents} claims, version {cube.version}")
+        self._cube, self._mtime = cube, mtime
+        return cube
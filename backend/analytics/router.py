@@ -0,0 +1,283 @@
+import re
+import logging
+from typing import Any, Dict, List, Optional
+
+from backend.analytics.service import (
+    AggregationParams,
+    AnalyticsParams,
+    AnalyticsRequestError,
+    AnalyticsService,
+    AnalyticsUnavailableError,
+)
+from backend.search.gateway import SearchTimeoutError
+
+logger = logging.getLogger(__name__)
+
+## ported from frontend/src/utils/analyticsUtils.ts and searchUtils.ts, with word
+## boundaries so "address" isn't a sum and "administration" isn't a minimum
+STATE_ANALYTICS_REGEX = re.compile(r"\b(which state|state with|by state|states with|states that)\b", re.I)
+PROVIDER_ANALYTICS_REGEX = re.compile(r"\b(which provider|provider with|by provider|providers with|providers that)\b", re.I)
+INSURANCE_ANALYTICS_REGEX = re.compile(r"\b(which insurance|insurance with|by insurance|insurances with|insurance companies)\b", re.I)
+
+MOST_REGEX = re.compile(r"\b(most|highest|largest|greatest|maximum)\b", re.I)
+LEAST_REGEX = re.compile(r"\b(least|lowest|smallest|minimum|fewest)\b", re.I)
+AVERAGE_REGEX = re.compile(r"\b(average|avg|mean)\b", re.I)
+TOTAL_REGEX = re.compile(r"\b(total|sum|add up)\b", re.I)
+MIN_REGEX = re.compile(r"\b(min|minimum|lowest|smallest)\b", re.I)
+MAX_REGEX = re.compile(r"\b(max|maximum|highest|largest)\b", re.I)
+COUNT_REGEX = re.compile(r"\b(number of|count of|count|how many)\b", re.I)
+
+## the first field named wins, then the looser synonyms, then claimAmount
+FIELD_REGEXES = (
+    ("claimAmount", re.compile(r"\bclaim amounts?\b", re.I)),
+    ("lineItemCharge", re.compile(r"\bline item charges?\b", re.I)),
+    ("amountPaid", re.compile(r"\bamounts? paid\b", re.I)),
+    ("balanceDue", re.compile(r"\bbalances? due\b", re.I)),
+    ("claimAmount", re.compile(r"\bclaims?\b", re.I)),
+    ("lineItemCharge", re.compile(r"\b(charges?|line items?)\b", re.I)),
+    ("amountPaid", re.compile(r"\b(paid|payments?)\b", re.I)),
+    ("balanceDue", re.compile(r"\b(due|balances?|owed)\b", re.I)),
+)
+AMOUNT_REGEX = re.compile(r"\b(amounts?|charges?|paid|payments?|balances?|due|owed|dollars?|spend|spent|cost)\b", re.I)
+TOP_REGEX = re.compile(r"\btop (\d{1,3})\b", re.I)
+
+## a routed question may only contain these words besides the ones the regexes matched;
+## anything else (a state name, "denied", a date) is a condition the computed answer wouldn't honour
+ROUTABLE_WORDS = frozenset("""
+    a all amount amounts an and any are across at average avg balance balances based be by calculate can charge charges
+    claim claims companies company count data dataset do does dollars due each fewest find for from get give greatest
+    has have highest how i in insurance insurances insurer insurers is it item largest least line list lowest many max
+    maximum me mean min minimum most number of on our out overall owed paid payer payers payment payments per please
+    provider providers show smallest spend spent state states sum tell than that the their there this to top total up
+    value values was we were what which who whose with you add cost s
+""".split())
+## these ask for more than the number; the model writes the answer from the computed table
+EXPLANATION_WORDS = frozenset("""
+    analyze analyse analysis breakdown compare comparison describe explain insight insights interpret recommend
+    recommendations suggest summarize summarise summary trend trends why
+""".split())
+
+FUNCTION_NAMES = {"avg": "average", "sum": "total", "min": "minimum", "max": "maximum"}
+
+
+def readable(field: str) -> str:
+    return re.sub(r"([A-Z])", r" \1", field).lower().strip()
+
+
+def detect_analytics_query(text: str) -> Optional[AnalyticsParams]:
+    if STATE_ANALYTICS_REGEX.search(text):
+        group_by_field = "patientState"
+    elif PROVIDER_ANALYTICS_REGEX.search(text):
+        group_by_field = "providerName"
+    elif INSURANCE_ANALYTICS_REGEX.search(text):
+        group_by_field = "insuranceCompany"
+    else:
+        return None
+
+    metric_function, metric_field = "count", None
+    if (MOST_REGEX.search(text) or LEAST_REGEX.search(text)) and not COUNT_REGEX.search(text):
+        if AVERAGE_REGEX.search(text):
+            metric_function = "avg"
+        elif TOTAL_REGEX.search(text):
+            metric_function = "sum"
+        if metric_function != "count":
+            metric_field = detect_field(text)
+
+    top = TOP_REGEX.search(text)
+    return AnalyticsParams(
+        group_by_field=group_by_field,
+        metric_function=metric_function,
+        metric_field=metric_field,
+        order="asc" if LEAST_REGEX.search(text) else "desc",
+        top_results=min(int(top.group(1)), 100) if top and int(top.group(1)) else 10,
+    )
+
+
+def detect_aggregation_query(text: str) -> Optional[AggregationParams]:
+    for aggregation_type, regex in (
+        ("avg", AVERAGE_REGEX), ("sum", TOTAL_REGEX), ("min", MIN_REGEX), ("max", MAX_REGEX), ("count", COUNT_REGEX),
+    ):
+        if regex.search(text):
+            break
+    else:
+        return None
+    ## "how many claims" counts claims; the other aggregations need an amount to aggregate
+    if aggregation_type != "count" and not AMOUNT_REGEX.search(text):
+        return None
+    return AggregationParams(field=detect_field(text), aggregation_type=aggregation_type)
+
+
+def detect_field(text: str) -> str:
+    for field, regex in FIELD_REGEXES:
+        if regex.search(text):
+            return field
+    return "claimAmount"
+
+
+class RoutedQuery():
+    __slots__ = ("route", "params", "direct")
+
+    def __init__(self, route: str, params: Any, direct: bool):
+        self.route = route
+        self.params = params
+        self.direct = direct
+
+
+def classify(text: str) -> Optional[RoutedQuery]:
+    """
+    The analytics query a chat message asks, or None when the model should
+    answer it. ``direct`` is False when the message also asks for an
+    explanation.
+    """
+    if not text or len(text) > 500:
+        return None
+    words = re.findall(r"[a-z0-9]+", text.lower())
+    ## the n of "top n" is the only number a routed question may hold; a year, an amount or an id is a condition
+    leftover = {
+        word for previous, word in zip([None] + words, words)
+        if word not in ROUTABLE_WORDS and not (word.isdigit() and previous == "top")
+    }
+    explain = leftover & EXPLANATION_WORDS
+    if leftover - EXPLANATION_WORDS:
+        return None
+
+    params = detect_analytics_query(text)
+    if params is not None:
+        return RoutedQuery("analytics", params, not explain)
+    params = detect_aggregation_query(text)
+    if params is not None:
+        return RoutedQuery("aggregation", params, not explain)
+    return None
+
+
+def format_money(value: Any) -> str:
+    return f"${value:,.2f}" if isinstance(value, (int, float)) else str(value)
+
+
+def format_analytics_answer(result: Dict[str, Any]) -> str:
+    ## as formatAnalyticsResult in frontend/src/utils/analyticsUtils.ts
+    results = result["results"]
+    group_name = readable(result["group_by_field"])
+    fewest = result.get("order") == "asc"
+    if result["metric_function"] == "count" or not result.get("metric_field"):
+        top = results[0]
+        answer = f"The {group_name} with the {'fewest' if fewest else 'most'} claims is {top['group']} with {top['count']} claims."
+        lines = [f"{index}. {row['group']}: {row['count']} claims" for index, row in enumerate(results, 1)]
+    else:
+        metric_name = f"{FUNCTION_NAMES.get(result['metric_function'], result['metric_function'])} {readable(result['metric_field'])}"
+        top = results[0]
+        answer = f"The {group_name} with the {'lowest' if fewest else 'highest'} {metric_name} is {top['group']} with {format_money(top.get('metric'))}."
+        lines = [f"{index}. {row['group']}: {format_money(row.get('metric'))}" for index, row in enumerate(results, 1)]
+    if len(results) > 1:
+        answer += "\n\nHere is the breakdown of the top results:\n" + "\n".join(lines)
+    return answer
+
+
+def format_aggregation_answer(result: Dict[str, Any]) -> str:
+    ## as formatAggregationResult in frontend/src/utils/searchUtils.ts
+    field_name, value, count = readable(result["field"]), format_money(result["result"]), result["count"]
+    aggregation_type = result["aggregation_type"]
+    if aggregation_type == "avg":
+        return f"The average {field_name} is {value}, based on {count} records."
+    if aggregation_type == "sum":
+        return f"The total {field_name} is {value}, summed across {count} records."
+    if aggregation_type in ("min", "max"):
+        return f"The {FUNCTION_NAMES[aggregation_type]} {field_name} is {value}, from {count} records analyzed."
+    return f"There are {count} records with {field_name} values."
+
+
+def result_table(route: str, result: Dict[str, Any]) -> str:
+    ## CSV, the format the system prompt's dataset is in
+    if route == "aggregation":
+        return f"field,aggregation,value,records\n{result['field']},{result['aggregation_type']},{result['result']},{result['count']}"
+    metrics = result.get("metrics") or []
+    lines = [",".join([result["group_by_field"], "claims"] + metrics)]
+    for row in result["results"]:
+        values = [row["group"], row["count"]] + [row["metrics"].get(metric) for metric in metrics]
+        lines.append(",".join("" if value is None else str(value).replace(",", " ") for value in values))
+    return "\n".join(lines)
+
+
+REFERENCE_DATA_REGEX = re.compile(r"^# Reference Data.*?```csv\n.*?```", re.S | re.M)
+
+
+def compact_system_message(system_message: str, table: str, total_documents: Optional[int]) -> str:
+    """
+    The system message with its CSV dataset swapped for the computed
+    result, so the model reads a few rows instead of every claim.
+    """
+    scope = f"all {total_documents} claims" if total_documents else "the complete claims dataset"
+    section = (
+        f"# Computed Result (exact, over {scope})\n"
+        "The backend computed this from the complete claims dataset. Base your answer on it; "
+        "do not recompute it or estimate other figures:\n\n"
+        f"```csv\n{table}\n```"
+    )
+    return replace_reference_data(system_message, section)
+
+
+def replace_reference_data(system_message: str, section: str) -> str:
+    ## the "# Reference Data" section and its csv block, see terraform/system-prompt.tpl
+    replaced, count = REFERENCE_DATA_REGEX.subn(lambda _: section, system_message or "", count=1)
+    return replaced if count else f"{system_message or ''}\n\n{section}".strip()
+
+
+class RoutedAnswer():
+    __slots__ = ("route", "direct", "result", "text", "table")
+
+    def __init__(self, route: str, direct: bool, result: Dict[str, Any], text: str, table: str):
+        self.route = route
+        self.direct = direct
+        self.result = result
+        self.text = text
+        self.table = table
+
+
+class QueryRouter():
+    """
+    Answers the analytics questions a chat message asks before it reaches
+    the model: the exact figure is computed by ``AnalyticsService`` and
+    either returned as the reply or handed to the model as a small table in
+    place of the dataset.
+    """
+
+    def __init__(self, service: AnalyticsService, direct_answers: bool = False):
+        self.service = service
+        self.direct_answers = direct_answers
+        self.counts = {"direct": 0, "context": 0, "passed": 0, "failed": 0}
+
+    async def route(self, messages: List[dict], security_filter: Optional[str] = None) -> Optional[RoutedAnswer]:
+        text = next(
+            (message.get("content") for message in reversed(messages)
+             if isinstance(message, dict) and message.get("role") == "user"),
+            None,
+        )
+        routed = classify(text) if isinstance(text, str) else None
+        if routed is None:
+            self.counts["passed"] += 1
+            return None
+
+        try:
+            result, _ = await self.service.answer(routed.route, routed.params.restricted_to(security_filter))
+        except (AnalyticsRequestError, AnalyticsUnavailableError, SearchTimeoutError) as e:
+            logger.info(f"Analytics router couldn't answer locally, passing to the model: {e}")
+            self.counts["failed"] += 1
+            return None
+        except Exception:
+            logger.exception("Analytics router failed, passing to the model")
+            self.counts["failed"] += 1
+            return None
+        if "error" in result or (routed.route == "analytics" and not result.get("results")):
+            self.counts["passed"] += 1
+            return None
+
+        direct = routed.direct and self.direct_answers
+        if routed.route == "analytics":
+            text = format_analytics_answer({**result, "order": routed.params.order})
+        else:
+            text = format_aggregation_answer(result)
+        self.counts["direct" if direct else "context"] += 1
+        return RoutedAnswer(routed.route, direct, result, text, result_table(routed.route, result))
+
+    def stats(self) -> dict:
+        return dict(self.counts)
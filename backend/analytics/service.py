@@ -0,0 +1,577 @@
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Dict, List, Literal, Optional, Tuple
+
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, ValidationError, conint, constr, field_validator, model_validator
+
+from backend.analytics.columnar import CLAIM_FIELDS, ClaimsColumns, ClaimsStore
+from backend.analytics.rollup import RollupCube, RollupStore
+from backend.search.gateway import SearchGateway, search_gateway
+from backend.search.groupby import METRIC_FUNCTIONS, metric_name
+from backend.utils import (
+    format_analytics_result,
+    perform_analytics_query,
+    perform_search_aggregation,
+    prefetch,
+    stream_direct_search_query,
+)
+
+logger = logging.getLogger(__name__)
+
+FieldName = constr(pattern=r"^[A-Za-z_][A-Za-z0-9_]*$", max_length=128)
+FieldList = constr(pattern=r"^\s*[A-Za-z_][A-Za-z0-9_]*\s*(,\s*[A-Za-z_][A-Za-z0-9_]*\s*)*$", max_length=2048)
+OrderBy = constr(
+    pattern=r"^\s*[A-Za-z_][A-Za-z0-9_]*(\s+(asc|desc))?\s*(,\s*[A-Za-z_][A-Za-z0-9_]*(\s+(asc|desc))?\s*)*$",
+    max_length=512,
+)
+Filter = constr(max_length=4096)
+MetricFunction = Literal[METRIC_FUNCTIONS]
+MAX_ROWS = 1000
+MAX_METRICS = 10
+## what /direct_search returns without a select: the claims index's fields but the vector, 3072 floats a claim
+DIRECT_SEARCH_SELECT = ",".join(("id", "content", "patientName", "patientAddress", "insuredID") + CLAIM_FIELDS)
+
+## a single-quoted OData literal ('' escapes a quote), or a run of whitespace
+LITERAL_OR_SPACE_REGEX = re.compile(r"('(?:[^']|'')*')|\s+")
+LITERAL_REGEX = re.compile(r"'(?:[^']|'')*'")
+
+## where an answer came from
+ROLLUP = "rollup"
+CLAIMS_STORE = "claims_store"
+INDEX = "index"
+
+
+class AnalyticsRequestError(ValueError):
+    pass
+
+
+class AnalyticsUnavailableError(Exception):
+    pass
+
+
+class AnalyticsAccessError(Exception):
+    pass
+
+
+def check_filter_syntax(filter_str: str):
+    """
+    Rejects a filter with an unterminated string literal or unbalanced
+    parentheses outside its literals: ANDed into the permitted groups
+    filter, such a filter could close the parentheses around it and
+    escape the restriction.
+    """
+    unquoted = LITERAL_REGEX.sub("_", filter_str)
+    if "'" in unquoted:
+        raise ValueError("filter has an unterminated string literal")
+    depth = 0
+    for char in unquoted:
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth < 0:
+                raise ValueError("filter has a ')' without a matching '('")
+    if depth:
+        raise ValueError("filter has a '(' without a matching ')'")
+
+
+class _AnalyticsParams(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
+    query: constr(max_length=1024) = "*"
+    ## the permitted groups filter of document-level security, never read from the request body
+    _security_filter: Optional[str] = PrivateAttr(default=None)
+
+    @field_validator("query")
+    @classmethod
+    def normalize_query(cls, query: str) -> str:
+        ## "" and whitespace mean every document, as "*" does
+        return " ".join(query.split()) or "*"
+
+    @field_validator("filter", check_fields=False)
+    @classmethod
+    def normalize_filter(cls, filter_str: Optional[str]) -> Optional[str]:
+        ## whitespace outside string literals doesn't change a filter, so it doesn't split the cache
+        if filter_str is None:
+            return None
+        check_filter_syntax(filter_str)
+        return LITERAL_OR_SPACE_REGEX.sub(lambda match: match.group(1) or " ", filter_str).strip() or None
+
+    @field_validator("select", "order_by", check_fields=False)
+    @classmethod
+    def normalize_field_list(cls, fields: Optional[str]) -> Optional[str]:
+        if fields is None:
+            return None
+        return ",".join(" ".join(part.split()) for part in fields.split(",")) or None
+
+    @classmethod
+    def parse(cls, body: Any) -> "_AnalyticsParams":
+        if not isinstance(body, dict):
+            raise AnalyticsRequestError("request body must be a JSON object")
+        try:
+            return cls.model_validate(body)
+        except ValidationError as e:
+            raise AnalyticsRequestError("; ".join(
+                f"{'.'.join(str(part) for part in error['loc']) or 'request'}: {error['msg']}" for error in e.errors()
+            ))
+
+    def cache_key(self) -> str:
+        return json.dumps(self.model_dump(), sort_keys=True, default=str)
+
+    def restricted_to(self, security_filter: Optional[str]) -> "_AnalyticsParams":
+        """
+        These params with ``security_filter`` ANDed into the filter. The
+        combined filter keys the cache, so callers with different groups
+        never share an answer.
+        """
+        if not security_filter:
+            return self
+        if self.filter:
+            ## validated when parsed, checked again as a model_copy() skips validation
+            try:
+                check_filter_syntax(self.filter)
+            except ValueError as e:
+                raise AnalyticsRequestError(f"filter: {e}")
+        combined = f"({self.filter}) and ({security_filter})" if self.filter else security_filter
+        params = self.model_copy(update={"filter": combined})
+        params._security_filter = security_filter
+        return params
+
+    @property
+    def restricted(self) -> bool:
+        return self._security_filter is not None
+
+
+class DirectSearchParams(_AnalyticsParams):
+    filter: Optional[Filter] = None
+    top_k: conint(ge=1, le=MAX_ROWS) = 50
+    select: Optional[FieldList] = None
+    order_by: Optional[OrderBy] = None
+
+
+class AggregationParams(_AnalyticsParams):
+    field: FieldName
+    aggregation_type: MetricFunction = "avg"
+    filter: Optional[Filter] = None
+
+
+class MetricParams(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
+    field: FieldName
+    function: MetricFunction
+
+
+class AnalyticsParams(_AnalyticsParams):
+    group_by_field: FieldName
+    metric_field: Optional[FieldName] = None
+    metric_function: MetricFunction = "count"
+    filter: Optional[Filter] = None
+    top_results: conint(ge=1, le=MAX_ROWS) = 10
+    order: Literal["asc", "desc"] = "desc"
+    metrics: List[MetricParams] = Field(default_factory=list, max_length=MAX_METRICS)
+
+    @model_validator(mode="after")
+    def check_metric(self):
+        if self.metric_function != "count" and not self.metric_field:
+            raise ValueError(f"metric_field is required for metric_function '{self.metric_function}'")
+        return self
+
+    @property
+    def all_metrics(self) -> List[Tuple[str, str]]:
+        ## the primary metric first, results are sorted by it
+        metrics = [(metric.field, metric.function) for metric in self.metrics]
+        if self.metric_field and self.metric_function != "count":
+            metrics.insert(0, (self.metric_field, self.metric_function))
+        return metrics
+
+
+class ResultCache():
+    """
+    LRU of recent answers, tagged with the version of the data they were
+    computed from.
+
+    A lookup under a new data version drops every entry at once, so an
+    answer is never served from data that has since changed; until then a
+    repeated query is a dict lookup. Entries are bounded by count and by
+    the approximate size of their JSON, and expire after ``ttl`` seconds
+    when one is set (0 disables the cache).
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.version: Optional[str] = None
+        ## key -> (expires, size, value)
+        self._entries: "OrderedDict[Any, Tuple[Optional[float], int, Any]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def _check_version(self, version: Optional[str]):
+        if version != self.version:
+            if self._entries:
+                self.invalidations += 1
+                logger.info(f"Data version changed from {self.version} to {version}, dropping {len(self._entries)} cached answers")
+            self.clear()
+            self.version = version
+
+    def get(self, key: Any, version: Optional[str] = None) -> Optional[Any]:
+        self._check_version(version)
+        entry = self._entries.get(key)
+        if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def put(self, key: Any, value: Any, version: Optional[str] = None):
+        if not self.max_entries or self.ttl == 0 or version != self.version:
+            ## computed from a version that has been replaced meanwhile
+            return
+        size = len(json.dumps(value, default=str))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl if self.ttl is not None else None, size, value)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: Any):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "version": self.version,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+        }
+
+
+class IndexVersion():
+    """
+    A fingerprint of the search index's contents: the document count, the
+    first and last ids and the claims per insurer, which a reindex or an
+    upload changes. One query reads it, at most every ``interval`` seconds;
+    concurrent callers share that query.
+    """
+
+    def __init__(self, endpoint: str, key: Optional[str], index_name: str, interval: float = 60.0,
+                 timeout: float = None, gateway: SearchGateway = None):
+        self.endpoint = endpoint
+        self.key = key
+        self.index_name = index_name
+        self.interval = interval
+        self.timeout = timeout
+        self.gateway = gateway or search_gateway
+        self.version: Optional[str] = None
+        ## documents in the index when it was last read
+        self.count: Optional[int] = None
+        self._checked = 0.0
+        self._lock = asyncio.Lock()
+
+    def _fresh(self) -> bool:
+        return self.version is not None and time.monotonic() < self._checked + self.interval
+
+    async def current(self) -> Optional[str]:
+        if self._fresh():
+            return self.version
+        async with self._lock:
+            if not self._fresh():
+                try:
+                    self.version = await self.probe()
+                except Exception as e:
+                    ## keep the last version rather than fail or flush the cache on a blip
+                    logger.warning(f"Couldn't read the version of index {self.index_name}: {e}")
+                self._checked = time.monotonic()
+        return self.version
+
+    async def probe(self) -> str:
+        digest = hashlib.blake2b(digest_size=8)
+        for order in ("id asc", "id desc"):
+            results = await self.gateway.search(
+                self.endpoint, self.key, self.index_name, timeout=self.timeout, search_text="*",
+                top=1, order_by=order, select=["id"], include_total_count=order == "id desc",
+                facets=["insuranceCompany,count:1000"] if order == "id desc" else None,
+            )
+            documents = [document async for document in results.documents()]
+            digest.update(json.dumps([document.get("id") for document in documents]).encode())
+        self.count = await results.get_count()
+        digest.update(json.dumps([self.count, await results.get_facets()], sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+
+class LatencyTracker():
+    """Recent latencies per route against that route's SLO."""
+
+    def __init__(self, slo_ms: Dict[str, float], window: int = 1000):
+        self.slo_ms = slo_ms
+        self.window = window
+        self._latencies: Dict[str, deque] = {}
+        self._counts: Dict[str, Dict[str, int]] = {}
+
+    def record(self, route: str, elapsed_ms: float, source: str, cached: bool) -> bool:
+        """Returns whether the request met the route's SLO."""
+        self._latencies.setdefault(route, deque(maxlen=self.window)).append(elapsed_ms)
+        counts = self._counts.setdefault(route, {"requests": 0, "cache_hits": 0, "over_slo": 0})
+        counts["requests"] += 1
+        counts[f"from_{source}"] = counts.get(f"from_{source}", 0) + 1
+        if cached:
+            counts["cache_hits"] += 1
+        slo = self.slo_ms.get(route)
+        if slo is not None and elapsed_ms > slo:
+            counts["over_slo"] += 1
+            return False
+        return True
+
+    def summary(self) -> dict:
+        summary = {}
+        for route, counts in self._counts.items():
+            latencies = sorted(self._latencies[route])
+            summary[route] = {
+                **counts,
+                "slo_ms": self.slo_ms.get(route),
+                "p50_ms": _percentile(latencies, 50),
+                "p95_ms": _percentile(latencies, 95),
+                "p99_ms": _percentile(latencies, 99),
+            }
+        return summary
+
+
+def _percentile(ordered: List[float], percent: float) -> Optional[float]:
+    if not ordered:
+        return None
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))], 3)
+
+
+async def _scan(columns: ClaimsColumns, method, *args, **kwargs) -> Dict[str, Any]:
+    ## scans of chunked columns take long enough to hold up other requests, run them on a thread
+    if columns.chunked:
+        return await asyncio.to_thread(method, *args, **kwargs)
+    return method(*args, **kwargs)
+
+
+class AnalyticsService():
+    """
+    Answers /direct_search, /aggregation and /analytics without the model.
+
+    Aggregations and group-bys over every document come from the rollup
+    built at indexing time when it holds them, else from the in-memory
+    claims columns when they are loaded and cover the fields asked for;
+    full-text queries, fields the columns don't hold and document
+    retrieval go to the search index. Answers are cached, and each
+    request's latency is tracked against its route's SLO.
+    """
+
+    def __init__(self, claims_store: Optional[ClaimsStore], index: Optional[Tuple[str, Optional[str], str]],
+                 cache: ResultCache, latency: LatencyTracker, timeout: float = None,
+                 index_version: Optional[IndexVersion] = None, rollup: Optional[RollupStore] = None,
+                 page_size: int = 100, buffer_pages: int = 2):
+        self.claims_store = claims_store
+        self.index = index
+        self.cache = cache
+        self.latency = latency
+        self.timeout = timeout
+        self.index_version = index_version
+        self.rollup = rollup
+        self.page_size = page_size
+        self.buffer_pages = buffer_pages
+        ## identical requests in flight share one computation
+        self._pending: Dict[Any, asyncio.Future] = {}
+
+    def _columns(self, params: _AnalyticsParams) -> Optional[ClaimsColumns]:
+        ## the columns hold no text, a search query needs the index; nor the permitted groups, a restricted one too
+        if self.claims_store is None or params.query != "*" or params.restricted:
+            return None
+        return self.claims_store.columns
+
+    async def _rollup(self, params: _AnalyticsParams) -> Optional[RollupCube]:
+        ## totals over every claim, which a caller restricted to some of them mustn't see
+        if self.rollup is None or params.query != "*" or params.restricted:
+            return None
+        cube = await self.rollup.current()
+        ## a rollup of other claims than the index holds (a reindex without one, a partial upload) is stale
+        if cube is not None and self.index_version is not None and self.index_version.count not in (None, cube.documents):
+            return None
+        return cube
+
+    def _require_index(self, params: _AnalyticsParams) -> Tuple[str, Optional[str], str]:
+        if not self.index:
+            if params.restricted:
+                raise AnalyticsUnavailableError("Document-level security needs a claims index to filter by permitted groups")
+            raise AnalyticsUnavailableError("No claims index is configured and the claims store can't answer this query")
+        return self.index
+
+    async def data_version(self) -> str:
+        """The version of the rollup, the claims columns and the index answers are computed from."""
+        columns = self.claims_store.columns if self.claims_store else None
+        index_version = await self.index_version.current() if self.index_version else None
+        cube = await self.rollup.current() if self.rollup else None
+        return f"{cube.version if cube else '-'}/{columns.version if columns else '-'}/{index_version or '-'}"
+
+    async def answer(self, route: str, params: _AnalyticsParams) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """The route's response body, and how it was served."""
+        started = time.perf_counter()
+        key = (route, params.cache_key())
+        version = await self.data_version()
+        cached = self.cache.get(key, version)
+        if cached is not None:
+            result, source = cached
+        else:
+            result, source = await self._compute(route, params, key, version)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if not self.latency.record(route, elapsed_ms, source, cached is not None):
+            logger.warning(
+                f"/{route} took {elapsed_ms:.1f}ms from {source}, over its {self.latency.slo_ms.get(route)}ms SLO: "
+                f"{params.cache_key()}"
+            )
+        return result, {"source": source, "cached": cached is not None, "elapsed_ms": elapsed_ms}
+
+    async def _compute(self, route: str, params: _AnalyticsParams, key: Any, version: str) -> Tuple[Dict[str, Any], str]:
+        ## a task, so a client going away doesn't cancel the answer the others are waiting for
+        pending = (key, version)
+        task = self._pending.get(pending)
+        if task is None:
+            task = self._pending[pending] = asyncio.ensure_future(self._run(route, params, key, version))
+            task.add_done_callback(lambda done: self._done(pending, done))
+        return await asyncio.shield(task)
+
+    async def _run(self, route: str, params: _AnalyticsParams, key: Any, version: str) -> Tuple[Dict[str, Any], str]:
+        result, source = await getattr(self, route)(params)
+        if "error" not in result:
+            self.cache.put(key, (result, source), version)
+        return result, source
+
+    def _done(self, pending: Any, task: asyncio.Future):
+        self._pending.pop(pending, None)
+        ## retrieved, so a failure every waiter abandoned isn't logged as never retrieved
+        if not task.cancelled():
+            task.exception()
+
+    async def stream_direct_search(self, params: DirectSearchParams) -> AsyncIterator[Dict[str, Any]]:
+        """
+        The /direct_search results a page at a time, the first page with
+        the total count. Up to ``buffer_pages`` pages are read ahead of the
+        client and none are cached, so memory stays flat however many
+        documents are asked for. The latency recorded is the first page's.
+        """
+        endpoint, key, index_name = self._require_index(params)
+        started = time.perf_counter()
+        pages = prefetch(stream_direct_search_query(
+            endpoint, key, index_name, params.query, params.filter, params.top_k,
+            params.select or DIRECT_SEARCH_SELECT, params.order_by, timeout=self.timeout, page_size=self.page_size,
+        ), self.buffer_pages)
+        try:
+            first = True
+            async for page in pages:
+                if first:
+                    first = False
+                    elapsed_ms = (time.perf_counter() - started) * 1000
+                    if not self.latency.record("direct_search", elapsed_ms, INDEX, False):
+                        logger.warning(
+                            f"/direct_search took {elapsed_ms:.1f}ms to its first page, over its "
+                            f"{self.latency.slo_ms.get('direct_search')}ms SLO: {params.cache_key()}"
+                        )
+                yield page
+        finally:
+            await pages.aclose()
+
+    async def aggregation(self, params: AggregationParams) -> Tuple[Dict[str, Any], str]:
+        cube = await self._rollup(params)
+        if cube is not None:
+            result = cube.aggregate(params.field, params.aggregation_type, params.filter)
+            if result is not None:
+                return result, ROLLUP
+
+        columns = self._columns(params)
+        if columns is not None:
+            try:
+                result = await _scan(columns, columns.aggregate, params.field, params.aggregation_type, params.filter)
+                return result, CLAIMS_STORE
+            except ValueError as e:
+                if not self.index:
+                    raise AnalyticsRequestError(str(e))
+                logger.debug(f"Claims store can't answer the aggregation, using the index: {e}")
+
+        endpoint, key, index_name = self._require_index(params)
+        result = await perform_search_aggregation(
+            endpoint, key, index_name, params.field, params.aggregation_type,
+            params.filter, params.query, timeout=self.timeout,
+        )
+        return result, INDEX
+
+    async def analytics(self, params: AnalyticsParams) -> Tuple[Dict[str, Any], str]:
+        metrics = params.all_metrics
+        sort_by = metric_name(*metrics[0]) if metrics else "count"
+        cube = await self._rollup(params)
+        if cube is not None:
+            grouped = cube.group_by(
+                params.group_by_field, metrics, params.filter, sort_by=sort_by, order=params.order, top=params.top_results,
+            )
+            if grouped is not None:
+                return self._grouped(params, grouped, metrics), ROLLUP
+
+        columns = self._columns(params)
+        if columns is not None:
+            try:
+                grouped = await _scan(
+                    columns, columns.group_by, params.group_by_field, metrics, params.filter,
+                    sort_by=sort_by, order=params.order, top=params.top_results,
+                )
+            except ValueError as e:
+                if not self.index:
+                    raise AnalyticsRequestError(str(e))
+                logger.debug(f"Claims store can't answer the group-by, using the index: {e}")
+            else:
+                return self._grouped(params, grouped, metrics), CLAIMS_STORE
+
+        endpoint, key, index_name = self._require_index(params)
+        result = await perform_analytics_query(
+            endpoint, key, index_name, params.group_by_field, params.metric_field, params.metric_function,
+            params.filter, params.query, params.top_results, params.order, timeout=self.timeout,
+            metrics=[(metric.field, metric.function) for metric in params.metrics],
+        )
+        return result, INDEX
+
+    def _grouped(self, params: AnalyticsParams, grouped: Dict[str, Any], metrics: List[Tuple[str, str]]) -> Dict[str, Any]:
+        if not grouped["total_documents"]:
+            return {"error": "No documents found matching the query"}
+        return format_analytics_result(
+            grouped["results"], grouped["total_groups"], grouped, params.group_by_field,
+            params.metric_field, params.metric_function, metrics,
+        )
+
+    def stats(self) -> dict:
+        columns = self.claims_store.columns if self.claims_store else None
+        return {
+            "latency": self.latency.summary(),
+            "cache": self.cache.stats(),
+            "index_version": self.index_version.version if self.index_version else None,
+            "rollup": self.rollup.cube.describe() if self.rollup and self.rollup.cube else None,
+            "claims_store": columns.describe() if columns else None,
+            "index": self.index[2] if self.index else None,
+        }
@@ -0,0 +1,268 @@
+import json
+import time
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from backend.analytics.columnar import BOOLEAN_FIELDS, CATEGORICAL_FIELDS, DATE_FIELDS, NUMERIC_FIELDS
+from backend.analytics.service import (
+    AggregationParams,
+    AnalyticsParams,
+    AnalyticsRequestError,
+    AnalyticsService,
+    AnalyticsUnavailableError,
+    INDEX,
+    DirectSearchParams,
+    LatencyTracker,
+)
+from backend.search.gateway import SearchTimeoutError
+from backend.search.groupby import METRIC_FUNCTIONS
+
+logger = logging.getLogger(__name__)
+
+FILTER_DESCRIPTION = (
+    "Optional OData filter, e.g. \"patientState eq 'CA' and claimAmount gt 500\" or "
+    "\"search.in(insuranceCompany, 'Aetna,Cigna')\". Strings are single-quoted, dates are ISO 8601."
+)
+METRIC_DESCRIPTION = (
+    "count, sum, avg, min and max are exact; median and p25/p75/p90/p95/p99 are percentiles and distinct "
+    "counts different values, both estimated within about 2%"
+)
+GROUP_FIELDS = list(CATEGORICAL_FIELDS + DATE_FIELDS + BOOLEAN_FIELDS)
+## distinct counts any of these, "patientName" counts patients; the other functions need an amount
+METRIC_FIELDS = list(NUMERIC_FIELDS) + ["patientName"] + list(CATEGORICAL_FIELDS)
+
+## route of the analytics service each tool runs on; find_claims streams its pages from the index
+TOOL_ROUTES = {
+    "aggregate_claims": "aggregation",
+    "group_claims": "analytics",
+}
+TOOL_PARAMS = {
+    "aggregate_claims": AggregationParams,
+    "group_claims": AnalyticsParams,
+    "find_claims": DirectSearchParams,
+}
+TOOL_DEFINITIONS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "aggregate_claims",
+            "description": "Compute one figure over all matching claims: the count, sum, average, minimum, maximum or a percentile of a claim amount field, or the number of distinct values of a field.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "field": {"type": "string", "enum": METRIC_FIELDS},
+                    "aggregation_type": {"type": "string", "enum": list(METRIC_FUNCTIONS), "description": METRIC_DESCRIPTION},
+                    "filter": {"type": "string", "description": FILTER_DESCRIPTION},
+                },
+                "required": ["field", "aggregation_type"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "group_claims",
+            "description": "Group all matching claims by a field and return the claim count per group, plus an optional metric, sorted by the metric (or the count).",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "group_by_field": {"type": "string", "enum": GROUP_FIELDS},
+                    "metric_field": {"type": "string", "enum": METRIC_FIELDS},
+                    "metric_function": {"type": "string", "enum": list(METRIC_FUNCTIONS), "description": METRIC_DESCRIPTION},
+                    "metrics": {
+                        "type": "array",
+                        "description": "Further metrics computed for each group",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "field": {"type": "string", "enum": METRIC_FIELDS},
+                                "function": {"type": "string", "enum": list(METRIC_FUNCTIONS)},
+                            },
+                            "required": ["field", "function"],
+                        },
+                    },
+                    "filter": {"type": "string", "description": FILTER_DESCRIPTION},
+                    "top_results": {"type": "integer", "minimum": 1, "maximum": 100},
+                    "order": {"type": "string", "enum": ["asc", "desc"]},
+                },
+                "required": ["group_by_field"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "find_claims",
+            "description": "Return individual claims matching a filter or search text, with the total number of matches.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {"type": "string", "description": "Search text, or * for every claim"},
+                    "filter": {"type": "string", "description": FILTER_DESCRIPTION},
+                    "select": {"type": "string", "description": "Comma-separated fields to return"},
+                    "order_by": {"type": "string", "description": "e.g. \"claimAmount desc\""},
+                    "top_k": {"type": "integer", "minimum": 1, "maximum": 50},
+                },
+            },
+        },
+    },
+]
+## the claim fields, without content, the vector and the patient's address and member id
+DEFAULT_SELECT = ",".join(["id", "patientName"] + list(NUMERIC_FIELDS + DATE_FIELDS + CATEGORICAL_FIELDS))
+MAX_FOUND_CLAIMS = 50
+## replaces the CSV dataset in the system message when the model has the tools
+TOOLS_DATA_SECTION = (
+    "# Claims Data\n"
+    "The claims dataset is not included in this message. Call the claims tools for every figure you "
+    "report: aggregate_claims and group_claims compute exactly over all claims, find_claims returns "
+    "individual claims. Never estimate a figure a tool can compute."
+)
+## replaces it when document-level security is on and the model has no tools
+RESTRICTED_DATA_SECTION = (
+    "# Claims Data\n"
+    "The claims dataset is not available in this conversation. Do not state or estimate figures about the claims."
+)
+
+
+class ToolRunner():
+    """
+    Runs the model's tool calls against the claims data and loops until it
+    answers.
+
+    Each round's tool calls execute concurrently through
+    ``AnalyticsService``, so they share its cache and engines, and their
+    results go back to the model as ``tool`` messages. After
+    ``max_rounds`` rounds the model is asked to answer without tools.
+    """
+
+    def __init__(self, service: AnalyticsService, max_rounds: int = 5, result_max_chars: int = 8000,
+                 extra_tools: Optional[List[dict]] = None):
+        self.service = service
+        self.max_rounds = max_rounds
+        self.result_max_chars = result_max_chars
+        self.extra_tools = extra_tools or []
+        self.latency = LatencyTracker(slo_ms={})
+        ## model calls per chat request -> requests
+        self.rounds: Dict[int, int] = {}
+        self.errors = 0
+
+    @property
+    def definitions(self) -> List[dict]:
+        return TOOL_DEFINITIONS + self.extra_tools
+
+    async def call(self, name: str, arguments: str, security_filter: Optional[str] = None) -> str:
+        started = time.perf_counter()
+        source, cached = "failed", False
+        try:
+            if name not in TOOL_PARAMS:
+                raise AnalyticsRequestError(f"Tool {name} is not available")
+            arguments = json.loads(arguments or "{}")
+            if name == "find_claims":
+                arguments.setdefault("select", DEFAULT_SELECT)
+                arguments["top_k"] = min(int(arguments.get("top_k") or 10), MAX_FOUND_CLAIMS)
+            params = TOOL_PARAMS[name].parse(arguments).restricted_to(security_filter)
+            if name == "find_claims":
+                result, source = await self.find_claims(params), INDEX
+            else:
+                result, served = await self.service.answer(TOOL_ROUTES[name], params)
+                source, cached = served["source"], served["cached"]
+        except (json.JSONDecodeError, TypeError, ValueError, AnalyticsUnavailableError, SearchTimeoutError) as e:
+            self.errors += 1
+            result = {"error": str(e)}
+        except Exception as e:
+            logger.exception(f"Tool {name} failed")
+            self.errors += 1
+            result = {"error": f"{name} failed: {e}"}
+        finally:
+            self.latency.record(name, (time.perf_counter() - started) * 1000, source, cached)
+
+        content = json.dumps(result, default=str)
+        if len(content) > self.result_max_chars:
+            content = content[:self.result_max_chars] + "... (truncated, narrow the filter or lower top_k)"
+        return content
+
+    async def find_claims(self, params: DirectSearchParams) -> Dict[str, Any]:
+        result = {"results": [], "count": None}
+        async for page in self.service.stream_direct_search(params):
+            result["results"].extend(page["results"])
+            result["count"] = page.get("count", result["count"])
+        return result
+
+    async def execute(self, tool_calls: List[dict], security_filter: Optional[str] = None) -> List[dict]:
+        """
+        ``tool`` messages answering ``tool_calls``, run concurrently and
+        restricted to the documents ``security_filter`` permits.
+        """
+        contents = await asyncio.gather(*(
+            self.call(tool_call["function"]["name"], tool_call["function"]["arguments"], security_filter)
+            for tool_call in tool_calls
+        ))
+        return [
+            {"role": "tool", "tool_call_id": tool_call["id"], "content": content}
+            for tool_call, content in zip(tool_calls, contents)
+        ]
+
+    def _next_round(self, model_args: dict, rounds: int, content: Optional[str], tool_calls: List[dict]):
+        model_args["messages"] = model_args["messages"] + [
+            {"role": "assistant", "content": content, "tool_calls": tool_calls},
+        ]
+        if rounds >= self.max_rounds:
+            model_args["tool_choice"] = "none"
+
+    def _record_rounds(self, rounds: int):
+        self.rounds[rounds] = self.rounds.get(rounds, 0) + 1
+
+    async def complete(self, client, model_args: dict, response, security_filter: Optional[str] = None):
+        """Follow tool calls from ``response`` to the model's final completion."""
+        rounds = 1
+        while response.choices and response.choices[0].message.tool_calls:
+            message = response.choices[0].message
+            tool_calls = [tool_call.model_dump(include={"id", "type", "function"}) for tool_call in message.tool_calls]
+            self._next_round(model_args, rounds, message.content, tool_calls)
+            model_args["messages"] += await self.execute(tool_calls, security_filter)
+            response = await client.chat.completions.create(**model_args)
+            rounds += 1
+        self._record_rounds(rounds)
+        return response
+
+    async def stream(self, client, model_args: dict, response, security_filter: Optional[str] = None) -> AsyncIterator[Any]:
+        """
+        The chunks of every round that carry content; tool call deltas are
+        collected, executed and answered with another streamed call.
+        """
+        rounds = 1
+        while True:
+            tool_calls: Dict[int, dict] = {}
+            content = []
+            async for chunk in response:
+                delta = chunk.choices[0].delta if chunk.choices else None
+                if delta is not None and delta.tool_calls:
+                    for tool_call in delta.tool_calls:
+                        collected = tool_calls.setdefault(
+                            tool_call.index, {"id": None, "type": "function", "function": {"name": "", "arguments": ""}}
+                        )
+                        collected["id"] = tool_call.id or collected["id"]
+                        if tool_call.function:
+                            collected["function"]["name"] += tool_call.function.name or ""
+                            collected["function"]["arguments"] += tool_call.function.arguments or ""
+                    continue
+                if delta is not None and delta.content:
+                    content.append(delta.content)
+                yield chunk
+
+            if not tool_calls:
+                self._record_rounds(rounds)
+                return
+            tool_calls = [tool_calls[index] for index in sorted(tool_calls)]
+            self._next_round(model_args, rounds, "".join(content) or None, tool_calls)
+            model_args["messages"] += await self.execute(tool_calls, security_filter)
+            response = await client.chat.completions.create(**model_args)
+            rounds += 1
+
+    def stats(self) -> dict:
+        return {
+            "latency": self.latency.summary(),
+            "rounds": {str(rounds): count for rounds, count in sorted(self.rounds.items())},
+            "errors": self.errors,
+        }
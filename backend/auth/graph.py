@@ -0,0 +1,178 @@
+import json
+import time
+import base64
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
+## tokens of one user the cached groups are returned for; a token Graph hasn't accepted fetches them itself
+TOKENS_PER_USER = 4
+
+
+class GroupResolutionError(Exception):
+    pass
+
+
+def token_subject(token: str) -> str:
+    """
+    The user a token is for: its ``oid`` (or ``sub``) claim, else a digest
+    of the whole token. The claims are read unverified, only to key the
+    cache; Graph verifies the token itself.
+    """
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        subject = claims.get("oid") or claims.get("sub")
+        if subject:
+            return str(subject)
+    except (IndexError, ValueError, AttributeError):
+        pass
+    return token_digest(token)
+
+
+def token_digest(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class _UserGroups():
+    __slots__ = ("groups", "fetched_at", "tokens")
+
+    def __init__(self, groups: List[str], fetched_at: float, tokens: List[str]):
+        self.groups = groups
+        self.fetched_at = fetched_at
+        self.tokens = tokens
+
+
+class GraphGroupResolver():
+    """
+    The ids of the groups a signed-in user is a transitive member of, for
+    the permitted-groups filter of document-level security.
+
+    Groups are cached per user, keyed by the token's subject, for ``ttl``
+    seconds. For ``stale_ttl`` seconds after that the cached groups are
+    still returned while one background fetch refreshes them. Concurrent
+    lookups for the same user and token share one fetch, and each fetch
+    follows ``@odata.nextLink`` page by page on one pooled HTTP client.
+
+    Cached groups are only returned for a token Graph has already accepted
+    for that user, so a token claiming someone else's subject fetches (and
+    fails) on its own. A failed fetch returns the groups still within
+    ``stale_ttl``, else none, which matches no documents.
+    """
+
+    def __init__(self, base_url: str = GRAPH_BASE_URL, ttl: float = 300.0, stale_ttl: float = 3600.0,
+                 timeout: float = 10.0, max_users: int = 10000, max_connections: int = 20, max_pages: int = 100,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.base_url = base_url.rstrip("/")
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.timeout = timeout
+        self.max_users = max_users
+        self.max_connections = max_connections
+        self.max_pages = max_pages
+        self.transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        self._cache: "OrderedDict[str, _UserGroups]" = OrderedDict()
+        ## (subject, token digest) -> the fetch in flight
+        self._pending: Dict[Tuple[str, str], asyncio.Task] = {}
+        self.counts = {"hits": 0, "stale_hits": 0, "misses": 0, "fetches": 0, "failures": 0}
+
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_connections),
+                transport=self.transport,
+            )
+        return self._client
+
+    async def groups(self, token: str) -> List[str]:
+        subject, digest = token_subject(token), token_digest(token)
+        entry = self._cache.get(subject)
+        if entry is not None and digest in entry.tokens:
+            age = time.monotonic() - entry.fetched_at
+            if age < self.ttl:
+                self.counts["hits"] += 1
+                self._cache.move_to_end(subject)
+                return entry.groups
+            if age < self.ttl + self.stale_ttl:
+                self.counts["stale_hits"] += 1
+                self._fetch(subject, digest, token)
+                return entry.groups
+
+        self.counts["misses"] += 1
+        try:
+            ## shielded, so a request going away doesn't cancel the fetch others are waiting on
+            return await asyncio.shield(self._fetch(subject, digest, token))
+        except (GroupResolutionError, httpx.HTTPError, ValueError):
+            ## logged once in _done, however many requests waited on the fetch
+            pass
+        stale = self._usable(subject, digest)
+        return stale.groups if stale is not None else []
+
+    def _usable(self, subject: str, digest: str) -> Optional[_UserGroups]:
+        entry = self._cache.get(subject)
+        if entry is None or digest not in entry.tokens or time.monotonic() - entry.fetched_at >= self.ttl + self.stale_ttl:
+            return None
+        return entry
+
+    def _fetch(self, subject: str, digest: str, token: str) -> asyncio.Task:
+        key = (subject, digest)
+        task = self._pending.get(key)
+        if task is None:
+            task = self._pending[key] = asyncio.ensure_future(self._refresh(subject, digest, token))
+            task.add_done_callback(lambda done: self._done(key, done))
+        return task
+
+    def _done(self, key: Tuple[str, str], task: asyncio.Task):
+        self._pending.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            self.counts["failures"] += 1
+            logger.error(f"Fetching user groups from Graph failed: {task.exception()!r}")
+
+    async def _refresh(self, subject: str, digest: str, token: str) -> List[str]:
+        self.counts["fetches"] += 1
+        groups = await self.fetch(token)
+        previous = self._cache.pop(subject, None)
+        tokens = [digest] + [other for other in (previous.tokens if previous else []) if other != digest]
+        self._cache[subject] = _UserGroups(groups, time.monotonic(), tokens[:TOKENS_PER_USER])
+        while len(self._cache) > self.max_users:
+            self._cache.popitem(last=False)
+        return groups
+
+    async def fetch(self, token: str) -> List[str]:
+        """Every group id of the token's user, straight from Graph."""
+        url = f"{self.base_url}/me/transitiveMemberOf?$select=id"
+        headers = {"Authorization": f"Bearer {token}"}
+        groups = []
+        for _ in range(self.max_pages):
+            ## the token only goes to Graph, never to a next link pointing elsewhere
+            if not url.startswith(self.base_url + "/"):
+                raise GroupResolutionError(f"Next link outside {self.base_url}: {url}")
+            response = await self.client().get(url, headers=headers)
+            if response.status_code != 200:
+                raise GroupResolutionError(f"{response.status_code} {response.text[:200]}")
+            body = response.json()
+            groups.extend(item["id"] for item in body.get("value", []) if item.get("id"))
+            url = body.get("@odata.nextLink")
+            if not url:
+                return groups
+        raise GroupResolutionError(f"More than {self.max_pages} pages of groups")
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counts, "users": len(self._cache), "pending": len(self._pending)}
+
+    async def close(self):
+        for task in list(self._pending.values()):
+            task.cancel()
+        await asyncio.gather(*self._pending.values(), return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,233 @@
+import os
+import gzip
+import json
+import uuid
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+from azure.core.exceptions import ResourceNotFoundError
+
+logger = logging.getLogger(__name__)
+
+## set on a conversation whose messages live in the archive instead of the history store
+ARCHIVED_FIELD = "archived"
+## set when a conversation is rehydrated, idleness is measured from the later of this and updatedAt
+LAST_ACCESSED_FIELD = "lastAccessedAt"
+
+
+class ArchiveStore(ABC):
+    @abstractmethod
+    async def write(self, name: str, data: bytes):
+        pass
+
+    @abstractmethod
+    async def read(self, name: str) -> bytes:
+        pass
+
+    @abstractmethod
+    async def delete(self, name: str):
+        pass
+
+    async def close(self):
+        pass
+
+
+class BlobArchiveStore(ArchiveStore):
+    def __init__(self, container_client):
+        ## azure.storage.blob.aio.ContainerClient
+        self.container_client = container_client
+
+    async def write(self, name, data):
+        await self.container_client.upload_blob(name, data, overwrite=True)
+
+    async def read(self, name):
+        downloader = await self.container_client.download_blob(name)
+        return await downloader.readall()
+
+    async def delete(self, name):
+        try:
+            await self.container_client.delete_blob(name)
+        except ResourceNotFoundError:
+            pass
+
+    async def close(self):
+        await self.container_client.close()
+
+
+class LocalArchiveStore(ArchiveStore):
+    """Filesystem stand-in for blob storage, for tests and local runs."""
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+
+    def _path(self, name):
+        return os.path.join(self.root_dir, *name.split("/"))
+
+    def _write(self, name, data):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as archive_file:
+            archive_file.write(data)
+        os.replace(temp_path, path)
+
+    def _read(self, name):
+        try:
+            with open(self._path(name), "rb") as archive_file:
+                return archive_file.read()
+        except FileNotFoundError as e:
+            raise ResourceNotFoundError(f"Archive {name} not found") from e
+
+    def _delete(self, name):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    async def write(self, name, data):
+        await asyncio.to_thread(self._write, name, data)
+
+    async def read(self, name):
+        return await asyncio.to_thread(self._read, name)
+
+    async def delete(self, name):
+        await asyncio.to_thread(self._delete, name)
+
+
+def archive_name(user_id: str, conversation_id: str, version: str) -> str:
+    ## one blob per archival, so a run that loses the race for the stub can delete its own blob
+    return f"{quote(user_id, safe='')}/{conversation_id}.{version}.ndjson.gz"
+
+
+class ConversationArchiver():
+    """
+    Moves conversations idle for ``idle_days`` out of the history store.
+
+    The conversation and its messages are written as one gzipped NDJSON blob
+    (conversation first). The conversation document stays behind as a stub,
+    so it still shows up in the history list, with ``archived`` pointing at
+    the blob; the messages are deleted. ``rehydrate`` reverses this when the
+    conversation is opened again.
+
+    The stub is written before any message is deleted, and rehydration
+    keeps messages that are still in the store, so a job interrupted at any
+    point loses nothing. The stub only replaces the conversation if it is
+    unchanged since it was read, and only the archived messages are
+    deleted, so a message written meanwhile stays put and the conversation
+    is left for a later run.
+    """
+
+    def __init__(self, client, store: ArchiveStore, idle_days: int = 90, batch_size: int = 100):
+        self.client = client
+        self.store = store
+        self.idle_days = idle_days
+        self.batch_size = batch_size
+
+    async def archive_idle(self, now: datetime = None) -> int:
+        cutoff = ((now or datetime.utcnow()) - timedelta(days=self.idle_days)).isoformat()
+        archived = 0
+        while True:
+            conversations = await self.client.get_idle_conversations(cutoff, self.batch_size)
+            batch_archived = 0
+            for conversation in conversations:
+                try:
+                    if await self.archive(conversation):
+                        batch_archived += 1
+                except Exception:
+                    logger.exception(f"Failed to archive conversation {conversation['id']}")
+            archived += batch_archived
+            ## stop on a short page, or when every conversation in the page failed and would come back again
+            if len(conversations) < self.batch_size or not batch_archived:
+                return archived
+
+    async def archive(self, conversation: dict) -> bool:
+        user_id, conversation_id = conversation['userId'], conversation['id']
+        etag = conversation.get('_etag')
+        messages = [
+            {key: value for key, value in message.items() if not key.startswith('_')}
+            for message in await self.client.get_messages(user_id, conversation_id)
+        ]
+
+        stub = {key: value for key, value in conversation.items() if not key.startswith('_')}
+        lines = [json.dumps(stub)] + [json.dumps(message) for message in messages]
+        name = archive_name(user_id, conversation_id, uuid.uuid4().hex)
+        await self.store.write(name, gzip.compress(("\n".join(lines) + "\n").encode('utf-8')))
+
+        stub[ARCHIVED_FIELD] = {
+            'blob': name,
+            'archivedAt': datetime.utcnow().isoformat(),
+            'messageCount': len(messages),
+        }
+        if not await self.client.replace_conversation(stub, etag):
+            ## written to (or archived, or deleted) since it was read
+            await self.store.delete(name)
+            logger.info(f"Conversation {conversation_id} changed while being archived, skipping it")
+            return False
+        await self.client.delete_message_ids(user_id, conversation_id, [message['id'] for message in messages])
+        logger.info(f"Archived conversation {conversation_id} with {len(messages)} messages to {name}")
+        return True
+
+    async def read_messages(self, conversation: dict) -> list:
+        data = gzip.decompress(await self.store.read(conversation[ARCHIVED_FIELD]['blob'])).decode('utf-8')
+        documents = [json.loads(line) for line in data.splitlines() if line]
+        return [document for document in documents if document.get('type') == 'message']
+
+    async def rehydrate(self, conversation: dict) -> dict:
+        archived = conversation.get(ARCHIVED_FIELD)
+        if not archived:
+            return conversation
+
+        user_id = conversation['userId']
+        try:
+            messages = await self.read_messages(conversation)
+        except ResourceNotFoundError:
+            ## a concurrent rehydrate got here first and has already deleted the blob
+            current = await self.client.get_conversation(user_id, conversation['id'])
+            if current is not None and (current.get(ARCHIVED_FIELD) or {}).get('blob') != archived['blob']:
+                return current
+            raise
+
+        existing = {message['id'] for message in await self.client.get_messages(user_id, conversation['id'])}
+        operations = []
+        for message in messages:
+            if message['id'] in existing:
+                continue
+            if self.client.content_compression:
+                self.client.content_compression.encode_message(message)
+            operations.append({'op': 'upsert', 'item': message})
+        for start in range(0, len(operations), self.batch_size):
+            await self.client.execute_batch(user_id, operations[start:start + self.batch_size])
+
+        etag = conversation.get('_etag')
+        conversation = {key: value for key, value in conversation.items() if key != ARCHIVED_FIELD and not key.startswith('_')}
+        ## opening a conversation doesn't move it in the history list, but it shouldn't be archived again right away
+        conversation[LAST_ACCESSED_FIELD] = datetime.utcnow().isoformat()
+        replaced = await self.client.replace_conversation(conversation, etag)
+        if not replaced:
+            ## written meanwhile, most likely by a concurrent rehydrate which deletes the blob itself
+            return await self.client.get_conversation(user_id, conversation['id'])
+        conversation = replaced
+        await self.store.delete(archived['blob'])
+        logger.info(f"Rehydrated conversation {conversation['id']} with {len(messages)} messages")
+        return conversation
+
+    async def discard(self, conversation: dict):
+        ## the conversation is being deleted, drop its archive too
+        archived = conversation.get(ARCHIVED_FIELD) if conversation else None
+        if archived:
+            await self.store.delete(archived['blob'])
+
+    async def run_forever(self, interval: float):
+        while True:
+            try:
+                archived = await self.archive_idle()
+                if archived:
+                    logger.info(f"Archived {archived} idle conversations")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Conversation archival run failed")
+            await asyncio.sleep(interval)
@@ -0,0 +1,72 @@
+import gzip
+import base64
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+## stored next to a compressed ``content``, documents without it are plain text
+CONTENT_ENCODING_FIELD = "contentEncoding"
+ZSTD_ENCODING = "zstd+base64"
+GZIP_ENCODING = "gzip+base64"
+
+
+class ContentCompression():
+    """
+    Compresses message ``content`` at or above ``threshold`` bytes of UTF-8.
+
+    ``algorithm`` is ``zstd``, ``gzip`` or ``auto`` (zstd when the
+    zstandard package is installed, gzip otherwise). Decoding handles both
+    encodings whatever the configured algorithm is, so the setting can
+    change without rewriting stored documents.
+    """
+
+    def __init__(self, threshold: int = 4096, algorithm: str = "auto"):
+        if algorithm == "zstd" and zstandard is None:
+            raise ValueError("zstd history compression requires the zstandard package")
+        self.threshold = threshold
+        self.encoding = ZSTD_ENCODING if algorithm == "zstd" or (algorithm == "auto" and zstandard) else GZIP_ENCODING
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == ZSTD_ENCODING:
+            return zstandard.ZstdCompressor(level=3).compress(data)
+        return gzip.compress(data, compresslevel=6, mtime=0)
+
+    def encode_message(self, message: dict) -> dict:
+        content = message.get('content')
+        if not isinstance(content, str) or CONTENT_ENCODING_FIELD in message:
+            return message
+
+        data = content.encode('utf-8')
+        if len(data) < self.threshold:
+            return message
+
+        encoded = base64.b64encode(self.compress(data)).decode('ascii')
+        ## short or already-compressed text can grow once base64 is added
+        if len(encoded) >= len(data):
+            return message
+
+        message['content'] = encoded
+        message[CONTENT_ENCODING_FIELD] = self.encoding
+        return message
+
+
+def decode_message(message: dict) -> dict:
+    encoding = message.pop(CONTENT_ENCODING_FIELD, None)
+    if encoding is None:
+        return message
+
+    data = base64.b64decode(message['content'])
+    if encoding == ZSTD_ENCODING:
+        if zstandard is None:
+            raise ValueError(f"Message {message.get('id')} is zstd compressed but the zstandard package is not installed")
+        ## frames written by ZstdCompressor.compress carry their size, so no max_output_size is needed
+        data = zstandard.ZstdDecompressor().decompress(data)
+    elif encoding == GZIP_ENCODING:
+        data = gzip.decompress(data)
+    else:
+        raise ValueError(f"Message {message.get('id')} has unknown content encoding {encoding}")
+
+    message['content'] = data.decode('utf-8')
+    return message
@@ -0,0 +1,292 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from azure.cosmos import exceptions
+
+logger = logging.getLogger(__name__)
+
+CONVERSATION_INDEX_ID = "conversation-index"
+CONVERSATION_INDEX_TYPE = "conversationIndex"
+CHECKPOINT_ID = "change-feed-checkpoint"
+CHECKPOINT_TYPE = "changeFeedCheckpoint"
+## pseudo user the consumer's checkpoint document is stored under
+CHECKPOINT_USER_ID = "__conversation_index__"
+## how long a deleted conversation is remembered, so a stale change can't bring it back
+TOMBSTONE_RETENTION = timedelta(days=7)
+MAX_UPDATE_ATTEMPTS = 10
+
+
+def new_conversation_index(user_id: str) -> dict:
+    return {
+        'id': CONVERSATION_INDEX_ID,
+        'type': CONVERSATION_INDEX_TYPE,
+        'userId': user_id,
+        'conversations': {},
+        'deleted': {},
+    }
+
+
+def apply_change(index: dict, item: dict) -> bool:
+    """
+    Fold one change feed document into a user's conversation index.
+
+    Every field is merged with max/min semantics (titles by the document's
+    ``_ts``), so replaying a change or seeing changes out of order leaves the
+    index in the same state. Returns True if the index changed.
+    """
+    if item.get('type') == 'conversation':
+        conversation_id = item['id']
+        activity = item.get('updatedAt') or item.get('createdAt')
+    elif item.get('type') == 'message':
+        conversation_id = item.get('conversationId')
+        activity = item.get('createdAt')
+    else:
+        return False
+
+    if not conversation_id or conversation_id in index['deleted']:
+        return False
+
+    entry = index['conversations'].get(conversation_id)
+    if entry is None:
+        ## ts 0 marks an entry whose conversation document hasn't been seen yet
+        entry = {'title': '', 'createdAt': activity, 'updatedAt': activity, 'ts': 0}
+        index['conversations'][conversation_id] = entry
+        changed = True
+    else:
+        changed = False
+
+    if activity and activity > entry['updatedAt']:
+        entry['updatedAt'] = activity
+        changed = True
+
+    if item['type'] == 'conversation':
+        ts = item.get('_ts', 0)
+        if ts >= entry['ts'] and (entry['title'] != item.get('title', '') or entry['ts'] != ts):
+            entry['title'] = item.get('title', '')
+            entry['ts'] = ts
+            changed = True
+        if item.get('createdAt') and item['createdAt'] < entry['createdAt']:
+            entry['createdAt'] = item['createdAt']
+            changed = True
+
+    return changed
+
+
+def remove_conversations(index: dict, conversation_ids: List[str]) -> bool:
+    now = datetime.utcnow()
+    for conversation_id in conversation_ids:
+        index['conversations'].pop(conversation_id, None)
+        index['deleted'][conversation_id] = now.isoformat()
+
+    expired = (now - TOMBSTONE_RETENTION).isoformat()
+    index['deleted'] = {key: deleted_at for key, deleted_at in index['deleted'].items() if deleted_at > expired}
+    return True
+
+
+def conversations_from_index(index: dict, limit, sort_order = 'DESC', offset = 0) -> List[dict]:
+    ## same shape get_conversations returns from the query path
+    conversations = [
+        {
+            'id': conversation_id,
+            'type': 'conversation',
+            'userId': index['userId'],
+            'title': entry['title'],
+            'createdAt': entry['createdAt'],
+            'updatedAt': entry['updatedAt'],
+        }
+        for conversation_id, entry in index['conversations'].items()
+        if entry['ts']
+    ]
+    conversations.sort(key=lambda conversation: conversation['updatedAt'], reverse=str(sort_order).upper() != 'ASC')
+    if limit is None:
+        return conversations[offset:]
+    return conversations[offset:offset + limit]
+
+
+async def update_conversation_index(store, user_id: str, mutate) -> Optional[dict]:
+    """
+    Read-modify-write a user's index with optimistic concurrency. ``mutate``
+    changes the document in place and returns whether anything changed.
+    """
+    for _ in range(MAX_UPDATE_ATTEMPTS):
+        index = await store.read_conversation_index(user_id)
+        if index is None:
+            index = new_conversation_index(user_id)
+        if not mutate(index):
+            return index
+        try:
+            return await store.write_conversation_index(index)
+        except (exceptions.CosmosAccessConditionFailedError, exceptions.CosmosResourceExistsError):
+            ## someone else updated it first, start over from their version
+            continue
+
+    raise RuntimeError(f"Gave up updating the conversation index for {user_id} after {MAX_UPDATE_ATTEMPTS} attempts")
+
+
+class CosmosChangeFeedSource():
+    """Reads the container's change feed one partition key range at a time."""
+
+    def __init__(self, container_client, max_item_count: int = 100):
+        self.container_client = container_client
+        self.max_item_count = max_item_count
+
+    async def ranges(self) -> List[str]:
+        ## the 4.5 SDK has no feed range API, list the ranges the way the change feed processor does
+        client_connection = self.container_client.client_connection
+        return [
+            partition_key_range['id']
+            async for partition_key_range in client_connection._ReadPartitionKeyRanges(self.container_client.container_link)
+        ]
+
+    async def read(self, range_id: str, continuation: Optional[str]) -> Tuple[List[dict], Optional[str]]:
+        headers = {}
+        changes = self.container_client.query_items_change_feed(
+            partition_key_range_id=range_id,
+            is_start_from_beginning=continuation is None,
+            continuation=continuation,
+            max_item_count=self.max_item_count,
+            response_hook=lambda response_headers, _: headers.update(response_headers),
+        )
+        items = [item async for item in changes]
+        return items, headers.get('etag', continuation)
+
+
+class LocalChangeFeed():
+    """
+    In-process stand-in for the Cosmos change feed, for tests and local runs.
+
+    ``publish`` appends a document version the way Cosmos would after a
+    write. Tests can publish the same version twice or publish versions out
+    of order to exercise the consumer's idempotency.
+    """
+
+    def __init__(self):
+        self.changes: List[dict] = []
+        self._ts = 0
+
+    def publish(self, item: dict, ts: Optional[int] = None) -> dict:
+        if ts is None:
+            self._ts += 1
+            ts = self._ts
+        change = dict(item, _ts=ts)
+        self.changes.append(change)
+        return change
+
+    async def ranges(self) -> List[str]:
+        return ["0"]
+
+    async def read(self, range_id: str, continuation: Optional[str]) -> Tuple[List[dict], Optional[str]]:
+        position = int(continuation or 0)
+        return self.changes[position:], str(len(self.changes))
+
+
+class InMemoryConversationIndexStore():
+    """Index and checkpoint storage with the same concurrency errors as Cosmos, for use with LocalChangeFeed."""
+
+    def __init__(self):
+        self.indexes: Dict[str, dict] = {}
+        self.checkpoint: Dict[str, str] = {}
+        self._version = 0
+
+    async def read_conversation_index(self, user_id):
+        index = self.indexes.get(user_id)
+        return {**index, 'conversations': {k: dict(v) for k, v in index['conversations'].items()}, 'deleted': dict(index['deleted'])} if index else None
+
+    async def write_conversation_index(self, index):
+        current = self.indexes.get(index['userId'])
+        if current is None and '_etag' in index:
+            raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="Index was deleted")
+        if current is not None and current['_etag'] != index.get('_etag'):
+            raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="Index was modified")
+        self._version += 1
+        self.indexes[index['userId']] = dict(index, _etag=str(self._version))
+        return self.indexes[index['userId']]
+
+    async def read_change_feed_checkpoint(self):
+        return dict(self.checkpoint)
+
+    async def write_change_feed_checkpoint(self, continuations):
+        self.checkpoint = dict(continuations)
+
+
+class ConversationIndexConsumer():
+    """
+    Tails the history change feed and keeps each user's conversation index
+    document up to date.
+
+    Changes are grouped per user so a page costs one read and one write per
+    user it touches. The continuation per partition key range is saved after
+    each page that had index-relevant changes; after a crash the last page is
+    replayed, which ``apply_change`` tolerates.
+    """
+
+    def __init__(self, source, store, poll_interval: float = 1.0):
+        self.source = source
+        self.store = store
+        self.poll_interval = poll_interval
+        self.continuations: Dict[str, str] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self.continuations = await self.store.read_change_feed_checkpoint() or {}
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                processed = await self.poll_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Conversation index consumer failed, retrying")
+                processed = 0
+            if not processed:
+                await asyncio.sleep(self.poll_interval)
+
+    async def poll_once(self) -> int:
+        processed = 0
+        for range_id in await self.source.ranges():
+            try:
+                items, continuation = await self.source.read(range_id, self.continuations.get(range_id))
+            except exceptions.CosmosHttpResponseError as e:
+                if e.status_code != 410:
+                    raise
+                ## the range split; its children start from the beginning and replay harmlessly
+                logger.info(f"Partition key range {range_id} is gone, re-reading partition key ranges")
+                self.continuations.pop(range_id, None)
+                continue
+
+            processed += await self.apply(items)
+            self.continuations[range_id] = continuation
+
+        if processed:
+            await self.store.write_change_feed_checkpoint(self.continuations)
+        return processed
+
+    async def apply(self, items: List[dict]) -> int:
+        changes_by_user: Dict[str, List[dict]] = {}
+        for item in items:
+            if item.get('type') in ('conversation', 'message') and item.get('userId'):
+                changes_by_user.setdefault(item['userId'], []).append(item)
+
+        def apply_all(changes):
+            def mutate(index):
+                changed = False
+                for change in changes:
+                    changed = apply_change(index, change) or changed
+                return changed
+            return mutate
+
+        await asyncio.gather(*(
+            update_conversation_index(self.store, user_id, apply_all(changes))
+            for user_id, changes in changes_by_user.items()
+        ))
+        return sum(len(changes) for changes in changes_by_user.values())
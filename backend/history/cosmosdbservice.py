@@ -1,18 +1,64 @@
-import uuid
-from datetime import datetime
+import asyncio
+import logging
 from azure.cosmos.aio import CosmosClient
+from azure.core import MatchConditions
 from azure.cosmos import exceptions
-  
-class CosmosConversationClient():
-    
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False):
+from backend.history.storage import HistoryStorage
+from backend.history.cosmosmetrics import raw_response_hook, tracked
+from backend.history.partitioning import PartitionStrategy, ClientIpPartitionStrategy
+from backend.history.compression import ContentCompression, decode_message
+from backend.history.indexingpolicy import indexing_policy_problems
+from backend.history.feedback import MESSAGE_FEEDBACK_FIELD, MAX_PATCH_OPERATIONS
+from backend.history.conversationindex import (
+    CONVERSATION_INDEX_ID,
+    CHECKPOINT_ID,
+    CHECKPOINT_TYPE,
+    CHECKPOINT_USER_ID,
+    conversations_from_index,
+    remove_conversations,
+    update_conversation_index,
+)
+
+logger = logging.getLogger(__name__)
+
+## server-managed properties that must not be copied between containers
+SYSTEM_PROPERTIES = ('_rid', '_self', '_etag', '_attachments', '_ts')
+
+
+def strip_system_properties(item: dict) -> dict:
+    return {key: value for key, value in item.items() if key not in SYSTEM_PROPERTIES}
+
+
+def document_conversation_id(item: dict) -> str:
+    return item['id'] if item.get('type') == 'conversation' else item.get('conversationId')
+
+
+def merge_documents(primary: list, fallback: list) -> list:
+    ## documents already copied to the primary container win over their legacy copies
+    seen = {item['id'] for item in primary}
+    return primary + [item for item in fallback if item['id'] not in seen]
+
+
+class CosmosConversationClient(HistoryStorage):
+
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False,
+                 partition_strategy: PartitionStrategy = None, fallback: "CosmosConversationClient" = None,
+                 conversation_index_enabled: bool = False, content_compression: ContentCompression = None):
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
         self.container_name = container_name
         self.enable_message_feedback = enable_message_feedback
+        self.partition_strategy = partition_strategy or ClientIpPartitionStrategy()
+        ## client for the container being migrated from, see scripts/migrate_history_partitions.py
+        self.fallback = fallback
+        ## list conversations from the per-user index kept by ConversationIndexConsumer
+        self.conversation_index_enabled = conversation_index_enabled
+        self.content_compression = content_compression
         try:
-            self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
+            self.cosmosdb_client = CosmosClient(
+                self.cosmosdb_endpoint, credential=credential, raw_response_hook=raw_response_hook
+            )
         except exceptions.CosmosHttpResponseError as e:
             if e.status_code == 401:
                 raise ValueError("Invalid credentials") from e
@@ -22,14 +68,15 @@ class CosmosConversationClient():
         try:
             self.database_client = self.cosmosdb_client.get_database_client(database_name)
         except exceptions.CosmosResourceNotFoundError:
-            raise ValueError("Invalid CosmosDB database name") 
-        
+            raise ValueError("Invalid CosmosDB database name")
+
         try:
             self.container_client = self.database_client.get_container_client(container_name)
         except exceptions.CosmosResourceNotFoundError:
-            raise ValueError("Invalid CosmosDB container name") 
-        
+            raise ValueError("Invalid CosmosDB container name")
+
 
+    @tracked("ensure")
     async def ensure(self):
         if not self.cosmosdb_client or not self.database_client or not self.container_client:
             return False, "CosmosDB client not initialized correctly"
@@ -37,58 +84,158 @@ class CosmosConversationClient():
             database_info = await self.database_client.read()
         except:
             return False, f"CosmosDB database {self.database_name} on account {self.cosmosdb_endpoint} not found"
-        
+
         try:
             container_info = await self.container_client.read()
         except:
             return False, f"CosmosDB container {self.container_name} not found"
-            
+
+        partition_key_paths = container_info.get('partitionKey', {}).get('paths', [])
+        if partition_key_paths != [self.partition_strategy.partition_key_path]:
+            return False, (
+                f"CosmosDB container {self.container_name} is partitioned on {partition_key_paths}, "
+                f"the '{self.partition_strategy.name}' partition strategy needs {self.partition_strategy.partition_key_path}"
+            )
+
+        ## a container created with the default policy works, it just costs more RU per write and query
+        problems = indexing_policy_problems(container_info.get('indexingPolicy', {}))
+        if problems:
+            logger.warning(
+                f"CosmosDB container {self.container_name} indexing policy is not tuned for chat history "
+                f"({'; '.join(problems)}), run scripts/provision_history_indexes.py"
+            )
+
+        if self.fallback:
+            success, err = await self.fallback.ensure()
+            if not success:
+                return False, f"Migration source: {err}"
+
         return True, "CosmosDB client initialized successfully"
 
+    async def close(self):
+        await self.cosmosdb_client.close()
+        if self.fallback:
+            await self.fallback.close()
+
+    def partition_fields(self, user_id, conversation_id):
+        return self.partition_strategy.document_fields(user_id, conversation_id)
+
+    def partition_key(self, user_id, conversation_id = None):
+        return self.partition_strategy.partition_key(user_id, conversation_id)
+
+    def item_partition_key(self, item):
+        return self.partition_key(item['userId'], document_conversation_id(item))
+
+    def prepare_item(self, item):
+        ## documents read from the migration source may lack this container's partition properties
+        item = strip_system_properties(item)
+        item.update(self.partition_fields(item['userId'], document_conversation_id(item)))
+        return item
+
+    async def query_user_items(self, query, parameters, user_id):
+        ## run a query over every partition holding the user's documents
+        partition_keys = self.partition_strategy.user_partition_keys(user_id)
+        if partition_keys is None:
+            return [item async for item in self.container_client.query_items(
+                query=query, parameters=parameters, enable_cross_partition_query=True
+            )]
+
+        async def query_partition(partition_key):
+            return [item async for item in self.container_client.query_items(
+                query=query, parameters=parameters, partition_key=partition_key
+            )]
+
+        if len(partition_keys) == 1:
+            return await query_partition(partition_keys[0])
+
+        results = await asyncio.gather(*(query_partition(partition_key) for partition_key in partition_keys))
+        return [item for items in results for item in items]
+
+    @tracked("create_conversation")
     async def create_conversation(self, user_id, title = ''):
-        conversation = {
-            'id': str(uuid.uuid4()),  
-            'type': 'conversation',
-            'createdAt': datetime.utcnow().isoformat(),  
-            'updatedAt': datetime.utcnow().isoformat(),  
-            'userId': user_id,
-            'title': title
-        }
+        conversation = self.build_conversation(user_id, title)
         ## TODO: add some error handling based on the output of the upsert_item call
-        resp = await self.container_client.upsert_item(conversation)  
+        resp = await self.container_client.upsert_item(conversation)
         if resp:
             return resp
         else:
             return False
-    
+
+    @tracked("upsert_conversation")
     async def upsert_conversation(self, conversation):
-        resp = await self.container_client.upsert_item(conversation)
+        resp = await self.container_client.upsert_item(self.prepare_item(conversation))
         if resp:
             return resp
         else:
             return False
 
+    @tracked("replace_conversation")
+    async def replace_conversation(self, conversation, etag):
+        try:
+            return await self.container_client.replace_item(
+                item=conversation['id'],
+                body=self.prepare_item(conversation),
+                etag=etag,
+                match_condition=MatchConditions.IfNotModified,
+            )
+        except (exceptions.CosmosAccessConditionFailedError, exceptions.CosmosResourceNotFoundError):
+            return None
+
+    @tracked("delete_conversation")
     async def delete_conversation(self, user_id, conversation_id):
-        conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)        
-        if conversation:
-            resp = await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
-            return resp
-        else:
-            return True
+        resp = True
+        try:
+            resp = await self.container_client.delete_item(
+                item=conversation_id, partition_key=self.partition_key(user_id, conversation_id)
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            pass
 
-        
+        if self.conversation_index_enabled:
+            await update_conversation_index(
+                self, user_id, lambda index: remove_conversations(index, [conversation_id])
+            )
+        if self.fallback:
+            await self.fallback.delete_conversation(user_id, conversation_id)
+        return resp
+
+
+    @tracked("delete_messages")
     async def delete_messages(self, conversation_id, user_id):
         ## get a list of all the messages in the conversation
-        messages = await self.get_messages(user_id, conversation_id)
+        messages = await self.query_messages(user_id, conversation_id)
         response_list = []
-        if messages:
-            for message in messages:
-                resp = await self.container_client.delete_item(item=message['id'], partition_key=user_id)
+        partition_key = self.partition_key(user_id, conversation_id)
+        for message in messages:
+            try:
+                resp = await self.container_client.delete_item(item=message['id'], partition_key=partition_key)
                 response_list.append(resp)
+            except exceptions.CosmosResourceNotFoundError:
+                pass
+
+        if self.fallback:
+            response_list += await self.fallback.delete_messages(conversation_id, user_id) or []
+        if response_list:
             return response_list
 
+    @tracked("delete_message_ids")
+    async def delete_message_ids(self, user_id, conversation_id, message_ids):
+        partition_key = self.partition_key(user_id, conversation_id)
+        for message_id in message_ids:
+            try:
+                await self.container_client.delete_item(item=message_id, partition_key=partition_key)
+            except exceptions.CosmosResourceNotFoundError:
+                pass
 
+    @tracked("get_conversations")
     async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        sort_order = 'ASC' if str(sort_order).upper() == 'ASC' else 'DESC'
+        ## the change feed only covers this container, so the index can't list a migration source
+        if self.conversation_index_enabled and not self.fallback:
+            index = await self.read_conversation_index(user_id)
+            if index is not None:
+                return conversations_from_index(index, limit, sort_order, offset)
+
         parameters = [
             {
                 'name': '@userId',
@@ -96,16 +243,67 @@ class CosmosConversationClient():
             }
         ]
         query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
+
+        ## results from several partitions (or containers) are merged here, so each one
+        ## has to return everything up to the end of the requested page
+        partition_keys = self.partition_strategy.user_partition_keys(user_id)
+        merged = self.fallback is not None or (partition_keys is not None and len(partition_keys) > 1)
         if limit is not None:
-            query += f" offset {offset} limit {limit}" 
-        
-        conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            conversations.append(item)
-        
-        return conversations
+            if merged:
+                query += f" offset 0 limit {offset + limit}"
+            else:
+                query += f" offset {offset} limit {limit}"
+
+        conversations = await self.query_user_items(query, parameters, user_id)
+        if not merged:
+            return conversations
+
+        if self.fallback:
+            legacy_conversations = await self.fallback.get_conversations(
+                user_id, None if limit is None else offset + limit, sort_order, 0
+            )
+            conversations = merge_documents(conversations, legacy_conversations)
+
+        conversations.sort(key=lambda conversation: conversation['updatedAt'], reverse=sort_order == 'DESC')
+        if limit is None:
+            return conversations[offset:]
+        return conversations[offset:offset + limit]
+
+    async def iter_conversations(self, user_id, page_size = 100):
+        ## streams from the query pager, so only one page per partition is held at a time
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = "SELECT * FROM c WHERE c.userId = @userId AND c.type='conversation'"
+        partition_keys = self.partition_strategy.user_partition_keys(user_id)
+        if partition_keys is None:
+            scopes = [{'enable_cross_partition_query': True}]
+        else:
+            scopes = [{'partition_key': partition_key} for partition_key in partition_keys]
+
+        seen = set()
+        for scope in scopes:
+            async for item in self.container_client.query_items(
+                query=query, parameters=parameters, max_item_count=page_size, **scope
+            ):
+                seen.add(item['id'])
+                yield item
+
+        if self.fallback:
+            async for item in self.fallback.iter_conversations(user_id, page_size):
+                if item['id'] not in seen:
+                    yield item
+
+    async def iter_messages(self, user_id, conversation_id, page_size = 100):
+        if self.fallback:
+            ## merging with the migration source needs the whole conversation anyway
+            for message in await self.get_messages(user_id, conversation_id):
+                yield message
+            return
 
-    async def get_conversation(self, user_id, conversation_id):
         parameters = [
             {
                 'name': '@conversationId',
@@ -116,54 +314,223 @@ class CosmosConversationClient():
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
-        conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            conversations.append(item)
+        query = "SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.createdAt ASC"
+        async for item in self.container_client.query_items(
+            query=query, parameters=parameters, max_item_count=page_size,
+            partition_key=self.partition_key(user_id, conversation_id)
+        ):
+            yield decode_message(item)
+
+    @tracked("get_idle_conversations")
+    async def get_idle_conversations(self, updated_before, limit):
+        parameters = [
+            {
+                'name': '@updatedBefore',
+                'value': updated_before
+            }
+        ]
+        query = (
+            f"SELECT TOP {int(limit)} * FROM c WHERE c.type='conversation' "
+            "AND c.updatedAt < @updatedBefore AND NOT IS_DEFINED(c.archived) "
+            "AND (NOT IS_DEFINED(c.lastAccessedAt) OR c.lastAccessedAt < @updatedBefore)"
+        )
+        return [item async for item in self.container_client.query_items(
+            query=query, parameters=parameters, enable_cross_partition_query=True
+        )]
+
+    @tracked("get_conversation")
+    async def get_conversation(self, user_id, conversation_id):
+        try:
+            conversation = await self.container_client.read_item(
+                item=conversation_id, partition_key=self.partition_key(user_id, conversation_id)
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            conversation = None
+
+        if conversation and conversation.get('type') == 'conversation' and conversation.get('userId') == user_id:
+            return conversation
 
         ## if no conversations are found, return None
-        if len(conversations) == 0:
-            return None
-        else:
-            return conversations[0]
- 
+        if self.fallback:
+            return await self.fallback.get_conversation(user_id, conversation_id)
+        return None
+
+    @tracked("create_message")
     async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
-        message = {
-            'id': uuid,
-            'type': 'message',
-            'userId' : user_id,
-            'createdAt': datetime.utcnow().isoformat(),
-            'updatedAt': datetime.utcnow().isoformat(),
-            'conversationId' : conversation_id,
-            'role': input_message['role'],
-            'content': input_message['content']
-        }
+        message = self.build_message(uuid, conversation_id, user_id, input_message)
+        if self.conversation_index_enabled:
+            ## the index takes last activity from the message itself, only check the conversation exists
+            if not await self.get_conversation(user_id, conversation_id):
+                return "Conversation not found"
+        ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
+        elif not await self.touch_conversation(user_id, conversation_id, message['createdAt']):
+            return "Conversation not found"
 
-        if self.enable_message_feedback:
-            message['feedback'] = ''
-        
-        resp = await self.container_client.upsert_item(message)  
+        resp = await self.container_client.upsert_item(message)
         if resp:
-            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = await self.get_conversation(user_id, conversation_id)
-            if not conversation:
-                return "Conversation not found"
-            conversation['updatedAt'] = message['createdAt']
-            await self.upsert_conversation(conversation)
-            return resp
-        else:
-            return False
-    
-    async def update_message_feedback(self, user_id, message_id, feedback):
-        message = await self.container_client.read_item(item=message_id, partition_key=user_id)
-        if message:
-            message['feedback'] = feedback
-            resp = await self.container_client.upsert_item(message)
             return resp
         else:
             return False
 
-    async def get_messages(self, user_id, conversation_id):
+    @tracked("touch_conversation")
+    async def touch_conversation(self, user_id, conversation_id, updated_at):
+        ## bump updatedAt without rewriting the whole conversation document
+        try:
+            return await self.container_client.patch_item(
+                item=conversation_id,
+                partition_key=self.partition_key(user_id, conversation_id),
+                patch_operations=[{'op': 'set', 'path': '/updatedAt', 'value': updated_at}]
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            if not self.fallback:
+                return None
+
+        ## the conversation hasn't been migrated yet, adopt it so new writes land in this container
+        conversation = await self.fallback.get_conversation(user_id, conversation_id)
+        if not conversation:
+            return None
+        conversation['updatedAt'] = updated_at
+        return await self.container_client.upsert_item(self.prepare_item(conversation))
+
+    @tracked("execute_batch")
+    async def execute_batch(self, user_id, operations):
+        ## operations are the write-behind queue's serializable ops for one user:
+        ## {'op': 'upsert', 'item': {...}} or {'op': 'touch', 'id': ..., 'updatedAt': ...}
+        ## a transactional batch is limited to one partition, so split them by partition key
+        ## while keeping each partition's operations in order
+        groups = {}
+        for operation in operations:
+            if operation['op'] == 'upsert':
+                partition_key = self.item_partition_key(operation['item'])
+            else:
+                partition_key = self.partition_key(user_id, operation['id'])
+            groups.setdefault(partition_key, []).append(operation)
+
+        results = []
+        for partition_key, group in groups.items():
+            results += await self.execute_partition_batch(user_id, partition_key, group)
+        return results
+
+    async def execute_partition_batch(self, user_id, partition_key, operations):
+        execute_item_batch = getattr(self.container_client, 'execute_item_batch', None)
+        if execute_item_batch and len(operations) > 1:
+            batch = []
+            for operation in operations:
+                if operation['op'] == 'upsert':
+                    batch.append(('upsert', (operation['item'],)))
+                else:
+                    batch.append(('patch', (operation['id'], [{'op': 'set', 'path': '/updatedAt', 'value': operation['updatedAt']}])))
+            return await execute_item_batch(batch_operations=batch, partition_key=partition_key)
+
+        ## a single operation needs no transaction (execute_item_batch is azure-cosmos 4.7.0+)
+        results = []
+        for operation in operations:
+            if operation['op'] == 'upsert':
+                results.append(await self.container_client.upsert_item(operation['item']))
+            else:
+                results.append(await self.touch_conversation(user_id, operation['id'], operation['updatedAt']))
+        return results
+
+    async def find_message(self, user_id, message_id, conversation_id = None):
+        if conversation_id is not None or not self.partition_strategy.conversation_scoped:
+            try:
+                message = await self.container_client.read_item(
+                    item=message_id, partition_key=self.partition_key(user_id, conversation_id)
+                )
+            except exceptions.CosmosResourceNotFoundError:
+                return None
+            return message if message.get('type') == 'message' and message.get('userId') == user_id else None
+
+        ## the message's partition depends on a conversation the caller didn't give us
+        parameters = [
+            {
+                'name': '@messageId',
+                'value': message_id
+            },
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = "SELECT * FROM c WHERE c.id = @messageId AND c.type='message' AND c.userId = @userId"
+        messages = await self.query_user_items(query, parameters, user_id)
+        return messages[0] if messages else None
+
+    async def update_message_feedback(self, user_id, message_id, feedback, conversation_id = None):
+        updated = await self.update_messages_feedback(user_id, [(message_id, feedback, conversation_id)])
+        return updated[0] if updated else False
+
+    @tracked("update_messages_feedback")
+    async def update_messages_feedback(self, user_id, ratings):
+        ## patch every message at once, then each touched conversation's feedback map in one patch
+        messages = await asyncio.gather(*(
+            self.patch_message_feedback(user_id, message_id, feedback, conversation_id)
+            for message_id, feedback, conversation_id in ratings
+        ))
+        updated = [message for message in messages if message]
+
+        feedback_by_conversation = {}
+        for message in updated:
+            feedback_by_conversation.setdefault(message['conversationId'], {})[message['id']] = message['feedback']
+        await asyncio.gather(*(
+            self.patch_conversation_feedback(user_id, conversation_id, feedback_by_message)
+            for conversation_id, feedback_by_message in feedback_by_conversation.items()
+        ))
+
+        missing = [rating for rating, message in zip(ratings, messages) if not message]
+        if missing and self.fallback:
+            updated += await self.fallback.update_messages_feedback(user_id, missing)
+        return updated
+
+    async def patch_message_feedback(self, user_id, message_id, feedback, conversation_id = None):
+        if conversation_id is None and self.partition_strategy.conversation_scoped:
+            ## the message's partition depends on its conversation, look it up once
+            message = await self.find_message(user_id, message_id)
+            if not message:
+                return None
+            conversation_id = message['conversationId']
+
+        ## the partition key already scopes the read to the user, the predicate keeps it off conversations
+        try:
+            return await self.container_client.patch_item(
+                item=message_id,
+                partition_key=self.partition_key(user_id, conversation_id),
+                patch_operations=[{'op': 'set', 'path': '/feedback', 'value': feedback}],
+                filter_predicate="FROM c WHERE c.type = 'message'",
+            )
+        except (exceptions.CosmosResourceNotFoundError, exceptions.CosmosAccessConditionFailedError):
+            return None
+
+    async def patch_conversation_feedback(self, user_id, conversation_id, feedback_by_message):
+        partition_key = self.partition_key(user_id, conversation_id)
+        operations = [
+            {'op': 'set', 'path': f'/{MESSAGE_FEEDBACK_FIELD}/{message_id}', 'value': feedback}
+            for message_id, feedback in feedback_by_message.items()
+        ]
+        for start in range(0, len(operations), MAX_PATCH_OPERATIONS):
+            chunk = operations[start:start + MAX_PATCH_OPERATIONS]
+            try:
+                await self.container_client.patch_item(item=conversation_id, partition_key=partition_key, patch_operations=chunk)
+            except exceptions.CosmosResourceNotFoundError:
+                logger.warning(f"Conversation {conversation_id} not found, feedback aggregate not updated")
+                return
+            except exceptions.CosmosHttpResponseError as e:
+                if e.status_code != 400:
+                    raise
+                ## conversations created before feedback aggregates have no map to set into yet
+                try:
+                    await self.container_client.patch_item(
+                        item=conversation_id,
+                        partition_key=partition_key,
+                        patch_operations=[{'op': 'add', 'path': f'/{MESSAGE_FEEDBACK_FIELD}', 'value': {}}],
+                        filter_predicate=f"FROM c WHERE NOT IS_DEFINED(c.{MESSAGE_FEEDBACK_FIELD})",
+                    )
+                except exceptions.CosmosAccessConditionFailedError:
+                    ## a concurrent rating added it first
+                    pass
+                await self.container_client.patch_item(item=conversation_id, partition_key=partition_key, patch_operations=chunk)
+
+    async def query_messages(self, user_id, conversation_id):
         parameters = [
             {
                 'name': '@conversationId',
@@ -174,10 +541,83 @@ class CosmosConversationClient():
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
+        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.createdAt ASC"
         messages = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
+        async for item in self.container_client.query_items(
+            query=query, parameters=parameters, partition_key=self.partition_key(user_id, conversation_id)
+        ):
             messages.append(item)
 
         return messages
 
+    @tracked("get_changes")
+    async def get_changes(self, user_id, since = None):
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = "SELECT * FROM c WHERE c.userId = @userId AND (c.type = 'conversation' OR c.type = 'message')"
+        if since is not None:
+            query += " AND c._ts >= @since"
+            parameters.append({'name': '@since', 'value': since})
+        documents = await self.query_user_items(query, parameters, user_id)
+        if self.fallback:
+            documents = merge_documents(documents, await self.fallback.get_changes(user_id, since))
+
+        return [decode_message(document) if document['type'] == 'message' else document for document in documents]
+
+    @tracked("get_messages")
+    async def get_messages(self, user_id, conversation_id):
+        messages = await self.query_messages(user_id, conversation_id)
+        if self.fallback:
+            legacy_messages = await self.fallback.get_messages(user_id, conversation_id)
+            if legacy_messages:
+                messages = merge_documents(messages, legacy_messages)
+                messages.sort(key=lambda message: message['createdAt'])
+
+        return [decode_message(message) for message in messages]
+
+    ## conversation index and change feed checkpoint, see backend/history/conversationindex.py
+
+    @tracked("read_conversation_index")
+    async def read_conversation_index(self, user_id):
+        try:
+            return await self.container_client.read_item(
+                item=CONVERSATION_INDEX_ID, partition_key=self.partition_key(user_id, CONVERSATION_INDEX_ID)
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+    @tracked("write_conversation_index")
+    async def write_conversation_index(self, index):
+        ## optimistic concurrency: fails with 412 (or 409 on create) if another writer got there first
+        index.update(self.partition_fields(index['userId'], CONVERSATION_INDEX_ID))
+        if '_etag' not in index:
+            return await self.container_client.create_item(body=index)
+        return await self.container_client.replace_item(
+            item=index['id'],
+            body=strip_system_properties(index),
+            etag=index['_etag'],
+            match_condition=MatchConditions.IfNotModified,
+        )
+
+    async def read_change_feed_checkpoint(self):
+        try:
+            checkpoint = await self.container_client.read_item(
+                item=CHECKPOINT_ID, partition_key=self.partition_key(CHECKPOINT_USER_ID, CHECKPOINT_ID)
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            return {}
+        return checkpoint.get('continuations', {})
+
+    async def write_change_feed_checkpoint(self, continuations):
+        checkpoint = {
+            'id': CHECKPOINT_ID,
+            'type': CHECKPOINT_TYPE,
+            'userId': CHECKPOINT_USER_ID,
+            'continuations': continuations,
+        }
+        checkpoint.update(self.partition_fields(CHECKPOINT_USER_ID, CHECKPOINT_ID))
+        await self.container_client.upsert_item(checkpoint)
@@ -0,0 +1,201 @@
+import time
+import logging
+import functools
+import threading
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+from azure.cosmos import exceptions
+from opentelemetry import metrics
+
+logger = logging.getLogger(__name__)
+
+REQUEST_CHARGE_HEADER = "x-ms-request-charge"
+## responses the SDK retries on its own before surfacing a result or an error
+RETRIED_STATUS_CODES = {408, 410, 429, 449, 503}
+BACKGROUND_ROUTE = "background"
+
+_meter = metrics.get_meter(__name__)
+_request_charge_counter = _meter.create_counter(
+    "cosmos.request_charge", unit="RU", description="Request units consumed by history operations"
+)
+_duration_histogram = _meter.create_histogram(
+    "cosmos.operation.duration", unit="ms", description="Latency of history operations including SDK retries"
+)
+_retry_counter = _meter.create_counter(
+    "cosmos.retries", description="Retryable HTTP responses (throttling, timeouts) seen by history operations"
+)
+_throttle_counter = _meter.create_counter(
+    "cosmos.throttled_requests", description="HTTP 429 responses returned to history operations"
+)
+
+_current_route: ContextVar[Optional[str]] = ContextVar("cosmos_route", default=None)
+_current_request: ContextVar[Optional["RequestCharges"]] = ContextVar("cosmos_request_charges", default=None)
+_current_operation: ContextVar[Optional["OperationCharge"]] = ContextVar("cosmos_operation", default=None)
+
+
+class OperationCharge():
+    __slots__ = ("operation", "request_charge", "requests", "retries", "throttles")
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.request_charge = 0.0
+        self.requests = 0
+        self.retries = 0
+        self.throttles = 0
+
+
+class RequestCharges():
+    """Cosmos totals for one HTTP request to the app."""
+
+    def __init__(self, route: str):
+        self.route = route
+        self.request_charge = 0.0
+        self.latency_ms = 0.0
+        self.operations = 0
+        self.retries = 0
+        self.throttles = 0
+
+    def add(self, charge: OperationCharge, latency_ms: float):
+        self.request_charge += charge.request_charge
+        self.latency_ms += latency_ms
+        self.operations += 1
+        self.retries += charge.retries
+        self.throttles += charge.throttles
+
+    def as_headers(self) -> Dict[str, str]:
+        return {
+            "X-Cosmos-Request-Charge": f"{self.request_charge:.2f}",
+            "X-Cosmos-Latency-Ms": f"{self.latency_ms:.1f}",
+            "X-Cosmos-Operations": str(self.operations),
+            "X-Cosmos-Retries": str(self.retries),
+            "X-Cosmos-Throttled": str(self.throttles),
+        }
+
+
+class _OperationStats():
+    __slots__ = ("count", "errors", "request_charge", "latency_ms", "max_latency_ms", "retries", "throttles")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.request_charge = 0.0
+        self.latency_ms = 0.0
+        self.max_latency_ms = 0.0
+        self.retries = 0
+        self.throttles = 0
+
+
+_aggregates: Dict[Tuple[str, str], _OperationStats] = {}
+_aggregates_lock = threading.Lock()
+
+
+def begin_request(route: str) -> RequestCharges:
+    charges = RequestCharges(route)
+    _current_route.set(route)
+    _current_request.set(charges)
+    return charges
+
+
+def current_request_charges() -> Optional[RequestCharges]:
+    return _current_request.get()
+
+
+def raw_response_hook(pipeline_response):
+    ## invoked by the SDK pipeline for every HTTP response, including throttled attempts
+    charge = _current_operation.get()
+    if charge is None:
+        return
+
+    http_response = pipeline_response.http_response
+    try:
+        charge.request_charge += float(http_response.headers.get(REQUEST_CHARGE_HEADER) or 0)
+    except ValueError:
+        pass
+    charge.requests += 1
+    if http_response.status_code in RETRIED_STATUS_CODES:
+        charge.retries += 1
+    if http_response.status_code == 429:
+        charge.throttles += 1
+
+
+def _record(route: str, charge: OperationCharge, latency_ms: float, failed: bool):
+    attributes = {"route": route, "operation": charge.operation}
+    _request_charge_counter.add(charge.request_charge, attributes)
+    _duration_histogram.record(latency_ms, attributes)
+    if charge.retries:
+        _retry_counter.add(charge.retries, attributes)
+    if charge.throttles:
+        _throttle_counter.add(charge.throttles, attributes)
+
+    with _aggregates_lock:
+        stats = _aggregates.setdefault((route, charge.operation), _OperationStats())
+        stats.count += 1
+        stats.errors += 1 if failed else 0
+        stats.request_charge += charge.request_charge
+        stats.latency_ms += latency_ms
+        stats.max_latency_ms = max(stats.max_latency_ms, latency_ms)
+        stats.retries += charge.retries
+        stats.throttles += charge.throttles
+
+    request_charges = _current_request.get()
+    if request_charges is not None:
+        request_charges.add(charge, latency_ms)
+
+    logger.debug(
+        f"Cosmos {charge.operation} for {route}: {charge.request_charge:.2f} RU, "
+        f"{latency_ms:.1f} ms, {charge.retries} retries, {charge.throttles} throttled"
+    )
+
+
+@asynccontextmanager
+async def track_operation(operation: str):
+    ## nested client calls (e.g. create_message reading the conversation) count toward the outer operation
+    if _current_operation.get() is not None:
+        yield _current_operation.get()
+        return
+
+    charge = OperationCharge(operation)
+    token = _current_operation.set(charge)
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield charge
+    except exceptions.CosmosHttpResponseError:
+        failed = True
+        raise
+    finally:
+        _current_operation.reset(token)
+        _record(_current_route.get() or BACKGROUND_ROUTE, charge, (time.perf_counter() - start) * 1000, failed)
+
+
+def tracked(operation: str):
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            async with track_operation(operation):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def snapshot() -> list:
+    with _aggregates_lock:
+        items = list(_aggregates.items())
+
+    results = []
+    for (route, operation), stats in items:
+        results.append({
+            "route": route,
+            "operation": operation,
+            "count": stats.count,
+            "errors": stats.errors,
+            "request_charge": round(stats.request_charge, 2),
+            "avg_request_charge": round(stats.request_charge / stats.count, 2) if stats.count else 0,
+            "avg_latency_ms": round(stats.latency_ms / stats.count, 1) if stats.count else 0,
+            "max_latency_ms": round(stats.max_latency_ms, 1),
+            "retries": stats.retries,
+            "throttles": stats.throttles,
+        })
+    return sorted(results, key=lambda r: r["request_charge"], reverse=True)
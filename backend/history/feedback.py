@@ -0,0 +1,36 @@
+from typing import Dict
+
+## on a conversation document, message id -> that message's current feedback
+MESSAGE_FEEDBACK_FIELD = "messageFeedback"
+POSITIVE_FEEDBACK = "positive"
+## what the frontend sends when a rating is withdrawn
+NEUTRAL_FEEDBACK = "neutral"
+NEGATIVE_FEEDBACK = "negative"
+## ratings accepted by one /history/message_feedback/batch call
+MAX_FEEDBACK_BATCH_SIZE = 100
+## Cosmos rejects a patch with more operations than this
+MAX_PATCH_OPERATIONS = 10
+
+
+def feedback_summary(conversation: dict) -> Dict:
+    """
+    Aggregate a conversation's message ratings.
+
+    Negative feedback arrives as the comma separated reasons the user
+    ticked (``missing_citation,wrong_citation``), each counted under
+    ``reasons``. Neutral or empty feedback is a withdrawn rating and isn't
+    counted.
+    """
+    summary = {POSITIVE_FEEDBACK: 0, NEGATIVE_FEEDBACK: 0, 'reasons': {}}
+    for feedback in (conversation.get(MESSAGE_FEEDBACK_FIELD) or {}).values():
+        if not feedback or feedback == NEUTRAL_FEEDBACK:
+            continue
+        if feedback == POSITIVE_FEEDBACK:
+            summary[POSITIVE_FEEDBACK] += 1
+            continue
+        summary[NEGATIVE_FEEDBACK] += 1
+        for reason in feedback.split(','):
+            reason = reason.strip()
+            if reason and reason != NEGATIVE_FEEDBACK:
+                summary['reasons'][reason] = summary['reasons'].get(reason, 0) + 1
+    return summary
@@ -0,0 +1,59 @@
+from typing import List
+
+## composite indexes for the two query shapes the history routes run:
+##   get_conversations: userId = @ AND type = 'conversation' ORDER BY updatedAt
+##   get_messages:      conversationId = @ AND type = 'message' AND userId = @ ORDER BY createdAt
+HISTORY_COMPOSITE_INDEXES = [
+    [
+        {"path": "/userId", "order": "ascending"},
+        {"path": "/type", "order": "ascending"},
+        {"path": "/updatedAt", "order": "descending"},
+    ],
+    [
+        {"path": "/userId", "order": "ascending"},
+        {"path": "/type", "order": "ascending"},
+        {"path": "/updatedAt", "order": "ascending"},
+    ],
+    [
+        {"path": "/conversationId", "order": "ascending"},
+        {"path": "/type", "order": "ascending"},
+        {"path": "/userId", "order": "ascending"},
+        {"path": "/createdAt", "order": "ascending"},
+    ],
+]
+
+## large or free-form properties nothing filters or sorts on; messageFeedback is the
+## conversation's message id -> feedback map (backend/history/feedback.py)
+HISTORY_EXCLUDED_PATHS = ["/content/*", "/feedback/?", "/messageFeedback/*", "/\"_etag\"/?"]
+
+HISTORY_INDEXING_POLICY = {
+    "indexingMode": "consistent",
+    "automatic": True,
+    "includedPaths": [{"path": "/*"}],
+    "excludedPaths": [{"path": path} for path in HISTORY_EXCLUDED_PATHS],
+    "compositeIndexes": HISTORY_COMPOSITE_INDEXES,
+}
+
+
+def _composite_key(composite_index: list) -> tuple:
+    return tuple((entry["path"], entry.get("order", "ascending")) for entry in composite_index)
+
+
+def indexing_policy_problems(indexing_policy: dict) -> List[str]:
+    """Differences between a container's indexing policy and what the history queries need."""
+    problems = []
+    if indexing_policy.get("indexingMode", "consistent").lower() != "consistent":
+        problems.append(f"indexing mode is {indexing_policy.get('indexingMode')}, expected consistent")
+
+    existing = {_composite_key(index) for index in indexing_policy.get("compositeIndexes", [])}
+    for composite_index in HISTORY_COMPOSITE_INDEXES:
+        if _composite_key(composite_index) not in existing:
+            paths = ", ".join(f"{path} {order}" for path, order in _composite_key(composite_index))
+            problems.append(f"missing composite index ({paths})")
+
+    excluded = {entry["path"] for entry in indexing_policy.get("excludedPaths", [])}
+    for path in HISTORY_EXCLUDED_PATHS:
+        if path not in excluded:
+            problems.append(f"{path} is indexed")
+
+    return problems
@@ -0,0 +1,120 @@
+import zlib
+from abc import ABC, abstractmethod
+from typing import List, Optional
+
+
+class PartitionStrategy(ABC):
+    """
+    Decides who a history document belongs to and which logical partition it
+    lives in.
+
+    ``user_key`` picks the identity stored in ``userId``. ``partition_key``
+    returns the value passed to the SDK for a document of that user and
+    conversation. ``document_fields`` returns any extra properties the
+    container's partition key path needs.
+    """
+
+    name: str = ""
+    partition_key_path: str = "/userId"
+    ## True when the partition key depends on the conversation, so single-document
+    ## operations need the conversation id to find the document
+    conversation_scoped: bool = False
+
+    @abstractmethod
+    def user_key(self, authenticated_user: dict) -> str:
+        pass
+
+    def partition_key(self, user_id: str, conversation_id: Optional[str] = None) -> str:
+        return user_id
+
+    def document_fields(self, user_id: str, conversation_id: Optional[str] = None) -> dict:
+        return {}
+
+    def user_partition_keys(self, user_id: str) -> Optional[List[str]]:
+        ## partitions holding all of a user's documents, None means a cross-partition query
+        return [user_id]
+
+
+class ClientIpPartitionStrategy(PartitionStrategy):
+    ## the original scheme; everyone behind one NAT or proxy shares a partition
+    name = "client_ip"
+
+    def user_key(self, authenticated_user: dict) -> str:
+        return authenticated_user["client_ip"]
+
+
+class PrincipalPartitionStrategy(PartitionStrategy):
+    name = "principal"
+
+    def user_key(self, authenticated_user: dict) -> str:
+        return authenticated_user["user_principal_id"]
+
+
+class HierarchicalPartitionStrategy(PrincipalPartitionStrategy):
+    """
+    One logical partition per conversation, keyed ``<user>/<conversation>``.
+
+    The composite value is stored in ``partitionKey`` so it works with
+    single-path containers. Listing a user's conversations is a
+    cross-partition query filtered on ``userId``.
+    """
+
+    name = "hierarchical"
+    partition_key_path = "/partitionKey"
+    conversation_scoped = True
+
+    def partition_key(self, user_id: str, conversation_id: Optional[str] = None) -> str:
+        return f"{user_id}/{conversation_id}"
+
+    def document_fields(self, user_id: str, conversation_id: Optional[str] = None) -> dict:
+        return {"partitionKey": self.partition_key(user_id, conversation_id)}
+
+    def user_partition_keys(self, user_id: str) -> Optional[List[str]]:
+        return None
+
+
+class HashedBucketPartitionStrategy(PrincipalPartitionStrategy):
+    """
+    Spreads each user's conversations over ``buckets`` partitions,
+    ``<user>/<crc32(conversation) % buckets>``, so one heavy user cannot
+    exhaust a single partition's throughput. User-wide queries fan out to
+    exactly those buckets.
+    """
+
+    name = "hashed"
+    partition_key_path = "/partitionKey"
+    conversation_scoped = True
+
+    def __init__(self, buckets: int = 16):
+        self.buckets = buckets
+
+    def bucket(self, conversation_id: str) -> int:
+        return zlib.crc32(conversation_id.encode("utf-8")) % self.buckets
+
+    def partition_key(self, user_id: str, conversation_id: Optional[str] = None) -> str:
+        return f"{user_id}/{self.bucket(conversation_id or '')}"
+
+    def document_fields(self, user_id: str, conversation_id: Optional[str] = None) -> dict:
+        return {"partitionKey": self.partition_key(user_id, conversation_id)}
+
+    def user_partition_keys(self, user_id: str) -> Optional[List[str]]:
+        return [f"{user_id}/{bucket}" for bucket in range(self.buckets)]
+
+
+PARTITION_STRATEGIES = {
+    strategy.name: strategy
+    for strategy in (
+        ClientIpPartitionStrategy,
+        PrincipalPartitionStrategy,
+        HierarchicalPartitionStrategy,
+        HashedBucketPartitionStrategy,
+    )
+}
+
+
+def get_partition_strategy(name: str, buckets: int = 16) -> PartitionStrategy:
+    if name not in PARTITION_STRATEGIES:
+        raise ValueError(f"Unknown history partition strategy '{name}'")
+    if name == HashedBucketPartitionStrategy.name:
+        return HashedBucketPartitionStrategy(buckets)
+    return PARTITION_STRATEGIES[name]()
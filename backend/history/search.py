@@ -0,0 +1,303 @@
+import re
+import math
+import time
+import asyncio
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+## BM25 parameters, the usual defaults
+K1 = 1.2
+B = 0.75
+## a prefix expansion counts for less than the exact term the user typed
+PREFIX_WEIGHT = 0.5
+MAX_PREFIX_EXPANSIONS = 50
+## stored per message for snippets; the index itself covers the full text
+SNIPPET_SOURCE_CHARS = 2000
+SNIPPET_CHARS = 160
+INDEXED_ROLES = ("user", "assistant")
+## changes are read from a little before the watermark: _ts has one second resolution and
+## a write can commit with a _ts just below one already read
+WATERMARK_OVERLAP = 5
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if len(token) > 1 or token.isdigit()]
+
+
+def message_text(content) -> str:
+    ## multimodal messages store a list of parts
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content if isinstance(content, str) else ""
+
+
+class _Document():
+    __slots__ = ("conversation_id", "message_id", "terms", "length", "text", "created_at")
+
+    def __init__(self, conversation_id, message_id, terms, length, text, created_at):
+        self.conversation_id = conversation_id
+        self.message_id = message_id
+        self.terms = terms
+        self.length = length
+        self.text = text
+        self.created_at = created_at
+
+
+class _ConversationState():
+    __slots__ = ("title", "updated_at", "archived", "documents")
+
+    def __init__(self, title, updated_at, archived=False):
+        self.title = title
+        self.updated_at = updated_at
+        self.archived = archived
+        self.documents = set()
+
+
+class UserSearchIndex():
+    """
+    Inverted index over one user's conversation titles and messages.
+
+    Each message (and each conversation title) is a document. Postings map a
+    term to ``{document id: term frequency}``; a sorted term list, rebuilt
+    lazily after changes, serves prefix lookups with a binary search.
+    """
+
+    def __init__(self):
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.documents: Dict[str, _Document] = {}
+        self.conversations: Dict[str, _ConversationState] = {}
+        self.total_length = 0
+        self.caught_up_at = 0.0
+        self.reconciled_at = 0.0
+        ## largest _ts of the documents read so far, None until the first load
+        self.watermark = None
+        self._sorted_terms: Optional[List[str]] = None
+
+    def add(self, document_id, conversation_id, text, created_at = None, message_id = None):
+        self.remove(document_id)
+        tokens = tokenize(text)
+        frequencies = {}
+        for token in tokens:
+            frequencies[token] = frequencies.get(token, 0) + 1
+        for token, frequency in frequencies.items():
+            if token not in self.postings:
+                self.postings[token] = {}
+                self._sorted_terms = None
+            self.postings[token][document_id] = frequency
+
+        self.documents[document_id] = _Document(
+            conversation_id, message_id, tuple(frequencies), len(tokens), text[:SNIPPET_SOURCE_CHARS], created_at
+        )
+        self.total_length += len(tokens)
+        state = self.conversations.setdefault(conversation_id, _ConversationState("", created_at or ""))
+        state.documents.add(document_id)
+        if created_at and created_at > state.updated_at:
+            state.updated_at = created_at
+
+    def remove(self, document_id):
+        document = self.documents.pop(document_id, None)
+        if document is None:
+            return
+        self.total_length -= document.length
+        for token in document.terms:
+            postings = self.postings.get(token)
+            if postings and postings.pop(document_id, None) is not None and not postings:
+                del self.postings[token]
+                self._sorted_terms = None
+        state = self.conversations.get(document.conversation_id)
+        if state:
+            state.documents.discard(document_id)
+
+    def remove_conversation(self, conversation_id):
+        state = self.conversations.pop(conversation_id, None)
+        if state:
+            for document_id in list(state.documents):
+                self.remove(document_id)
+
+    def set_title(self, conversation_id, title, updated_at = ""):
+        self.add(f"title:{conversation_id}", conversation_id, title or "")
+        state = self.conversations[conversation_id]
+        state.title = title or ""
+        if updated_at > state.updated_at:
+            state.updated_at = updated_at
+
+    def _expand(self, token) -> Dict[str, float]:
+        ## the exact term at full weight, longer terms starting with it at PREFIX_WEIGHT
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self.postings)
+        terms = {}
+        start = bisect_left(self._sorted_terms, token)
+        for term in self._sorted_terms[start:start + MAX_PREFIX_EXPANSIONS]:
+            if not term.startswith(token):
+                break
+            terms[term] = 1.0 if term == token else PREFIX_WEIGHT
+        return terms
+
+    def search(self, query: str, limit: int = 20) -> List[dict]:
+        if not self.documents:
+            return []
+
+        document_count = len(self.documents)
+        average_length = self.total_length / document_count or 1
+        scores: Dict[str, float] = {}
+        matched_terms: Dict[str, str] = {}
+        for token in set(tokenize(query)):
+            for term, weight in self._expand(token).items():
+                postings = self.postings[term]
+                idf = math.log(1 + (document_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for document_id, frequency in postings.items():
+                    length = self.documents[document_id].length
+                    score = idf * frequency * (K1 + 1) / (frequency + K1 * (1 - B + B * length / average_length))
+                    scores[document_id] = scores.get(document_id, 0.0) + weight * score
+                    matched_terms.setdefault(document_id, term)
+
+        ## one result per conversation, represented by its best matching message
+        best: Dict[str, tuple] = {}
+        for document_id, score in scores.items():
+            conversation_id = self.documents[document_id].conversation_id
+            if conversation_id not in best or score > best[conversation_id][0]:
+                best[conversation_id] = (score, document_id)
+
+        results = []
+        for conversation_id, (score, document_id) in sorted(best.items(), key=lambda item: item[1][0], reverse=True)[:limit]:
+            document = self.documents[document_id]
+            state = self.conversations.get(conversation_id)
+            results.append({
+                "conversation_id": conversation_id,
+                "title": state.title if state else "",
+                "message_id": document.message_id,
+                "createdAt": document.created_at,
+                "score": round(score, 4),
+                "snippet": snippet(document.text, matched_terms[document_id]),
+            })
+        return results
+
+
+def snippet(text: str, term: str) -> str:
+    position = text.lower().find(term)
+    start = max(0, position - SNIPPET_CHARS // 3) if position >= 0 else 0
+    fragment = text[start:start + SNIPPET_CHARS]
+    return ("…" if start else "") + fragment + ("…" if start + SNIPPET_CHARS < len(text) else "")
+
+
+class HistorySearchIndex():
+    """
+    Per-worker cache of ``UserSearchIndex`` objects, least recently used
+    evicted beyond ``max_users``.
+
+    The message write path updates a cached index directly, so a worker
+    sees its own writes at once. Writes that went through other workers are
+    picked up on the next search, at most every ``catch_up_interval``
+    seconds per user, by reading only the documents written since the
+    index's watermark (the largest ``_ts`` it has seen). A cold index loads
+    everything in that same single query. Deletes leave nothing to read, so
+    conversations deleted elsewhere are dropped by a full listing every
+    ``reconcile_interval`` seconds.
+    """
+
+    def __init__(self, max_users: int = 256, catch_up_interval: float = 5.0, reconcile_interval: float = 300.0):
+        self.max_users = max_users
+        self.catch_up_interval = catch_up_interval
+        self.reconcile_interval = reconcile_interval
+        self._indexes: "OrderedDict[str, UserSearchIndex]" = OrderedDict()
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def _cached(self, user_id) -> Optional[UserSearchIndex]:
+        index = self._indexes.get(user_id)
+        if index is not None:
+            self._indexes.move_to_end(user_id)
+        return index
+
+    def _cache(self, user_id, index):
+        self._indexes[user_id] = index
+        while len(self._indexes) > self.max_users:
+            evicted, _ = self._indexes.popitem(last=False)
+            self._locks.pop(evicted, None)
+
+    async def search(self, client, user_id, query, limit = 20) -> List[dict]:
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            index = self._cached(user_id)
+            if index is None:
+                index = UserSearchIndex()
+                self._cache(user_id, index)
+            if time.monotonic() - index.caught_up_at >= self.catch_up_interval:
+                await self._catch_up(client, user_id, index)
+            if time.monotonic() - index.reconciled_at >= self.reconcile_interval:
+                await self._reconcile(client, user_id, index)
+        return index.search(query, limit)
+
+    async def _catch_up(self, client, user_id, index):
+        since = index.watermark - WATERMARK_OVERLAP if index.watermark is not None else None
+        caught_up_at = time.monotonic()
+        documents = await client.get_changes(user_id, since)
+
+        ## conversations first, so their archive state decides whether their messages are indexed
+        for conversation in [document for document in documents if document['type'] == 'conversation']:
+            await self._apply_conversation(client, user_id, index, conversation)
+        for message in [document for document in documents if document['type'] == 'message']:
+            state = index.conversations.get(message['conversationId'])
+            if state is None or not state.archived:
+                self._add_message(index, message['conversationId'], message)
+
+        index.watermark = max([document.get('_ts', 0) for document in documents] + [index.watermark or 0])
+        index.caught_up_at = caught_up_at
+        if since is None:
+            ## a full load already lists exactly the live conversations
+            index.reconciled_at = caught_up_at
+
+    async def _apply_conversation(self, client, user_id, index, conversation):
+        conversation_id = conversation['id']
+        archived = bool(conversation.get('archived'))
+        state = index.conversations.get(conversation_id)
+        if state is not None and archived != state.archived:
+            if archived:
+                ## archived messages aren't in the store; the title stays searchable
+                self.messages_cleared(user_id, conversation_id, index)
+            else:
+                ## rehydrated, its messages may have been written (and skipped) before the conversation
+                async for message in client.iter_messages(user_id, conversation_id):
+                    self._add_message(index, conversation_id, message)
+        index.set_title(conversation_id, conversation.get('title', ''), conversation['updatedAt'])
+        index.conversations[conversation_id].archived = archived
+
+    async def _reconcile(self, client, user_id, index):
+        reconciled_at = time.monotonic()
+        live = {conversation['id'] for conversation in await client.get_conversations(user_id, limit=None)}
+        for conversation_id in [key for key in index.conversations if key not in live]:
+            index.remove_conversation(conversation_id)
+        index.reconciled_at = reconciled_at
+
+    @staticmethod
+    def _add_message(index, conversation_id, message):
+        if message.get('role') in INDEXED_ROLES:
+            index.add(
+                message['id'], conversation_id, message_text(message.get('content')),
+                created_at=message.get('createdAt'), message_id=message['id']
+            )
+
+    ## write path hooks, only users already cached are updated
+
+    def message_added(self, user_id, conversation_id, message):
+        index = self._indexes.get(user_id)
+        if index is not None:
+            self._add_message(index, conversation_id, message)
+
+    def conversation_added(self, user_id, conversation):
+        index = self._indexes.get(user_id)
+        if index is not None:
+            index.set_title(conversation['id'], conversation.get('title', ''), conversation.get('updatedAt', ''))
+
+    def conversation_deleted(self, user_id, conversation_id):
+        index = self._indexes.get(user_id)
+        if index is not None:
+            index.remove_conversation(conversation_id)
+
+    def messages_cleared(self, user_id, conversation_id, index = None):
+        index = index or self._indexes.get(user_id)
+        if index is not None and conversation_id in index.conversations:
+            state = index.conversations[conversation_id]
+            for document_id in [key for key in state.documents if not key.startswith("title:")]:
+                index.remove(document_id)
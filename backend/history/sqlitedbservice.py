@@ -0,0 +1,282 @@
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from backend.history.storage import HistoryStorage
+from backend.history.compression import ContentCompression, decode_message
+from backend.history.feedback import MESSAGE_FEEDBACK_FIELD
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    user_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    document TEXT NOT NULL,
+    PRIMARY KEY (user_id, id)
+);
+CREATE INDEX IF NOT EXISTS ix_conversations_user_updated ON conversations (user_id, updated_at);
+
+CREATE TABLE IF NOT EXISTS messages (
+    user_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    conversation_id TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    document TEXT NOT NULL,
+    PRIMARY KEY (user_id, id)
+);
+CREATE INDEX IF NOT EXISTS ix_messages_conversation_created ON messages (conversation_id, created_at);
+"""
+
+## a fresh _etag for a conversation document and the _ts of a write, as Cosmos assigns on every write
+NEW_ETAG_SQL = "lower(hex(randomblob(16)))"
+NOW_TS_SQL = "((julianday('now') - 2440587.5) * 86400.0)"
+
+
+class SqliteConversationClient(HistoryStorage):
+    """
+    Embedded chat history store for load tests and small deployments.
+
+    The database runs in WAL mode so readers don't block the writer, and
+    every call runs on a small thread pool (one connection per thread) to
+    keep sqlite3 off the event loop.
+    """
+
+    def __init__(self, database_path: str, enable_message_feedback: bool = False, max_workers: int = 4,
+                 content_compression: ContentCompression = None):
+        self.database_path = database_path
+        self.enable_message_feedback = enable_message_feedback
+        self.content_compression = content_compression
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="history-sqlite")
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+        connection = self._connect()
+        connection.executescript(SCHEMA)
+
+    def _connect(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_path, timeout=30, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    async def _read(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(self._call_read, fn, *args))
+
+    async def _write(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(self._call_write, fn, *args))
+
+    def _call_read(self, fn, *args):
+        return fn(self._connect(), *args)
+
+    def _call_write(self, fn, *args):
+        ## take the write lock up front, a deferred transaction that upgrades later
+        ## fails with "database is locked" instead of waiting on the busy timeout
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(connection, *args)
+            connection.execute("COMMIT")
+            return result
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    async def ensure(self):
+        try:
+            await self._read(lambda connection: connection.execute("SELECT 1 FROM conversations LIMIT 1").fetchall())
+        except sqlite3.Error as e:
+            return False, f"SQLite history database {self.database_path} is not usable: {e}"
+
+        return True, "SQLite history store initialized successfully"
+
+    async def close(self):
+        self._executor.shutdown(wait=True)
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+
+    ## synchronous helpers, always called on the executor
+
+    @staticmethod
+    def _upsert(connection, item):
+        if item['type'] == 'conversation':
+            item = {**item, '_etag': uuid.uuid4().hex, '_ts': time.time()}
+            connection.execute(
+                "INSERT OR REPLACE INTO conversations (user_id, id, created_at, updated_at, document) VALUES (?, ?, ?, ?, ?)",
+                (item['userId'], item['id'], item['createdAt'], item['updatedAt'], json.dumps(item))
+            )
+        else:
+            item = {**item, '_ts': time.time()}
+            connection.execute(
+                "INSERT OR REPLACE INTO messages (user_id, id, conversation_id, created_at, document) VALUES (?, ?, ?, ?, ?)",
+                (item['userId'], item['id'], item['conversationId'], item['createdAt'], json.dumps(item))
+            )
+        return item
+
+    @staticmethod
+    def _touch(connection, user_id, conversation_id, updated_at):
+        cursor = connection.execute(
+            "UPDATE conversations SET updated_at = ?, "
+            f"document = json_set(document, '$.updatedAt', ?, '$._etag', {NEW_ETAG_SQL}, '$._ts', {NOW_TS_SQL}) "
+            "WHERE user_id = ? AND id = ?",
+            (updated_at, updated_at, user_id, conversation_id)
+        )
+        return cursor.rowcount > 0
+
+    @staticmethod
+    def _read_conversation(connection, user_id, conversation_id):
+        row = connection.execute(
+            "SELECT document FROM conversations WHERE user_id = ? AND id = ?", (user_id, conversation_id)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    ## HistoryStorage
+
+    async def create_conversation(self, user_id, title = ''):
+        conversation = self.build_conversation(user_id, title)
+        return await self._write(self._upsert, conversation)
+
+    async def upsert_conversation(self, conversation):
+        return await self._write(self._upsert, conversation)
+
+    async def delete_conversation(self, user_id, conversation_id):
+        def delete(connection):
+            connection.execute("DELETE FROM conversations WHERE user_id = ? AND id = ?", (user_id, conversation_id))
+            return True
+        return await self._write(delete)
+
+    async def replace_conversation(self, conversation, etag):
+        def replace(connection):
+            current = self._read_conversation(connection, conversation['userId'], conversation['id'])
+            if current is None or current.get('_etag') != etag:
+                return None
+            return self._upsert(connection, conversation)
+        return await self._write(replace)
+
+    async def delete_message_ids(self, user_id, conversation_id, message_ids):
+        def delete(connection):
+            connection.executemany(
+                "DELETE FROM messages WHERE user_id = ? AND conversation_id = ? AND id = ?",
+                [(user_id, conversation_id, message_id) for message_id in message_ids]
+            )
+        await self._write(delete)
+
+    async def delete_messages(self, conversation_id, user_id):
+        def delete(connection):
+            rows = connection.execute(
+                "SELECT id FROM messages WHERE conversation_id = ? AND user_id = ?", (conversation_id, user_id)
+            ).fetchall()
+            connection.execute("DELETE FROM messages WHERE conversation_id = ? AND user_id = ?", (conversation_id, user_id))
+            return [row[0] for row in rows]
+        return await self._write(delete)
+
+    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        sort_order = 'ASC' if str(sort_order).upper() == 'ASC' else 'DESC'
+        query = f"SELECT document FROM conversations WHERE user_id = ? ORDER BY updated_at {sort_order}"
+        parameters = [user_id]
+        if limit is not None:
+            query += " LIMIT ? OFFSET ?"
+            parameters += [int(limit), int(offset)]
+
+        def select(connection):
+            return [json.loads(row[0]) for row in connection.execute(query, parameters)]
+        return await self._read(select)
+
+    async def get_idle_conversations(self, updated_before, limit):
+        def select(connection):
+            rows = connection.execute(
+                "SELECT document FROM conversations WHERE updated_at < ? AND json_extract(document, '$.archived') IS NULL "
+                "AND coalesce(json_extract(document, '$.lastAccessedAt'), '') < ? ORDER BY updated_at LIMIT ?",
+                (updated_before, updated_before, int(limit))
+            )
+            return [json.loads(row[0]) for row in rows]
+        return await self._read(select)
+
+    async def get_conversation(self, user_id, conversation_id):
+        return await self._read(self._read_conversation, user_id, conversation_id)
+
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+        message = self.build_message(uuid, conversation_id, user_id, input_message)
+
+        def create(connection):
+            ## update the parent conversation's updatedAt together with the message insert
+            if not self._touch(connection, user_id, conversation_id, message['createdAt']):
+                return "Conversation not found"
+            return self._upsert(connection, message)
+        return await self._write(create)
+
+    async def touch_conversation(self, user_id, conversation_id, updated_at):
+        return await self._write(self._touch, user_id, conversation_id, updated_at)
+
+    async def execute_batch(self, user_id, operations):
+        def execute(connection):
+            results = []
+            for operation in operations:
+                if operation['op'] == 'upsert':
+                    results.append(self._upsert(connection, operation['item']))
+                else:
+                    results.append(self._touch(connection, user_id, operation['id'], operation['updatedAt']))
+            return results
+        return await self._write(execute)
+
+    async def update_message_feedback(self, user_id, message_id, feedback, conversation_id = None):
+        updated = await self.update_messages_feedback(user_id, [(message_id, feedback, conversation_id)])
+        return updated[0] if updated else False
+
+    async def update_messages_feedback(self, user_id, ratings):
+        def update(connection):
+            updated = []
+            for message_id, feedback, _ in ratings:
+                row = connection.execute(
+                    f"UPDATE messages SET document = json_set(document, '$.feedback', ?, '$._ts', {NOW_TS_SQL}) WHERE user_id = ? AND id = ? "
+                    "RETURNING conversation_id, document",
+                    (feedback, user_id, message_id)
+                ).fetchone()
+                if not row:
+                    continue
+                ## keep the conversation's feedback map, the source of its feedback aggregates, in step
+                connection.execute(
+                    f"UPDATE conversations SET document = json_set(document, '$.{MESSAGE_FEEDBACK_FIELD}', "
+                    f"json_set(coalesce(json_extract(document, '$.{MESSAGE_FEEDBACK_FIELD}'), '{{}}'), '$.\"' || ? || '\"', ?), "
+                    f"'$._etag', {NEW_ETAG_SQL}, '$._ts', {NOW_TS_SQL}) "
+                    "WHERE user_id = ? AND id = ?",
+                    (message_id, feedback, user_id, row[0])
+                )
+                updated.append(json.loads(row[1]))
+            return updated
+        return await self._write(update)
+
+    async def get_changes(self, user_id, since = None):
+        def select(connection):
+            documents = []
+            for table in ("conversations", "messages"):
+                rows = connection.execute(
+                    f"SELECT document FROM {table} WHERE user_id = ? AND coalesce(json_extract(document, '$._ts'), 0) >= ?",
+                    (user_id, 0 if since is None else since)
+                )
+                documents += [json.loads(row[0]) for row in rows]
+            return [decode_message(document) if document['type'] == 'message' else document for document in documents]
+        return await self._read(select)
+
+    async def get_messages(self, user_id, conversation_id):
+        def select(connection):
+            rows = connection.execute(
+                "SELECT document FROM messages WHERE conversation_id = ? AND user_id = ? ORDER BY created_at ASC",
+                (conversation_id, user_id)
+            )
+            return [decode_message(json.loads(row[0])) for row in rows]
+        return await self._read(select)
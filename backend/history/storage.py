@@ -0,0 +1,160 @@
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+from backend.history.feedback import MESSAGE_FEEDBACK_FIELD
+
+
+class HistoryStorage(ABC):
+    """
+    Interface every chat history backend implements.
+
+    The method set mirrors what the ``/history/*`` routes need. Documents are
+    plain dicts in the shape the Cosmos container has always stored
+    (``type`` is ``conversation`` or ``message``), so backends stay
+    interchangeable.
+    """
+
+    enable_message_feedback: bool = False
+    conversation_index_enabled: bool = False
+    ## ContentCompression applied to message bodies on write, see backend/history/compression.py
+    content_compression = None
+
+    def partition_fields(self, user_id, conversation_id):
+        ## extra properties a backend's partitioning scheme needs on every document
+        return {}
+
+    def build_conversation(self, user_id, title = ''):
+        conversation = {
+            'id': str(uuid.uuid4()),
+            'type': 'conversation',
+            'createdAt': datetime.utcnow().isoformat(),
+            'updatedAt': datetime.utcnow().isoformat(),
+            'userId': user_id,
+            'title': title
+        }
+        conversation.update(self.partition_fields(user_id, conversation['id']))
+        if self.enable_message_feedback:
+            conversation[MESSAGE_FEEDBACK_FIELD] = {}
+        return conversation
+
+    def build_message(self, uuid, conversation_id, user_id, input_message: dict):
+        message = {
+            'id': uuid,
+            'type': 'message',
+            'userId' : user_id,
+            'createdAt': datetime.utcnow().isoformat(),
+            'updatedAt': datetime.utcnow().isoformat(),
+            'conversationId' : conversation_id,
+            'role': input_message['role'],
+            'content': input_message['content']
+        }
+        message.update(self.partition_fields(user_id, conversation_id))
+        if self.content_compression:
+            self.content_compression.encode_message(message)
+
+        if self.enable_message_feedback:
+            message['feedback'] = ''
+
+        return message
+
+    @abstractmethod
+    async def ensure(self):
+        pass
+
+    @abstractmethod
+    async def create_conversation(self, user_id, title = ''):
+        pass
+
+    @abstractmethod
+    async def upsert_conversation(self, conversation):
+        pass
+
+    @abstractmethod
+    async def delete_conversation(self, user_id, conversation_id):
+        pass
+
+    @abstractmethod
+    async def delete_messages(self, conversation_id, user_id):
+        pass
+
+    @abstractmethod
+    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        pass
+
+    @abstractmethod
+    async def get_conversation(self, user_id, conversation_id):
+        pass
+
+    @abstractmethod
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+        pass
+
+    @abstractmethod
+    async def touch_conversation(self, user_id, conversation_id, updated_at):
+        pass
+
+    @abstractmethod
+    async def execute_batch(self, user_id, operations):
+        pass
+
+    @abstractmethod
+    async def update_message_feedback(self, user_id, message_id, feedback, conversation_id = None):
+        pass
+
+    async def update_messages_feedback(self, user_id, ratings):
+        ## ratings are (message_id, feedback, conversation_id or None); returns the messages that were updated
+        updated = []
+        for message_id, feedback, conversation_id in ratings:
+            message = await self.update_message_feedback(user_id, message_id, feedback, conversation_id)
+            if message:
+                updated.append(message)
+        return updated
+
+    @abstractmethod
+    async def get_messages(self, user_id, conversation_id):
+        pass
+
+    async def iter_conversations(self, user_id, page_size = 100):
+        ## every conversation of the user, a page at a time, for exports
+        offset = 0
+        while True:
+            conversations = await self.get_conversations(user_id, limit=page_size, offset=offset)
+            for conversation in conversations:
+                yield conversation
+            if len(conversations) < page_size:
+                return
+            offset += page_size
+
+    async def iter_messages(self, user_id, conversation_id, page_size = 100):
+        for message in await self.get_messages(user_id, conversation_id):
+            yield message
+
+    async def get_changes(self, user_id, since = None):
+        ## the user's conversations and (decoded) messages written at or after `since`, a `_ts` in
+        ## seconds since the epoch, or all of them; backends override this with a single query
+        documents = []
+        async for conversation in self.iter_conversations(user_id):
+            documents.append(conversation)
+            documents += [message async for message in self.iter_messages(user_id, conversation['id'])]
+        if since is None:
+            return documents
+        return [document for document in documents if document.get('_ts', since) >= since]
+
+    @abstractmethod
+    async def get_idle_conversations(self, updated_before, limit):
+        ## unarchived conversations of any user with updatedAt and lastAccessedAt older than updated_before
+        pass
+
+    @abstractmethod
+    async def replace_conversation(self, conversation, etag):
+        ## write the conversation only if it is unchanged since it was read with this _etag, None if it changed
+        pass
+
+    @abstractmethod
+    async def delete_message_ids(self, user_id, conversation_id, message_ids):
+        ## delete just these messages of the conversation, leaving any written since they were read
+        pass
+
+    async def close(self):
+        pass
@@ -0,0 +1,242 @@
+import os
+import json
+import glob
+import asyncio
+import logging
+import contextvars
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from azure.core.exceptions import HttpResponseError
+
+logger = logging.getLogger(__name__)
+
+## status codes worth retrying; anything else will never succeed and is dropped
+TRANSIENT_STATUS_CODES = {408, 429, 449, 500, 502, 503, 504}
+
+
+def is_transient_error(error: Exception) -> bool:
+    ## covers CosmosHttpResponseError and CosmosBatchOperationError, whose status is the failed operation's
+    if isinstance(error, HttpResponseError):
+        return error.status_code in TRANSIENT_STATUS_CODES
+    ## network failures, timeouts, etc.
+    return True
+
+
+class HistoryWriteBehindQueue():
+    """
+    Per-worker write-behind queue for conversation history writes.
+
+    Operations are buffered per partition key and written by one writer task
+    per partition, so writes for a conversation land in the order they were
+    enqueued. Each writer drains its partition in batches of up to
+    ``batch_size`` operations. Once ``max_pending`` operations are queued,
+    callers wait in ``wait_for_capacity`` for the writers to catch up rather
+    than the queue spilling out of order. Whatever cannot be written before
+    shutdown is appended to a bounded NDJSON spill file which the next worker
+    replays on startup, before it accepts any writes of its own.
+    """
+
+    def __init__(
+        self,
+        client,
+        batch_size: int = 50,
+        flush_interval: float = 0.05,
+        max_pending: int = 10000,
+        max_concurrent_partitions: int = 16,
+        spill_dir: Optional[str] = None,
+        max_spill_bytes: int = 16 * 1024 * 1024,
+        max_backoff: float = 5.0,
+        flush_timeout: float = 10.0,
+    ):
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_backoff = max_backoff
+        self.flush_timeout = flush_timeout
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self.spill_path = (
+            os.path.join(spill_dir, f"history-spill-{os.getpid()}.ndjson")
+            if spill_dir else None
+        )
+
+        self._pending: Dict[str, Deque[dict]] = {}
+        self._writers: Dict[str, asyncio.Task] = {}
+        self._pending_count = 0
+        self._semaphore = asyncio.Semaphore(max_concurrent_partitions)
+        self._closing = False
+        self._capacity = asyncio.Event()
+        self._capacity.set()
+
+    @property
+    def pending_count(self) -> int:
+        return self._pending_count
+
+    async def start(self):
+        await self.replay_spill_files()
+
+    async def wait_for_capacity(self):
+        ## backpressure: hold the caller until the writers bring the queue under max_pending
+        while self._pending_count >= self.max_pending and not self._closing:
+            self._capacity.clear()
+            await self._capacity.wait()
+
+    def enqueue(self, partition_key: str, operation: dict):
+        if self._closing:
+            self._spill([(partition_key, operation)])
+            return
+
+        ## never spilled while running, a spilled operation would land after later ones
+        self._pending.setdefault(partition_key, deque()).append(operation)
+        self._pending_count += 1
+
+        writer = self._writers.get(partition_key)
+        if writer is None or writer.done():
+            ## start the writer in a fresh context so its Cosmos calls aren't attributed to
+            ## whichever request happened to enqueue first
+            writer = contextvars.Context().run(asyncio.create_task, self._drain_partition(partition_key))
+            writer.add_done_callback(lambda task: self._forget_writer(partition_key, task))
+            self._writers[partition_key] = writer
+
+    def _forget_writer(self, partition_key: str, task: asyncio.Task):
+        if self._writers.get(partition_key) is task:
+            del self._writers[partition_key]
+
+    def enqueue_upsert(self, partition_key: str, item: dict):
+        self.enqueue(partition_key, {'op': 'upsert', 'item': item})
+
+    def enqueue_touch(self, partition_key: str, conversation_id: str, updated_at: str):
+        self.enqueue(partition_key, {'op': 'touch', 'id': conversation_id, 'updatedAt': updated_at})
+
+    def has_pending_upsert(self, partition_key: str, item_id: str) -> bool:
+        return any(
+            operation['op'] == 'upsert' and operation['item'].get('id') == item_id
+            for operation in self._pending.get(partition_key, ())
+        )
+
+    async def flush(self, partition_key: Optional[str] = None, timeout: Optional[float] = None) -> bool:
+        ## wait until everything enqueued so far (for one partition, or all of them) is written,
+        ## for at most `timeout` (flush_timeout by default) seconds; False when that ran out
+        if partition_key is not None:
+            writers = [self._writers[partition_key]] if partition_key in self._writers else []
+        else:
+            writers = list(self._writers.values())
+        if not writers:
+            return True
+        ## asyncio.wait, unlike wait_for, leaves the writers running when the time is up
+        _, not_done = await asyncio.wait(writers, timeout=self.flush_timeout if timeout is None else timeout)
+        if not_done:
+            logger.warning(f"History writes for {partition_key or 'all partitions'} still pending after flush timeout")
+        return not not_done
+
+    async def close(self, timeout: float = 10.0):
+        self._closing = True
+        ## release anyone waiting for capacity, their writes go to the spill file now
+        self._capacity.set()
+        if not await self.flush(timeout=timeout):
+            logger.warning("Timed out flushing history write-behind queue, spilling remaining operations")
+
+        writers = list(self._writers.values())
+        for writer in writers:
+            writer.cancel()
+        await asyncio.gather(*writers, return_exceptions=True)
+        self._writers.clear()
+
+        remaining = []
+        for partition_key, operations in self._pending.items():
+            remaining.extend((partition_key, operation) for operation in operations)
+        self._pending.clear()
+        self._pending_count = 0
+        if remaining:
+            self._spill(remaining)
+
+    async def _drain_partition(self, partition_key: str):
+        ## give concurrent requests a moment to enqueue into the same batch
+        await asyncio.sleep(self.flush_interval)
+        backoff = 0.1
+        async with self._semaphore:
+            while True:
+                operations = self._pending.get(partition_key)
+                if not operations:
+                    self._pending.pop(partition_key, None)
+                    return
+
+                batch = [operations[i] for i in range(min(self.batch_size, len(operations)))]
+                try:
+                    await self.client.execute_batch(partition_key, batch)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    if is_transient_error(e) and not self._closing:
+                        logger.warning(f"Transient error writing history batch, retrying in {backoff}s: {e}")
+                        await asyncio.sleep(backoff)
+                        backoff = min(backoff * 2, self.max_backoff)
+                        continue
+                    if is_transient_error(e):
+                        ## shutting down: leave the batch queued so close() spills it
+                        return
+                    await self._write_individually(partition_key, batch, e)
+
+                backoff = 0.1
+                for _ in batch:
+                    operations.popleft()
+                self._pending_count -= len(batch)
+                if self._pending_count < self.max_pending:
+                    self._capacity.set()
+
+    async def _write_individually(self, partition_key: str, batch: List[dict], error: Exception):
+        ## a batch fails as a unit, so retry each operation alone and drop only the bad ones
+        logger.warning(f"History batch for partition {partition_key} failed ({error}), writing operations individually")
+        for operation in batch:
+            try:
+                await self.client.execute_batch(partition_key, [operation])
+            except Exception as e:
+                logger.error(f"Dropping history operation {operation.get('op')} {operation.get('id') or operation.get('item', {}).get('id')}: {e}")
+
+    def _spill(self, entries: List[tuple]):
+        if not self.spill_path:
+            logger.error(f"No spill path configured, dropping {len(entries)} history operations")
+            return
+
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            size = os.path.getsize(self.spill_path) if os.path.exists(self.spill_path) else 0
+            written = 0
+            with open(self.spill_path, "a", encoding="utf-8") as spill_file:
+                for partition_key, operation in entries:
+                    line = json.dumps({'partitionKey': partition_key, 'operation': operation}) + "\n"
+                    if size + len(line) > self.max_spill_bytes:
+                        break
+                    spill_file.write(line)
+                    size += len(line)
+                    written += 1
+            if written < len(entries):
+                logger.error(f"History spill file is full, dropped {len(entries) - written} operations")
+        except OSError as e:
+            logger.error(f"Unable to spill {len(entries)} history operations: {e}")
+
+    async def replay_spill_files(self):
+        if not self.spill_dir or not os.path.isdir(self.spill_dir):
+            return
+
+        for path in sorted(glob.glob(os.path.join(self.spill_dir, "history-spill-*.ndjson"))):
+            ## claim the file first so two workers starting together don't replay it twice
+            claimed_path = f"{path}.replay-{os.getpid()}"
+            try:
+                os.rename(path, claimed_path)
+            except OSError:
+                continue
+
+            replayed = 0
+            with open(claimed_path, encoding="utf-8") as spill_file:
+                for line in spill_file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.enqueue(entry['partitionKey'], entry['operation'])
+                    replayed += 1
+            os.remove(claimed_path)
+            logger.info(f"Replayed {replayed} spilled history operations from {path}")
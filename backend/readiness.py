@@ -0,0 +1,141 @@
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+WARMING = "warming"
+READY = "ready"
+FAILED = "failed"
+## not configured for this deployment, never blocks readiness
+DISABLED = "disabled"
+
+
+class DependencyUnavailableError(Exception):
+    def __init__(self, component: str, state: "ComponentState"):
+        super().__init__(f"{component} is not ready ({state.status})" + (f": {state.detail}" if state.detail else ""))
+        self.component = component
+        self.state = state
+
+
+class ComponentState():
+    __slots__ = ("status", "detail", "required", "changed_at", "warm_seconds", "attempts")
+
+    def __init__(self, required: bool = True):
+        self.status = PENDING
+        self.detail = None
+        self.required = required
+        self.changed_at = time.time()
+        self.warm_seconds = None
+        self.attempts = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "status": self.status,
+            "required": self.required,
+            "detail": self.detail,
+            "changed_at": self.changed_at,
+            "warm_seconds": self.warm_seconds,
+            "attempts": self.attempts,
+        }
+
+
+class Readiness():
+    """
+    Tracks the warm-up state of each dependency a worker serves from.
+
+    Components are registered with a warm function that returns a short
+    detail string (or raises). ``warm_all`` runs them concurrently at
+    startup, each bounded by ``warm_timeout``; ``run_retries`` keeps
+    re-warming failed ones in the background. Routes call ``require`` so a
+    dependency that is down fails the request at once instead of letting it
+    hang.
+    """
+
+    def __init__(self, warm_timeout: float = 30.0, retry_interval: float = 30.0):
+        self.warm_timeout = warm_timeout
+        self.retry_interval = retry_interval
+        self.components: Dict[str, ComponentState] = {}
+        self._warmers: Dict[str, Callable[[], Awaitable[Optional[str]]]] = {}
+        self._retry_task: Optional[asyncio.Task] = None
+
+    def register(self, name: str, warm: Callable[[], Awaitable[Optional[str]]], required: bool = True):
+        self.components[name] = ComponentState(required)
+        self._warmers[name] = warm
+
+    def disable(self, name: str, detail: str = None):
+        state = self.components.setdefault(name, ComponentState(required=False))
+        self._set(state, DISABLED, detail)
+        self._warmers.pop(name, None)
+
+    @staticmethod
+    def _set(state, status, detail = None):
+        state.status = status
+        state.detail = detail
+        state.changed_at = time.time()
+
+    async def warm(self, name: str) -> bool:
+        state = self.components[name]
+        state.attempts += 1
+        self._set(state, WARMING)
+        started = time.perf_counter()
+        try:
+            detail = await asyncio.wait_for(self._warmers[name](), self.warm_timeout)
+        except asyncio.TimeoutError:
+            self._set(state, FAILED, f"warm-up timed out after {self.warm_timeout}s")
+            logger.error(f"Warming {name} timed out after {self.warm_timeout}s")
+            return False
+        except Exception as e:
+            self._set(state, FAILED, str(e) or type(e).__name__)
+            logger.exception(f"Warming {name} failed")
+            return False
+        finally:
+            state.warm_seconds = round(time.perf_counter() - started, 3)
+
+        self._set(state, READY, detail)
+        logger.info(f"{name} ready in {state.warm_seconds}s")
+        return True
+
+    async def warm_all(self):
+        await asyncio.gather(*(self.warm(name) for name in list(self._warmers)))
+
+    def start_retries(self):
+        if self._retry_task is None:
+            self._retry_task = asyncio.create_task(self.run_retries())
+
+    async def run_retries(self):
+        while True:
+            await asyncio.sleep(self.retry_interval)
+            failed = [name for name, state in self.components.items() if state.status == FAILED and name in self._warmers]
+            if failed:
+                await asyncio.gather(*(self.warm(name) for name in failed))
+
+    async def stop(self):
+        if self._retry_task:
+            self._retry_task.cancel()
+            await asyncio.gather(self._retry_task, return_exceptions=True)
+            self._retry_task = None
+
+    def is_ready(self, name: str) -> bool:
+        state = self.components.get(name)
+        return state is not None and state.status == READY
+
+    def require(self, name: str):
+        state = self.components.get(name)
+        if state is None:
+            state = ComponentState()
+            self._set(state, PENDING, "not registered")
+        if state.status != READY:
+            raise DependencyUnavailableError(name, state)
+
+    @property
+    def ready(self) -> bool:
+        return all(state.status in (READY, DISABLED) for state in self.components.values() if state.required)
+
+    def snapshot(self) -> dict:
+        return {
+            "status": READY if self.ready else "not_ready",
+            "components": {name: state.to_dict() for name, state in self.components.items()},
+        }
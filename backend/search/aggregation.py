@@ -0,0 +1,199 @@
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+from azure.core.exceptions import HttpResponseError
+
+from backend.search.gateway import SearchGateway, search_gateway
+from backend.search.sketches import (
+    DISTINCT_FUNCTION,
+    QUANTILE_FUNCTIONS,
+    SKETCH_FUNCTIONS,
+    DistinctSketch,
+    QuantileSketch,
+    error_bound,
+)
+
+logger = logging.getLogger(__name__)
+
+AGGREGATION_TYPES = ("count", "min", "max", "sum", "avg") + SKETCH_FUNCTIONS
+## how each aggregation is answered when the field's attributes allow it
+PLANS = {
+    "count": "total_count",
+    "min": "order_by",
+    "max": "order_by",
+    "sum": "scan",
+    "avg": "scan",
+    **{function: "scan" for function in SKETCH_FUNCTIONS},
+}
+## the service won't page past $skip=100000, a scan reads at most this many documents
+SCAN_LIMIT = 100000
+## facet buckets requested per field; fewer coming back means none were cut off
+FACET_BUCKETS = 1000
+
+
+def combine_filters(*filters: Optional[str]) -> Optional[str]:
+    filters = [f"({filter_str})" for filter_str in filters if filter_str]
+    return " and ".join(filters) or None
+
+
+def is_field_capability_error(error: HttpResponseError) -> bool:
+    ## a 400 here means the field isn't filterable, sortable or facetable in the index
+    return getattr(error, "status_code", None) == 400
+
+
+def with_error_bound(result: Dict[str, Any]) -> Dict[str, Any]:
+    ## an aggregation estimated from a sketch says how far off it may be
+    bound = error_bound(result["aggregation_type"])
+    if bound is not None:
+        result["error_bound"] = bound
+    return result
+
+
+class AggregationPlanner():
+    """
+    Answers aggregations over an index with the cheapest query that gives
+    the right result.
+
+    ``count`` is a ``top=0`` query with ``include_total_count``; ``min`` and
+    ``max`` read one document ordered by the field; group counts come from
+    facets. Only ``sum``, ``avg`` and the sketches (percentiles and
+    ``distinct``) stream the matching documents. When the
+    index doesn't allow a push-down for the field (not filterable, sortable
+    or facetable) the planner falls back to a scan.
+
+    Every result says whether it is ``exact``: a scan that hit
+    ``SCAN_LIMIT``, or facets that may have dropped buckets, are not.
+    """
+
+    def __init__(self, endpoint: str, key: Optional[str], index_name: str, query_text: str = "*",
+                 filter_str: str = None, timeout: float = None, gateway: SearchGateway = None):
+        self.endpoint = endpoint
+        self.key = key
+        self.index_name = index_name
+        self.query_text = query_text
+        self.filter_str = filter_str
+        self.timeout = timeout
+        self.gateway = gateway or search_gateway
+
+    async def _search(self, **search_args):
+        return await self.gateway.search(
+            self.endpoint, self.key, self.index_name, timeout=self.timeout,
+            search_text=self.query_text, **search_args
+        )
+
+    def _with_values(self, field: str) -> Optional[str]:
+        return combine_filters(self.filter_str, f"{field} ne null")
+
+    async def count(self, filter_str: Optional[str]) -> int:
+        stream = await self._search(filter=filter_str, top=0, include_total_count=True)
+        return await stream.get_count()
+
+    async def extreme(self, field: str, descending: bool) -> Optional[float]:
+        stream = await self._search(
+            filter=self._with_values(field), top=1, select=[field],
+            ## a string: the pinned azure-search-documents sends it as $orderby verbatim
+            order_by=f"{field} {'desc' if descending else 'asc'}",
+        )
+        async for document in stream.documents():
+            return document.get(field)
+        return None
+
+    async def scan(self, field: str, aggregation_type: str = None) -> Dict[str, Any]:
+        stream = await self._search(filter=self.filter_str, top=SCAN_LIMIT, select=[field], include_total_count=True)
+        scanned, count, total, minimum, maximum = 0, 0, 0.0, None, None
+        quantiles = QuantileSketch() if aggregation_type in QUANTILE_FUNCTIONS else None
+        distinct = DistinctSketch() if aggregation_type == DISTINCT_FUNCTION else None
+        async for document in stream.documents():
+            scanned += 1
+            if document.get(field) is None:
+                continue
+            if distinct is not None:
+                ## any field has distinct values, numeric or not
+                distinct.add(document[field])
+                count += 1
+                continue
+            value = float(document[field])
+            if quantiles is not None:
+                quantiles.add(value)
+            count += 1
+            total += value
+            minimum = value if minimum is None else min(minimum, value)
+            maximum = value if maximum is None else max(maximum, value)
+        result = {
+            "count": count,
+            "sum": total,
+            "min": minimum,
+            "max": maximum,
+            "avg": total / count if count else None,
+            "exact": scanned >= (await stream.get_count() or 0),
+        }
+        if quantiles is not None:
+            result[aggregation_type] = quantiles.quantile(QUANTILE_FUNCTIONS[aggregation_type])
+        if distinct is not None:
+            result[aggregation_type] = distinct.estimate()
+        return result
+
+    async def aggregate(self, field: str, aggregation_type: str) -> Dict[str, Any]:
+        aggregation_type = aggregation_type.lower()
+        if aggregation_type not in AGGREGATION_TYPES:
+            return {"error": f"Unsupported aggregation type: {aggregation_type}"}
+
+        strategy = PLANS[aggregation_type]
+        try:
+            if strategy == "total_count":
+                count = await self.count(self._with_values(field))
+                result, exact = count, True
+            elif strategy == "order_by":
+                result, count = await asyncio.gather(
+                    self.extreme(field, descending=aggregation_type == "max"),
+                    self.count(self._with_values(field)),
+                )
+                exact = True
+        except HttpResponseError as e:
+            if not is_field_capability_error(e):
+                raise
+            logger.debug(f"Can't push {aggregation_type} on {field} down to the index, scanning instead: {e}")
+            strategy = "scan"
+
+        if strategy == "scan":
+            scanned = await self.scan(field, aggregation_type)
+            count, exact = scanned["count"], scanned["exact"]
+            result = count if aggregation_type == "count" else scanned[aggregation_type]
+
+        if not count:
+            return {"error": f"No numeric values found for field '{field}'"}
+
+        return with_error_bound({
+            "result": result,
+            "count": count,
+            "aggregation_type": aggregation_type,
+            "field": field,
+            "strategy": strategy,
+            "exact": exact,
+        })
+
+    async def group_counts(self, field: str) -> Optional[Dict[str, Any]]:
+        """
+        Document count per value of ``field`` from facets, or None when the
+        field isn't facetable.
+        """
+        try:
+            stream = await self._search(
+                filter=self.filter_str, top=0, include_total_count=True,
+                facets=[f"{field},count:{FACET_BUCKETS}"],
+            )
+            facets, total = await asyncio.gather(stream.get_facets(), stream.get_count())
+        except HttpResponseError as e:
+            if not is_field_capability_error(e):
+                raise
+            logger.debug(f"Can't facet on {field}, scanning instead: {e}")
+            return None
+
+        buckets = (facets or {}).get(field, [])
+        return {
+            "groups": {bucket["value"]: bucket["count"] for bucket in buckets},
+            "total_documents": total,
+            ## each shard reports its top buckets; if fewer than asked came back, nothing was cut
+            "exact": len(buckets) < FACET_BUCKETS,
+        }
@@ -0,0 +1,130 @@
+import time
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from azure.core.credentials import AzureKeyCredential
+from azure.identity.aio import DefaultAzureCredential
+from azure.search.documents.aio import SearchClient
+
+logger = logging.getLogger(__name__)
+
+
+class SearchTimeoutError(TimeoutError):
+    pass
+
+
+class SearchResultStream():
+    """
+    One search call's results, fetched a page at a time.
+
+    Every await on the service (the first page, each following page, the
+    count and facets) is bounded by what is left of the call's deadline, so
+    a slow index fails the call instead of holding the request open.
+    """
+
+    def __init__(self, results, deadline: Optional[float], description: str):
+        self._results = results
+        self._deadline = deadline
+        self._description = description
+        self._page_iterator = None
+
+    async def _bounded(self, awaitable):
+        if self._deadline is None:
+            return await awaitable
+        remaining = self._deadline - time.monotonic()
+        try:
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            return await asyncio.wait_for(awaitable, remaining)
+        except asyncio.TimeoutError as e:
+            raise SearchTimeoutError(f"Search on {self._description} timed out") from e
+
+    def _pages(self):
+        ## one by_page() iterator serves the pages, the count and the facets, so the first page is fetched once
+        if self._page_iterator is None:
+            self._page_iterator = self._results.by_page()
+        return self._page_iterator
+
+    async def pages(self) -> AsyncIterator[List[dict]]:
+        page_iterator = self._pages()
+        while True:
+            try:
+                page = await self._bounded(page_iterator.__anext__())
+            except StopAsyncIteration:
+                return
+            yield await self._bounded(_collect(page))
+
+    async def documents(self) -> AsyncIterator[dict]:
+        async for page in self.pages():
+            for document in page:
+                yield document
+
+    async def get_count(self) -> Optional[int]:
+        ## only set when the query asked for include_total_count
+        return await self._bounded(self._pages().get_count())
+
+    async def get_facets(self) -> Optional[Dict[str, List[dict]]]:
+        return await self._bounded(self._pages().get_facets())
+
+
+async def _collect(page) -> List[dict]:
+    return [document async for document in page]
+
+
+class SearchGateway():
+    """
+    Shared async access to Azure AI Search.
+
+    One ``azure.search.documents.aio.SearchClient`` is kept per
+    (endpoint, index) so calls reuse its connection pool instead of
+    opening a client per query. ``timeout`` is the default per-call budget
+    in seconds, covering every page the call reads.
+    """
+
+    def __init__(self, timeout: Optional[float] = 30.0):
+        self.timeout = timeout
+        self._clients: Dict[Tuple[str, str], Tuple[Optional[str], SearchClient]] = {}
+        ## clients replaced after a key rotation, closed with the rest
+        self._retired: List[SearchClient] = []
+        self._credential: Optional[DefaultAzureCredential] = None
+
+    def client(self, endpoint: str, index_name: str, key: Optional[str] = None) -> SearchClient:
+        cached = self._clients.get((endpoint, index_name))
+        if cached and cached[0] == key:
+            return cached[1]
+        if cached:
+            self._retired.append(cached[1])
+
+        if key:
+            credential = AzureKeyCredential(key)
+        else:
+            if self._credential is None:
+                self._credential = DefaultAzureCredential()
+            credential = self._credential
+        client = SearchClient(endpoint=endpoint, index_name=index_name, credential=credential)
+        self._clients[(endpoint, index_name)] = (key, client)
+        return client
+
+    async def search(self, endpoint: str, key: Optional[str], index_name: str, timeout: Optional[float] = None,
+                     **search_args) -> SearchResultStream:
+        """Start a search; ``search_args`` are passed to ``SearchClient.search``."""
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout if timeout else None
+        client = self.client(endpoint, index_name, key)
+        ## the aio client sends nothing until the first page is read
+        results = await client.search(**search_args)
+        return SearchResultStream(results, deadline, f"{endpoint} index {index_name}")
+
+    async def close(self):
+        clients = [client for _, client in self._clients.values()] + self._retired
+        self._clients.clear()
+        self._retired.clear()
+        await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+        if self._credential:
+            await self._credential.close()
+            self._credential = None
+
+
+## shared by the search helpers in backend/utils.py
+search_gateway = SearchGateway()
@@ -0,0 +1,245 @@
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from azure.core.exceptions import HttpResponseError
+
+from backend.search.aggregation import SCAN_LIMIT, combine_filters, is_field_capability_error
+from backend.search.sketches import (
+    DISTINCT_FUNCTION,
+    QUANTILE_FUNCTIONS,
+    SKETCH_FUNCTIONS,
+    DistinctSketch,
+    QuantileSketch,
+    error_bound,
+)
+
+logger = logging.getLogger(__name__)
+
+## percentiles and distinct counts come from mergeable sketches, see backend/search/sketches.py
+METRIC_FUNCTIONS = ("count", "sum", "avg", "min", "max") + SKETCH_FUNCTIONS
+KEY_FIELD = "id"
+## documents per keyset query; well under the service's skip limit, which each query pages within
+KEYSET_BATCH_SIZE = 10000
+
+
+def metric_name(field: str, function: str) -> str:
+    return f"{function}_{field}"
+
+
+class MetricAccumulator():
+    __slots__ = ("count", "sum", "min", "max", "quantiles", "distinct")
+
+    def __init__(self, quantiles: bool = False, distinct: bool = False):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.quantiles = QuantileSketch() if quantiles else None
+        self.distinct = DistinctSketch() if distinct else None
+
+    def add(self, value: float):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self.quantiles is not None:
+            self.quantiles.add(value)
+
+    def merge(self, other: "MetricAccumulator"):
+        """Fold in an accumulator of other documents, e.g. another worker's or shard's."""
+        if other.count:
+            self.count += other.count
+            self.sum += other.sum
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        if self.quantiles is not None and other.quantiles is not None:
+            self.quantiles.merge(other.quantiles)
+        if self.distinct is not None and other.distinct is not None:
+            self.distinct.merge(other.distinct)
+
+    def result(self, function: str) -> Optional[float]:
+        if function == DISTINCT_FUNCTION:
+            return self.distinct.estimate() if self.distinct is not None else None
+        if not self.count:
+            return None
+        if function in QUANTILE_FUNCTIONS:
+            return self.quantiles.quantile(QUANTILE_FUNCTIONS[function]) if self.quantiles is not None else None
+        if function == "sum":
+            return self.sum
+        if function == "avg":
+            return self.sum / self.count
+        if function == "min":
+            return self.min
+        if function == "max":
+            return self.max
+        return self.count
+
+
+class GroupByAccumulator():
+    """
+    Single pass group-by over a stream of documents.
+
+    Each group keeps its document count and one ``MetricAccumulator`` per
+    metric field, so memory is O(groups) however many documents go
+    through, and any number of (field, function) metrics come out of the
+    same pass. Percentiles and distinct counts add a sketch of bounded
+    size to the field's accumulator.
+    """
+
+    def __init__(self, group_by_field: str, metrics: Iterable[Tuple[str, str]] = ()):
+        self.group_by_field = group_by_field
+        self.metrics = [(field, function) for field, function in metrics]
+        for _, function in self.metrics:
+            if function not in METRIC_FUNCTIONS:
+                raise ValueError(f"Unsupported metric function: {function}")
+        self.metric_fields = sorted({field for field, _ in self.metrics})
+        ## field -> (keeps a quantile sketch, keeps a distinct sketch)
+        self.sketches = {
+            field: (
+                any(function in QUANTILE_FUNCTIONS for metric_field, function in self.metrics if metric_field == field),
+                any(function == DISTINCT_FUNCTION for metric_field, function in self.metrics if metric_field == field),
+            )
+            for field in self.metric_fields
+        }
+        ## group value -> [document count, [(metric field, MetricAccumulator)]]
+        self.groups: Dict[Any, list] = {}
+        self.documents = 0
+
+    def add(self, document: dict):
+        self.add_page((document,))
+
+    def add_page(self, documents: Iterable[dict]):
+        group_by_field, groups, metric_fields, sketches = self.group_by_field, self.groups, self.metric_fields, self.sketches
+        for document in documents:
+            self.documents += 1
+            group_value = document.get(group_by_field)
+            if group_value is None:
+                continue
+
+            group = groups.get(group_value)
+            if group is None:
+                group = groups[group_value] = [0, [(field, MetricAccumulator(*sketches[field])) for field in metric_fields]]
+            group[0] += 1
+
+            for field, accumulator in group[1]:
+                value = document.get(field)
+                if value is None:
+                    continue
+                if accumulator.distinct is not None:
+                    accumulator.distinct.add(value)
+                try:
+                    accumulator.add(float(value))
+                except (ValueError, TypeError):
+                    # Skip values that can't be converted to float
+                    pass
+
+    def error_bounds(self) -> Dict[str, dict]:
+        """How far each sketch metric may be off, by metric name."""
+        return {
+            metric_name(field, function): error_bound(function)
+            for field, function in self.metrics if function in SKETCH_FUNCTIONS
+        }
+
+    def results(self, sort_by: Optional[str] = None, order: str = "desc", top: Optional[int] = None) -> List[dict]:
+        """
+        One row per group: ``group``, ``count`` and a ``metrics`` dict keyed
+        by ``metric_name``. ``sort_by`` is ``count`` or a metric name.
+        """
+        rows = []
+        for group_value, (count, accumulators) in self.groups.items():
+            accumulators = dict(accumulators)
+            rows.append({
+                "group": group_value,
+                "count": count,
+                "metrics": {
+                    metric_name(field, function): accumulators[field].result(function)
+                    for field, function in self.metrics
+                },
+            })
+        return sort_rows(rows, sort_by, order, top)
+
+
+def sort_rows(rows: List[dict], sort_by: Optional[str] = None, order: str = "desc", top: Optional[int] = None) -> List[dict]:
+    if sort_by and sort_by != "count":
+        ## groups without a value for the metric sort last either way
+        present = [row for row in rows if row["metrics"].get(sort_by) is not None]
+        missing = [row for row in rows if row["metrics"].get(sort_by) is None]
+        present.sort(key=lambda row: row["metrics"][sort_by], reverse=order.lower() == "desc")
+        rows = present + missing
+    else:
+        rows.sort(key=lambda row: row["count"], reverse=order.lower() == "desc")
+    return rows[:top] if top is not None else rows
+
+
+def quote_odata(value: str) -> str:
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+async def keyset_pages(search: Callable[..., Awaitable[Any]], filter_str: Optional[str], select: List[str],
+                       batch_size: int = KEYSET_BATCH_SIZE, totals: Optional[dict] = None) -> AsyncIterator[List[dict]]:
+    """
+    Every document matching ``filter_str``, a result page at a time, in
+    ``id`` order.
+
+    Each query asks for the next ``batch_size`` documents after the last
+    id seen (``id gt '<last>'``), so no query skips past the service limit
+    however many documents match. ``search`` takes ``SearchClient.search``
+    arguments and returns a ``SearchResultStream``. The total match count
+    from the first query is stored in ``totals['count']``.
+    """
+    select = select if KEY_FIELD in select else select + [KEY_FIELD]
+    last_key = None
+    while True:
+        stream = await search(
+            filter=combine_filters(filter_str, f"{KEY_FIELD} gt {quote_odata(last_key)}" if last_key is not None else None),
+            order_by=f"{KEY_FIELD} asc",
+            select=select,
+            top=batch_size,
+            include_total_count=last_key is None,
+        )
+        read = 0
+        async for page in stream.pages():
+            if page:
+                read += len(page)
+                last_key = page[-1][KEY_FIELD]
+                yield page
+        if totals is not None and "count" not in totals:
+            totals["count"] = await stream.get_count()
+        if read < batch_size:
+            return
+
+
+async def scan_group_by(search: Callable[..., Awaitable[Any]], accumulator: GroupByAccumulator,
+                        filter_str: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Feed every matching document through ``accumulator``.
+
+    Uses keyset paging when the index lets ``id`` be filtered and sorted,
+    otherwise a single query capped at ``SCAN_LIMIT``. Returns the total
+    match count, the strategy used and whether every match was read.
+    """
+    select = [accumulator.group_by_field] + [field for field in accumulator.metric_fields if field != accumulator.group_by_field]
+    totals = {}
+    try:
+        async for page in keyset_pages(search, filter_str, select, totals=totals):
+            accumulator.add_page(page)
+        strategy = "keyset_scan"
+    except HttpResponseError as e:
+        if not is_field_capability_error(e) or accumulator.documents:
+            raise
+        logger.debug(f"Can't page by {KEY_FIELD}, falling back to a capped scan: {e}")
+        stream = await search(filter=filter_str, select=select, top=SCAN_LIMIT, include_total_count=True)
+        async for page in stream.pages():
+            accumulator.add_page(page)
+        totals["count"] = await stream.get_count()
+        strategy = "scan"
+
+    total = totals.get("count") or 0
+    return {
+        "total_documents": total,
+        "strategy": strategy,
+        "exact": accumulator.documents >= total,
+        "error_bounds": accumulator.error_bounds(),
+    }
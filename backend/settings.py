@@ -19,6 +19,7 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import List, Literal, Optional
 from typing_extensions import Self
 from quart import Request
+from backend.auth.graph import GraphGroupResolver
 from backend.utils import parse_multi_columns, generateFilterString
 
 DOTENV_PATH = os.environ.get(
@@ -65,6 +66,172 @@ class _ChatHistorySettings(BaseSettings):
     conversations_container: str
     enable_feedback: bool = False
     enable_history: bool = False
+    ## off by default: without a spill dir, writes still queued when a worker dies are lost
+    write_behind_enabled: bool = False
+    write_behind_batch_size: conint(ge=1, le=100) = 50
+    write_behind_flush_interval: float = 0.05
+    write_behind_max_pending: int = 10000
+    write_behind_spill_dir: Optional[str] = None
+    write_behind_max_spill_bytes: int = 16 * 1024 * 1024
+    ## longest a read waits for the user's queued writes before going ahead without them
+    write_behind_flush_timeout: float = 10.0
+    ## container being migrated away from; reads fall back to it until the copy finishes
+    migration_source_container: Optional[str] = None
+    migration_source_partition_strategy: Literal["client_ip", "principal", "hierarchical", "hashed"] = "client_ip"
+    ## list conversations from a per-user index document maintained from the change feed
+    conversation_index_enabled: bool = False
+    ## run the change feed consumer in each app worker; disable when it runs elsewhere
+    conversation_index_consumer_enabled: bool = True
+    conversation_index_poll_interval: float = 1.0
+
+
+class _HistoryStorageSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="HISTORY_STORAGE_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    backend: Literal["cosmosdb", "sqlite"] = "cosmosdb"
+    sqlite_path: str = "history.db"
+    sqlite_max_workers: conint(ge=1) = 4
+    enable_feedback: bool = False
+    partition_strategy: Literal["client_ip", "principal", "hierarchical", "hashed"] = "client_ip"
+    partition_buckets: conint(ge=1) = 16
+    ## message bodies this many UTF-8 bytes or larger are stored compressed, 0 disables
+    compression_threshold: conint(ge=0) = 4096
+    compression_algorithm: Literal["auto", "zstd", "gzip"] = "auto"
+    ## /history/search keeps an in-memory index per user in each worker
+    search_max_cached_users: conint(ge=1) = 256
+    search_catch_up_interval: float = 5.0
+    ## how often the index drops conversations deleted through other workers
+    search_reconcile_interval: float = 300.0
+
+
+class _HistoryArchiveSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="HISTORY_ARCHIVE_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    enabled: bool = False
+    idle_days: conint(ge=1) = 90
+    interval_seconds: float = 3600
+    batch_size: conint(ge=1, le=100) = 100
+    ## run the archival job in this process; enable it in one worker of one instance only
+    scheduler_enabled: bool = False
+    ## archive to this directory instead of blob storage (local runs and tests)
+    local_path: Optional[str] = None
+    storage_account: Optional[str] = None
+    storage_connection_string: Optional[str] = None
+    container: str = "history-archive"
+
+
+class _ReadinessSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="READINESS_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    ## each component's warm-up is abandoned (and reported as failed) after this long
+    warm_timeout: float = 30.0
+    ## failed components are warmed again in the background at this interval
+    retry_interval: float = 30.0
+    ## make one cheap Azure OpenAI call at startup so the connection pool and token are warm
+    openai_probe: bool = True
+
+
+class _GraphSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="GRAPH_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    ## Microsoft Graph, where the groups of AZURE_SEARCH_PERMITTED_GROUPS_COLUMN's filter come from
+    base_url: str = "https://graph.microsoft.com/v1.0"
+    request_timeout: confloat(gt=0) = 10.0
+    max_connections: conint(ge=1) = 20
+    ## a user's groups are reused for this many seconds, then served for groups_stale_ttl more
+    ## while a background fetch refreshes them
+    groups_ttl: confloat(ge=0) = 300.0
+    groups_stale_ttl: confloat(ge=0) = 3600.0
+    groups_max_users: conint(ge=1) = 10000
+
+
+class _ClaimsStoreSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="CLAIMS_STORE_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    ## keep the claims columns in memory in each worker for vectorized analytics
+    enabled: bool = False
+    ## written after each index load and read at startup, so workers start without the index: a
+    ## directory of columns the workers memory-map and share, or an .npz file each loads into memory
+    snapshot_path: Optional[str] = None
+    ## read the claims from the search index; off, the snapshot is the only source
+    load_from_index: bool = True
+    ## the claims index; defaults to the AZURE_SEARCH_* datasource
+    index_endpoint: Optional[str] = None
+    index_key: Optional[str] = None
+    index_name: Optional[str] = None
+    ## seconds between reloads from the index, 0 to load once
+    refresh_interval: float = 3600.0
+    ## scans of more claims than this run a chunk of this many at a time, off the event loop; 0 scans whole
+    scan_chunk_rows: conint(ge=0) = 1_000_000
+    ## processes scanning the chunks of a mapped snapshot of at least scan_process_min_rows claims
+    scan_processes: conint(ge=0) = 0
+    scan_process_min_rows: conint(ge=1) = 5_000_000
+
+
+class _AnalyticsSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="ANALYTICS_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    ## /direct_search, /aggregation and /analytics answers are cached in each worker until the claims
+    ## data changes; a ttl also expires them after that many seconds, 0 disables the cache
+    cache_ttl: Optional[confloat(ge=0)] = None
+    cache_max_entries: conint(ge=0) = 1024
+    cache_max_bytes: conint(ge=0) = 64 * 1024 * 1024
+    ## seconds between checks of the index's document count, ids and facets and of the rollup file
+    ## for changes, 0 checks every request
+    index_version_interval: confloat(ge=0) = 60.0
+    ## rollup written by scripts/indexdata.py; matching aggregations and group-bys are answered from it
+    rollup_path: Optional[str] = None
+    ## /direct_search streams its results this many documents at a time, reading up to
+    ## direct_search_buffer_pages of them ahead of the client
+    direct_search_page_size: conint(ge=1, le=1000) = 100
+    direct_search_buffer_pages: conint(ge=1) = 2
+    ## latency objectives, /direct_search's to its first page; slower requests are logged and counted in /analytics/stats
+    direct_search_slo_ms: float = 500.0
+    aggregation_slo_ms: float = 50.0
+    analytics_slo_ms: float = 100.0
+    ## requests per route the latency percentiles are computed over
+    latency_window: conint(ge=1) = 1000
+    ## answer analytics questions sent to /conversation before they reach the model
+    router_enabled: bool = True
+    ## reply with the computed figure itself; off, the model writes every reply from the computed table
+    router_direct_answers: bool = False
+    ## give the model the claims data as tools (aggregate_claims, group_claims, find_claims)
+    tools_enabled: bool = False
+    ## with the tools on, the CSV dataset is left out of the system message
+    tools_strip_dataset: bool = True
+    ## model calls per chat request; the last one has to answer without tools
+    tools_max_rounds: conint(ge=1) = 5
+    tools_result_max_chars: conint(ge=500) = 8000
 
 
 class _PromptflowSettings(BaseSettings):
@@ -131,7 +298,10 @@ class _AzureOpenAISettings(BaseSettings):
         if isinstance(tools_json_str, str):
             try:
                 tools_dict = json.loads(tools_json_str)
-                return _AzureOpenAITool(**tools_dict)
+                ## one tool definition or a list of them
+                if isinstance(tools_dict, list):
+                    return [_AzureOpenAITool(**tool) for tool in tools_dict]
+                return [_AzureOpenAITool(**tools_dict)]
             except json.JSONDecodeError:
                 logging.warning("No valid tool definition found in the environment.  If you believe this to be in error, please check that the value of AZURE_OPENAI_TOOLS is a valid JSON string.")
             
@@ -207,6 +377,8 @@ class _SearchCommonSettings(BaseSettings):
     )
     max_search_queries: Optional[int] = None
     allow_partial_result: bool = False
+    ## budget in seconds for one direct query against the index, all pages included
+    request_timeout: float = 30.0
     include_contexts: Optional[List[str]] = ["citations", "intent"]
     vectorization_dimensions: Optional[int] = None
     role_information: str = Field(
@@ -316,7 +488,7 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
     def set_query_type(self) -> Self:
         self.query_type = to_snake(self.query_type)
 
-    def _set_filter_string(self, request: Request) -> str:
+    async def _set_filter_string(self, request: Request, group_resolver: GraphGroupResolver) -> str:
         if self.permitted_groups_column:
             user_token = request.headers.get("X-MS-TOKEN-AAD-ACCESS-TOKEN", "")
             logging.debug(f"USER TOKEN is {'present' if user_token else 'not present'}")
@@ -325,7 +497,7 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
                     "Document-level access control is enabled, but user access token could not be fetched."
                 )
 
-            filter_string = generateFilterString(user_token)
+            filter_string = generateFilterString(await group_resolver.groups(user_token))
             logging.debug(f"FILTER: {filter_string}")
             return filter_string
         
@@ -336,14 +508,17 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
         *args,
         **kwargs
     ):
-        request = kwargs.pop('request', None)
-        if request and self.permitted_groups_column:
-            self.filter = self._set_filter_string(request)
+        ## the permitted groups filter is resolved per request with _set_filter_string and passed in,
+        ## these settings are shared by every request
+        kwargs.pop('request', None)
+        filter_string = kwargs.pop('filter_string', None)
             
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
         parameters = self.model_dump(exclude_none=True, by_alias=True)
         parameters.update(self._settings.search.model_dump(exclude_none=True, by_alias=True))
+        if filter_string:
+            parameters["filter"] = filter_string
         
         return {
             "type": self._type,
@@ -764,6 +939,12 @@ class _AppSettings(BaseModel):
     azure_openai: _AzureOpenAISettings = _AzureOpenAISettings()
     search: _SearchCommonSettings = _SearchCommonSettings()
     ui: Optional[_UiSettings] = _UiSettings()
+    history_storage: _HistoryStorageSettings = _HistoryStorageSettings()
+    history_archive: _HistoryArchiveSettings = _HistoryArchiveSettings()
+    readiness: _ReadinessSettings = _ReadinessSettings()
+    graph: _GraphSettings = _GraphSettings()
+    claims_store: _ClaimsStoreSettings = _ClaimsStoreSettings()
+    analytics: _AnalyticsSettings = _AnalyticsSettings()
     
     # Constructed properties
     chat_history: Optional[_ChatHistorySettings] = None
@@ -1,14 +1,17 @@
 import os
 import json
+import zlib
+import asyncio
 import logging
-import requests
 import dataclasses
 import httpx
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
 from azure.search.documents.models import QueryType
+from azure.core.exceptions import HttpResponseError
+from backend.search.gateway import SearchResultStream, search_gateway
+from backend.search.aggregation import AggregationPlanner, is_field_capability_error
+from backend.search.groupby import KEY_FIELD, GroupByAccumulator, metric_name, scan_group_by
 
-from typing import List, Dict, Any, Optional
+from typing import AsyncIterator, List, Dict, Any, Optional, Tuple
 
 DEBUG = os.environ.get("DEBUG", "false")
 if DEBUG.lower() == "true":
@@ -35,6 +38,45 @@ async def format_as_ndjson(r):
         yield json.dumps({"error": str(error)})
 
 
+async def gzip_stream(chunks):
+    ## compress a text stream chunk by chunk instead of buffering all of it
+    compressor = zlib.compressobj(wbits=31)
+    async for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+async def prefetch(items: AsyncIterator, size: int) -> AsyncIterator:
+    ## read up to size items ahead of the consumer, so fetching the next overlaps sending the
+    ## last while a slow client still holds back the producer
+    queue = asyncio.Queue(maxsize=size)
+    end = object()
+
+    async def produce():
+        try:
+            async for item in items:
+                await queue.put((item, None))
+        except Exception as e:
+            await queue.put((None, e))
+        else:
+            await queue.put((end, None))
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            item, error = await queue.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+
+
 def parse_multi_columns(columns: str) -> list:
     if "|" in columns:
         return columns.split("|")
@@ -42,41 +84,12 @@ def parse_multi_columns(columns: str) -> list:
         return columns.split(",")
 
 
-def fetchUserGroups(userToken, nextLink=None):
-    # Recursively fetch group membership
-    if nextLink:
-        endpoint = nextLink
-    else:
-        endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
-
-    headers = {"Authorization": "bearer " + userToken}
-    try:
-        r = requests.get(endpoint, headers=headers)
-        if r.status_code != 200:
-            logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
-            return []
-
-        r = r.json()
-        if "@odata.nextLink" in r:
-            nextLinkData = fetchUserGroups(userToken, r["@odata.nextLink"])
-            r["value"].extend(nextLinkData)
-
-        return r["value"]
-    except Exception as e:
-        logging.error(f"Exception in fetchUserGroups: {e}")
-        return []
-
-
-def generateFilterString(userToken):
-    # Get list of groups user is a member of
-    userGroups = fetchUserGroups(userToken)
-
-    # Construct filter string
-    if not userGroups:
+def generateFilterString(group_ids: List[str]) -> str:
+    ## the user's groups come from GraphGroupResolver in backend/auth/graph.py
+    if not group_ids:
         logging.debug("No user groups found")
 
-    group_ids = ", ".join([obj["id"] for obj in userGroups])
-    return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{group_ids}'))"
+    return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{', '.join(group_ids)}'))"
 
 
 def format_non_streaming_response(chatCompletion, history_metadata, apim_request_id):
@@ -219,61 +232,111 @@ def comma_separated_string_to_list(s: str) -> List[str]:
     return s.strip().replace(' ', '').split(',')
 
 
-async def perform_direct_search_query(
-    endpoint: str, 
-    key: str, 
-    index_name: str, 
-    query_text: str, 
+def stable_order_by(order_by: Optional[str], key_field: str = KEY_FIELD) -> str:
+    ## end the sort on the unique key, so the service's pages of one query don't repeat or skip ties
+    clauses = [clause.strip() for clause in order_by.split(",") if clause.strip()] if order_by else []
+    clauses = clauses or ["search.score() desc"]
+    if not any(clause.split()[0] == key_field for clause in clauses):
+        clauses.append(f"{key_field} asc")
+    return ",".join(clauses)
+
+
+async def stream_direct_search_query(
+    endpoint: str,
+    key: str,
+    index_name: str,
+    query_text: str,
     filter_str: str = None,
     top_k: int = 50,
     select: str = None,
-    order_by: str = None
-) -> Dict[str, Any]:
+    order_by: str = None,
+    timeout: float = None,
+    page_size: int = 100
+) -> AsyncIterator[Dict[str, Any]]:
     """
-    Directly query Azure Search without going through the OpenAI model.
-    This allows performing direct aggregations and retrieving all documents.
-    
-    Args:
-        endpoint: Azure Search endpoint
-        key: Azure Search API key
-        index_name: Name of the index to query
-        query_text: The search query or "*" for all documents
-        filter_str: Optional filter expression
-        top_k: Number of documents to retrieve
-        select: Comma-separated list of fields to return
-        order_by: Field to order results by
-    
-    Returns:
-        Dictionary with results and count
+    Directly query Azure Search without going through the OpenAI model,
+    yielding the results ``page_size`` at a time; the first page also
+    carries the total count.
+
+    Every page comes from the one query, following the service's own
+    continuation, and the sort ends on the key so the order is total:
+    a document is never repeated or skipped between pages. The count is
+    a ``top=0`` query of its own run alongside, because reading it from
+    the results stream would end that stream's paging.
     """
+    async def count():
+        stream = await open_search_stream(endpoint, key, index_name, query_text, filter_str, 0, None, None, timeout)
+        return await stream.get_count()
+
+    counting = asyncio.ensure_future(count())
+    pages = None
     try:
-        # Set up the search client
-        credential = AzureKeyCredential(key)
-        client = SearchClient(endpoint=endpoint, index_name=index_name, credential=credential)
-        
-        # Execute the search query
-        results = client.search(
-            search_text=query_text,
-            filter=filter_str,
-            top=top_k,
-            select=select.split(',') if select else None,
-            order_by=order_by,
-            query_type=QueryType.SIMPLE if query_text != "*" else None,
-            include_total_count=True
-        )
-        
-        # Convert results to a list
-        result_list = list(results)
-        
-        # Return results along with total count
-        return {
-            "results": result_list,
-            "count": results.get_count() 
-        }
-        
-    except Exception as e:
-        logging.error(f"Error performing direct search query: {str(e)}")
-        raise
+        try:
+            stream = await open_search_stream(
+                endpoint, key, index_name, query_text, filter_str, top_k, select, stable_order_by(order_by), timeout,
+                include_total_count=False
+            )
+            pages = stream.pages()
+            buffered = await anext(pages, [])
+        except HttpResponseError as e:
+            if not is_field_capability_error(e):
+                raise
+            ## the key isn't sortable in this index, fall back to the order asked for
+            logging.debug(f"Can't sort {index_name} by {KEY_FIELD}, paging without a tiebreaker: {e}")
+            stream = await open_search_stream(
+                endpoint, key, index_name, query_text, filter_str, top_k, select, order_by, timeout,
+                include_total_count=False
+            )
+            pages = stream.pages()
+            buffered = await anext(pages, [])
+
+        first = {"count": await counting}
+        while True:
+            while len(buffered) >= page_size:
+                yield {"results": buffered[:page_size], **first}
+                buffered, first = buffered[page_size:], {}
+            page = await anext(pages, None)
+            if page is None:
+                break
+            buffered += page
+        if buffered or first:
+            yield {"results": buffered, **first}
+    finally:
+        if pages is not None:
+            await pages.aclose()
+        if not counting.done():
+            counting.cancel()
+        elif not counting.cancelled():
+            ## retrieved, so a count failing after the results did isn't logged as never retrieved
+            counting.exception()
+
+
+async def open_search_stream(
+    endpoint: str,
+    key: str,
+    index_name: str,
+    query_text: str,
+    filter_str: str = None,
+    top_k: int = 50,
+    select: str = None,
+    order_by: str = None,
+    timeout: float = None,
+    include_total_count: bool = True
+) -> SearchResultStream:
+    ## results are read page by page from the stream, nothing is fetched until then
+    return await search_gateway.search(
+        endpoint,
+        key,
+        index_name,
+        timeout=timeout,
+        search_text=query_text,
+        filter=filter_str,
+        top=top_k,
+        select=select.split(',') if select else None,
+        order_by=order_by,
+        query_type=QueryType.SIMPLE if query_text != "*" else None,
+        include_total_count=include_total_count
+    )
 
 
 async def perform_search_aggregation(
@@ -283,7 +346,8 @@ async def perform_search_aggregation(
     field: str,
     aggregation_type: str = "avg",
     filter_str: str = None,
-    query_text: str = "*"
+    query_text: str = "*",
+    timeout: float = None
 ) -> Dict[str, Any]:
     """
     Perform aggregation operations directly on Azure Search data.
@@ -293,54 +357,21 @@ async def perform_search_aggregation(
         key: Azure Search API key
         index_name: Name of the index to query
         field: Field to aggregate on
-        aggregation_type: Type of aggregation (avg, sum, min, max, count)
+        aggregation_type: Type of aggregation (avg, sum, min, max, count, a percentile
+            such as median or p95, or distinct)
         filter_str: Optional filter expression
         query_text: The search query or "*" for all documents
+        timeout: Seconds the whole query may take, the gateway default if not given
     
     Returns:
-        Dictionary with aggregation result
+        Dictionary with aggregation result, how it was computed ("strategy")
+        and whether it is exact
     """
     try:
-        # Get all matching documents
-        search_results = await perform_direct_search_query(
-            endpoint=endpoint,
-            key=key,
-            index_name=index_name,
-            query_text=query_text,
-            filter_str=filter_str,
-            top_k=1000,  # Use a high value to get as many documents as possible
-            select=field
+        planner = AggregationPlanner(
+            endpoint, key, index_name, query_text=query_text, filter_str=filter_str, timeout=timeout
         )
-        
-        # Extract the values of the specified field
-        values = [doc[field] for doc in search_results["results"] if field in doc and doc[field] is not None]
-        
-        # Ensure we have numeric values
-        numeric_values = [float(val) for val in values if val is not None]
-        
-        if not numeric_values:
-            return {"error": f"No numeric values found for field '{field}'"}
-        
-        # Perform the requested aggregation
-        if aggregation_type.lower() == "avg":
-            result = sum(numeric_values) / len(numeric_values)
-        elif aggregation_type.lower() == "sum":
-            result = sum(numeric_values)
-        elif aggregation_type.lower() == "min":
-            result = min(numeric_values)
-        elif aggregation_type.lower() == "max":
-            result = max(numeric_values)
-        elif aggregation_type.lower() == "count":
-            result = len(numeric_values)
-        else:
-            return {"error": f"Unsupported aggregation type: {aggregation_type}"}
-        
-        return {
-            "result": result,
-            "count": len(numeric_values),
-            "aggregation_type": aggregation_type,
-            "field": field
-        }
+        return await planner.aggregate(field, aggregation_type)
         
     except Exception as e:
         logging.error(f"Error performing search aggregation: {str(e)}")
@@ -357,96 +388,107 @@ async def perform_analytics_query(
     filter_str: str = None,
     query_text: str = "*",
     top_results: int = 10,
-    order: str = "desc"
+    order: str = "desc",
+    timeout: float = None,
+    metrics: Optional[List[Tuple[str, str]]] = None
 ) -> Dict[str, Any]:
+    """
+    Group matching documents by ``group_by_field`` with a count per group
+    and, optionally, metrics. ``metric_field``/``metric_function`` is the
+    primary metric results are sorted by; ``metrics`` adds more
+    (field, function) pairs computed in the same pass.
+    """
     try:
-        fields_to_select = [group_by_field]
-        if metric_field and metric_field != group_by_field:
-            fields_to_select.append(metric_field)
-            
-        select_str = ",".join(fields_to_select)
+        if not metrics and (not metric_field or metric_function == "count"):
+            ## group counts come straight from facets when the field is facetable
+            planner = AggregationPlanner(
+                endpoint, key, index_name, query_text=query_text, filter_str=filter_str, timeout=timeout
+            )
+            faceted = await planner.group_counts(group_by_field)
+            if faceted is not None:
+                if not faceted["total_documents"]:
+                    return {
+                        "error": "No documents found matching the query"
+                    }
+                results = sorted(
+                    ({"group": group, "count": count} for group, count in faceted["groups"].items()),
+                    key=lambda x: x["count"], reverse=(order.lower() == "desc")
+                )
+                return {
+                    "results": results[:top_results],
+                    "total_groups": len(faceted["groups"]),
+                    "total_documents": faceted["total_documents"],
+                    "group_by_field": group_by_field,
+                    "metric_function": metric_function,
+                    "metric_field": None,
+                    "strategy": "facets",
+                    "exact": faceted["exact"],
+                }
         
-        search_results = await perform_direct_search_query(
-            endpoint=endpoint,
-            key=key,
-            index_name=index_name,
-            query_text=query_text,
-            filter_str=filter_str,
-            top_k=10000,  # Use a high value to get comprehensive results
-            select=select_str
-        )
+        metrics = list(metrics or [])
+        if metric_field and metric_function != "count":
+            metrics.insert(0, (metric_field, metric_function))
+        accumulator = GroupByAccumulator(group_by_field, metrics)
+
+        async def search(**search_args):
+            return await search_gateway.search(
+                endpoint, key, index_name, timeout=timeout, search_text=query_text,
+                query_type=QueryType.SIMPLE if query_text != "*" else None, **search_args
+            )
 
-        documents = search_results["results"]
-        total_docs = search_results["count"]
-        
-        if not documents:
+        ## one pass over every match, paged by id, keeping running totals per group
+        scanned = await scan_group_by(search, accumulator, filter_str)
+        if not accumulator.documents:
             return {
                 "error": "No documents found matching the query"
             }
 
-        groups = {}
-        for doc in documents:
-            if group_by_field not in doc or doc[group_by_field] is None:
-                continue
-                
-            group_value = doc[group_by_field]
-
-            if group_value not in groups:
-                groups[group_value] = []
-
-            groups[group_value].append(doc)
-
-        results = []
-        for group_value, group_docs in groups.items():
-            result = {
-                "group": group_value,
-                "count": len(group_docs)
-            }
-
-            if metric_field and metric_function != "count":
-                metric_values = []
-                for doc in group_docs:
-                    if metric_field in doc and doc[metric_field] is not None:
-                        try:
-                            metric_values.append(float(doc[metric_field]))
-                        except (ValueError, TypeError):
-                            # Skip values that can't be converted to float
-                            pass
-                
-                # Calculate the metric
-                if metric_values:
-                    if metric_function == "sum":
-                        result["metric"] = sum(metric_values)
-                    elif metric_function == "avg":
-                        result["metric"] = sum(metric_values) / len(metric_values)
-                    elif metric_function == "min":
-                        result["metric"] = min(metric_values)
-                    elif metric_function == "max":
-                        result["metric"] = max(metric_values)
-                    else:
-                        result["metric"] = len(metric_values)
-                    
-                    result["metric_function"] = metric_function
-                    result["metric_field"] = metric_field
-            
-            results.append(result)
-
-        if metric_function != "count" and any("metric" in r for r in results):
-            results.sort(key=lambda x: x.get("metric", 0), reverse=(order.lower() == "desc"))
-        else:
-            results.sort(key=lambda x: x["count"], reverse=(order.lower() == "desc"))
-
-        results = results[:top_results]
-        
-        return {
-            "results": results,
-            "total_groups": len(groups),
-            "total_documents": total_docs,
-            "group_by_field": group_by_field,
-            "metric_function": metric_function,
-            "metric_field": metric_field if metric_function != "count" else None
-        }
+        sort_by = metric_name(*metrics[0]) if metrics else "count"
+        results = accumulator.results(sort_by=sort_by, order=order, top=top_results)
+        return format_analytics_result(
+            results, len(accumulator.groups), scanned, group_by_field, metric_field, metric_function, metrics
+        )
         
     except Exception as e:
         logging.error(f"Error performing analytics query: {str(e)}")
         raise
+
+
+def format_analytics_result(
+    results: List[dict],
+    total_groups: int,
+    scanned: Dict[str, Any],
+    group_by_field: str,
+    metric_field: Optional[str],
+    metric_function: str,
+    metrics: List[Tuple[str, str]]
+) -> Dict[str, Any]:
+    """
+    The /analytics response for group-by ``results`` (rows from
+    ``GroupByAccumulator.results``), whichever engine computed them.
+    ``metrics`` starts with the primary metric when there is one. Metrics
+    an engine estimated from a sketch are listed in ``error_bounds``.
+    """
+    if metric_field and metric_function != "count":
+        primary = metric_name(metric_field, metric_function)
+        for result in results:
+            value = result["metrics"][primary]
+            if value is not None:
+                result["metric"] = value
+                result["metric_function"] = metric_function
+                result["metric_field"] = metric_field
+
+    result = {
+        "results": results,
+        "total_groups": total_groups,
+        "total_documents": scanned["total_documents"],
+        "group_by_field": group_by_field,
+        "metric_function": metric_function,
+        "metric_field": metric_field if metric_function != "count" else None,
+        "metrics": [metric_name(field, function) for field, function in metrics],
+        "strategy": scanned["strategy"],
+        "exact": scanned["exact"]
+    }
+    if scanned.get("error_bounds"):
+        result["error_bounds"] = scanned["error_bounds"]
+    return result
@@ -10,6 +10,7 @@ import {
   ConversationRequest, 
   CosmosDBHealth, 
   CosmosDBStatus, 
+  DirectSearchPage,
   DirectSearchRequest, 
   DirectSearchResult, 
   UserInfo 
@@ -366,7 +367,10 @@ export const historyMessageFeedback = async (messageId: string, feedback: string
   return response
 }
 
-export const directSearch = async (options: DirectSearchRequest): Promise<DirectSearchResult | null> => {
+export const directSearch = async (
+  options: DirectSearchRequest,
+  onPage?: (page: DirectSearchPage) => void
+): Promise<DirectSearchResult | null> => {
   try {
     const response = await fetch('/direct_search', {
       method: 'POST',
@@ -376,13 +380,35 @@ export const directSearch = async (options: DirectSearchRequest): Promise<Direct
       body: JSON.stringify(options)
     })
     
-    if (!response.ok) {
+    if (!response.ok || !response.body) {
       const errorText = await response.text()
       console.error(`Error performing direct search: ${errorText}`)
       return null
     }
     
-    return await response.json() as DirectSearchResult
+    // NDJSON, a page of results per line; the first line also has the total count
+    const result: DirectSearchResult = { results: [], count: 0 }
+    const reader = response.body.getReader()
+    const decoder = new TextDecoder('utf-8')
+    let buffered = ''
+    const readLine = (line: string) => {
+      if (!line.trim()) return
+      const page = JSON.parse(line) as DirectSearchPage
+      if (page.error) throw Error(page.error)
+      if (page.count !== undefined && page.count !== null) result.count = page.count
+      result.results.push(...(page.results ?? []))
+      onPage?.(page)
+    }
+    while (true) {
+      const { done, value } = await reader.read()
+      if (done) break
+      buffered += decoder.decode(value, { stream: true })
+      const lines = buffered.split('\n')
+      buffered = lines.pop() ?? ''
+      lines.forEach(readLine)
+    }
+    readLine(buffered)
+    return result
   } catch (err) {
     console.error('Error performing direct search:', err)
     return null
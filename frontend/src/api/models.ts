@@ -172,6 +172,12 @@ export type DirectSearchResult = {
   count: number
 }
 
+export type DirectSearchPage = {
+  results?: any[]
+  count?: number | null
+  error?: string
+}
+
 // Aggregation API Types
 export enum AggregationType {
   Average = 'avg',
@@ -0,0 +1,184 @@
+"""
+Benchmark the analytics group-by over synthetic claims.
+
+Usage (from the repository root):
+
+    python -m scripts.benchmark_analytics                      # 1M claims
+    python -m scripts.benchmark_analytics --claims 200000 --group-by procedureCode
+
+Claims are served by an in-process stand-in for the search service that
+honours the query shape the engine sends (id range filter, id order, top,
+1,000 documents per page), so the numbers measure the engine rather than
+the network. The list-based group-by the engine replaced is run on the same
+documents for comparison; it has no cap here, so both see every claim.
+The same claims are then loaded into the in-memory columnar store and the
+group-bys repeated there.
+"""
+import time
+import random
+import asyncio
+import argparse
+import tracemalloc
+from bisect import bisect_right
+
+from backend.analytics.columnar import CLAIM_FIELDS, ColumnsBuilder
+from backend.search.groupby import GroupByAccumulator, keyset_pages, metric_name, scan_group_by
+
+PAGE_SIZE = 1000
+INSURERS = ["BlueCross BlueShield", "UnitedHealthcare", "Cigna", "Aetna", "Humana", "Kaiser", "Anthem", "Medicare"]
+PROCEDURES = [str(code) for code in range(99201, 99500)]
+STATES = ["CA", "TX", "NY", "FL", "IL", "PA", "OH", "GA", "NC", "MI", "CO", "OR", "MA", "AZ"]
+
+
+class SyntheticClaims():
+    """Columns for ``count`` claims; documents are built per page, like results off the wire."""
+
+    def __init__(self, count, seed=7):
+        rng = random.Random(seed)
+        self.ids = [f"{i:09d}" for i in range(count)]
+        self.columns = {
+            "insuranceCompany": [rng.choice(INSURERS) for _ in range(count)],
+            "procedureCode": [rng.choice(PROCEDURES) for _ in range(count)],
+            "patientState": [rng.choice(STATES) for _ in range(count)],
+            "claimAmount": [round(rng.lognormvariate(5, 0.8), 2) for _ in range(count)],
+            "amountPaid": [round(rng.lognormvariate(4.5, 0.9), 2) for _ in range(count)],
+        }
+        self.queries = 0
+
+    def document(self, i, select):
+        ## fields the synthetic claims don't have come back null, as unset index fields do
+        return {"id": self.ids[i], **{field: self.columns[field][i] if field in self.columns else None for field in select if field != "id"}}
+
+    async def search(self, filter=None, order_by=None, select=None, top=None, include_total_count=False, **_):
+        self.queries += 1
+        start = 0
+        if filter and "id gt '" in filter:
+            last_key = filter.split("id gt '")[1].split("'")[0]
+            start = bisect_right(self.ids, last_key)
+        end = min(len(self.ids), start + top) if top is not None else len(self.ids)
+        return _Stream(self, start, end, select or list(self.columns), len(self.ids))
+
+
+class _Stream():
+    def __init__(self, claims, start, end, select, total):
+        self.claims, self.start, self.end, self.select, self.total = claims, start, end, select, total
+
+    async def pages(self):
+        for page_start in range(self.start, self.end, PAGE_SIZE):
+            yield [self.claims.document(i, self.select) for i in range(page_start, min(page_start + PAGE_SIZE, self.end))]
+
+    async def documents(self):
+        async for page in self.pages():
+            for document in page:
+                yield document
+
+    async def get_count(self):
+        return self.total
+
+
+async def legacy_group_by(claims, group_by_field, metric_field, metric_function):
+    ## the previous implementation: collect every document, then per-group lists of documents and floats
+    stream = await claims.search(select=[group_by_field, metric_field], top=len(claims.ids))
+    documents = [document async for document in stream.documents()]
+    groups = {}
+    for document in documents:
+        if document.get(group_by_field) is None:
+            continue
+        groups.setdefault(document[group_by_field], []).append(document)
+    results = []
+    for group_value, group_documents in groups.items():
+        values = [float(document[metric_field]) for document in group_documents if document.get(metric_field) is not None]
+        metric = {"sum": sum, "avg": lambda v: sum(v) / len(v), "min": min, "max": max}[metric_function](values)
+        results.append({"group": group_value, "count": len(group_documents), "metric": metric})
+    results.sort(key=lambda result: result["metric"], reverse=True)
+    return results
+
+
+async def engine_group_by(claims, group_by_field, metrics):
+    accumulator = GroupByAccumulator(group_by_field, metrics)
+    scanned = await scan_group_by(claims.search, accumulator)
+    return accumulator.results(sort_by=metric_name(*metrics[0])), scanned
+
+
+async def load_columns(claims):
+    ## what ClaimsStore.load_from_index does, against the synthetic claims
+    builder = ColumnsBuilder()
+    async for page in keyset_pages(claims.search, None, list(CLAIM_FIELDS)):
+        builder.add_page(page)
+    return builder.build("synthetic claims")
+
+
+async def measure(label, coro_factory):
+    ## timed untraced, then run again under tracemalloc for the peak, which slows allocation down
+    start = time.perf_counter()
+    result = await coro_factory()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    await coro_factory()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"   {label:<34}{elapsed:>10.2f}s{peak / 1024 / 1024:>12.1f} MB")
+    return result
+
+
+async def main(args):
+    print(f"🧪 Generating {args.claims:,} synthetic claims...")
+    claims = SyntheticClaims(args.claims)
+
+    print(f"\n📊 Group by {args.group_by}, {args.claims:,} claims")
+    print(f"   {'implementation':<34}{'time':>11}{'peak memory':>13}")
+    legacy = await measure(
+        "list-based, avg(claimAmount)",
+        lambda: legacy_group_by(claims, args.group_by, "claimAmount", "avg"),
+    )
+    claims.queries = 0
+    single, scanned = await measure(
+        "streaming, avg(claimAmount)",
+        lambda: engine_group_by(claims, args.group_by, [("claimAmount", "avg")]),
+    )
+    print(f"   ({claims.queries // 2} keyset queries per run, strategy {scanned['strategy']}, exact {scanned['exact']})")
+    multi, _ = await measure(
+        "streaming, 5 metrics in one pass",
+        lambda: engine_group_by(claims, args.group_by, [
+            ("claimAmount", "avg"), ("claimAmount", "sum"), ("claimAmount", "max"),
+            ("amountPaid", "avg"), ("amountPaid", "min"),
+        ]),
+    )
+
+
+    print(f"\n🧮 Columnar store, {args.claims:,} claims")
+    start = time.perf_counter()
+    columns = await load_columns(claims)
+    print(f"   loaded in {time.perf_counter() - start:.2f}s, {sum(column.nbytes for column in columns.numeric.values()) / 1024 / 1024:.1f} MB of amounts")
+    columnar = {}
+    for label, metrics in (("avg(claimAmount)", [("claimAmount", "avg")]), ("5 metrics", [
+        ("claimAmount", "avg"), ("claimAmount", "sum"), ("claimAmount", "max"),
+        ("amountPaid", "avg"), ("amountPaid", "min"),
+    ])):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            columnar[label] = columns.group_by(args.group_by, metrics, sort_by=metric_name(*metrics[0]))["results"]
+        print(f"   {'group-by, ' + label:<34}{(time.perf_counter() - start) / args.repeat * 1000:>10.2f}ms")
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        columns.group_by(args.group_by, [("claimAmount", "avg")], filter_str="claimAmount gt 200 and patientState ne 'CA'")
+    print(f"   {'filtered group-by':<34}{(time.perf_counter() - start) / args.repeat * 1000:>10.2f}ms")
+
+    ## every implementation must agree
+    legacy_by_group = {row["group"]: row for row in legacy}
+    for row in single + columnar["avg(claimAmount)"]:
+        expected = legacy_by_group[row["group"]]
+        assert row["count"] == expected["count"], row["group"]
+        assert abs(row["metrics"]["avg_claimAmount"] - expected["metric"]) < 1e-6, row["group"]
+    assert len(multi) == len(single) == len(columnar["5 metrics"])
+    print(f"\n✅ {len(single)} groups, results match")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the streaming analytics group-by")
+    parser.add_argument("--claims", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=20, help="columnar queries are timed over this many runs")
+    parser.add_argument("--group-by", default="insuranceCompany", choices=["insuranceCompany", "procedureCode", "patientState"])
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
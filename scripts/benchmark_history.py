@@ -0,0 +1,139 @@
+"""
+Run the same chat history workload against each history storage backend.
+
+Usage (from the repository root):
+
+    python -m scripts.benchmark_history --backend sqlite --backend cosmosdb
+
+The Cosmos backend reads the same AZURE_COSMOSDB_* variables as the app and
+writes into the configured container under throwaway user ids, deleting
+everything it created when it's done.
+"""
+import os
+import time
+import uuid
+import asyncio
+import argparse
+import tempfile
+import statistics
+from pathlib import Path
+from dotenv import load_dotenv
+
+load_dotenv(dotenv_path=Path('.') / '.env')
+
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.sqlitedbservice import SqliteConversationClient
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(q * (len(values) - 1))))
+    return values[index]
+
+
+class Timings():
+    def __init__(self):
+        self.samples = {}
+
+    async def measure(self, operation, coro):
+        start = time.perf_counter()
+        result = await coro
+        self.samples.setdefault(operation, []).append((time.perf_counter() - start) * 1000)
+        return result
+
+    def report(self, backend_name, elapsed):
+        total = sum(len(v) for v in self.samples.values())
+        print(f"\n📊 {backend_name}: {total} operations in {elapsed:.2f}s ({total / elapsed:.0f} ops/s)")
+        print(f"   {'operation':<24}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mean ms':>10}")
+        for operation, values in self.samples.items():
+            print(
+                f"   {operation:<24}{len(values):>8}{percentile(values, 0.5):>10.2f}"
+                f"{percentile(values, 0.95):>10.2f}{percentile(values, 0.99):>10.2f}{statistics.mean(values):>10.2f}"
+            )
+
+
+async def run_user_workload(client, timings, user_id, conversations, messages_per_conversation):
+    ## mirrors what the UI does: generate, update, list, read, feedback, rename, delete
+    conversation_ids = []
+    for c in range(conversations):
+        conversation = await timings.measure("create_conversation", client.create_conversation(user_id, f"benchmark {c}"))
+        conversation_ids.append(conversation['id'])
+        for m in range(messages_per_conversation):
+            role = "user" if m % 2 == 0 else "assistant"
+            content = f"benchmark message {m} " + "lorem ipsum " * 40
+            message = await timings.measure(
+                "create_message",
+                client.create_message(str(uuid.uuid4()), conversation['id'], user_id, {"role": role, "content": content})
+            )
+            if role == "assistant" and m % 4 == 1:
+                await timings.measure("update_message_feedback", client.update_message_feedback(user_id, message['id'], "positive"))
+
+    await timings.measure("get_conversations", client.get_conversations(user_id, offset=0, limit=25))
+    for conversation_id in conversation_ids:
+        conversation = await timings.measure("get_conversation", client.get_conversation(user_id, conversation_id))
+        await timings.measure("get_messages", client.get_messages(user_id, conversation_id))
+        conversation['title'] = "renamed"
+        await timings.measure("upsert_conversation", client.upsert_conversation(conversation))
+
+    for conversation_id in conversation_ids:
+        await timings.measure("delete_messages", client.delete_messages(conversation_id, user_id))
+        await timings.measure("delete_conversation", client.delete_conversation(user_id, conversation_id))
+
+
+async def run_benchmark(backend_name, client, users, conversations, messages_per_conversation, concurrency):
+    timings = Timings()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one_user():
+        async with semaphore:
+            await run_user_workload(client, timings, f"benchmark-{uuid.uuid4()}", conversations, messages_per_conversation)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_user() for _ in range(users)))
+    timings.report(backend_name, time.perf_counter() - start)
+    return timings
+
+
+def create_client(backend_name, sqlite_path):
+    if backend_name == "sqlite":
+        return SqliteConversationClient(database_path=sqlite_path, enable_message_feedback=True)
+
+    account = os.getenv("AZURE_COSMOSDB_ACCOUNT")
+    if not account:
+        raise ValueError("AZURE_COSMOSDB_ACCOUNT is required for the cosmosdb backend")
+    return CosmosConversationClient(
+        cosmosdb_endpoint=f"https://{account}.documents.azure.com:443/",
+        credential=os.getenv("AZURE_COSMOSDB_ACCOUNT_KEY"),
+        database_name=os.getenv("AZURE_COSMOSDB_DATABASE"),
+        container_name=os.getenv("AZURE_COSMOSDB_CONVERSATIONS_CONTAINER"),
+        enable_message_feedback=True,
+    )
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for backend_name in args.backend:
+            client = create_client(backend_name, args.sqlite_path or os.path.join(temp_dir, "history-benchmark.db"))
+            try:
+                await run_benchmark(
+                    backend_name, client, args.users, args.conversations, args.messages, args.concurrency
+                )
+            finally:
+                await client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark chat history storage backends")
+    parser.add_argument("--backend", action="append", choices=["sqlite", "cosmosdb"],
+                        help="backend to benchmark, repeat to compare several (default: sqlite)")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--conversations", type=int, default=5, help="conversations per user")
+    parser.add_argument("--messages", type=int, default=8, help="messages per conversation")
+    parser.add_argument("--concurrency", type=int, default=10, help="users running at the same time")
+    parser.add_argument("--sqlite-path", help="use this database file instead of a temporary one")
+    args = parser.parse_args()
+    args.backend = args.backend or ["sqlite"]
+
+    asyncio.run(main(args))
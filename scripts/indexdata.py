@@ -1,4 +1,5 @@
 import os
+import sys
 import time
 from dotenv import load_dotenv
 from pathlib import Path
@@ -21,12 +22,18 @@ from azure.search.documents.indexes.models import (
 
 from openai import AzureOpenAI
 
+## run as a file, the repository root isn't on the path for the backend package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from backend.analytics.columnar import ColumnsBuilder
+from backend.analytics.rollup import RollupBuilder
+
 def create_cms1500_healthcare_index(index_client, index_name, dimensions=3072):
     print(f"🔧 Creating/updating CMS-1500 healthcare index '{index_name}'...")
 
     fields = [
         # Core fields
-        SimpleField(name="id", type=SearchFieldDataType.String, key=True),
+        # filterable/sortable so analytics can page past the skip limit by id range
+        SimpleField(name="id", type=SearchFieldDataType.String, key=True, filterable=True, sortable=True),
         SearchableField(name="content", type=SearchFieldDataType.String),
         
         # Financial fields - crucial for aggregation
@@ -309,6 +316,23 @@ def prepare_cms1500_documents(excel_path):
         traceback.print_exc()
         return []
 
+def write_claims_rollup(documents, rollup_path):
+    builder = RollupBuilder()
+    builder.add_documents(documents)
+    cube = builder.build(f"{len(documents)} claims indexed {datetime.now(timezone.utc).isoformat()}")
+    cube.save(rollup_path)
+    print(f"🧮 Wrote the analytics rollup ({cube.describe()['cells']} cells, version {cube.version}) to {rollup_path}")
+    return cube
+
+def write_claims_columns(documents, snapshot_path):
+    builder = ColumnsBuilder()
+    builder.add_page(documents)
+    columns = builder.build(f"{len(documents)} claims indexed {datetime.now(timezone.utc).isoformat()}")
+    columns.save(snapshot_path)
+    print(f"🗂️ Wrote the claims columns ({columns.size} claims, version {columns.version}) to {snapshot_path}")
+    print("   Set CLAIMS_STORE_ENABLED=true for the backend to map them")
+    return columns
+
 def upload_documents_with_tracking(search_client, documents, openai_client, 
                                   batch_size=25, embedding_model="text-embedding-3-large"):
     total_docs = len(documents)
@@ -364,7 +388,9 @@ def index_cms1500_claims(
     index_name="healthcare_claims",
     embedding_model="text-embedding-3-large", 
     batch_size=25,
-    skip_index_creation=False
+    skip_index_creation=False,
+    rollup_path=None,
+    columns_path=None
 ):
     start_time = time.time()
     print(f"🚀 Starting CMS-1500 healthcare claims indexing process at {datetime.now().strftime('%H:%M:%S')}")
@@ -390,12 +416,25 @@ def index_cms1500_claims(
     if not documents:
         print("❌ No CMS-1500 healthcare claim documents were found to index")
         return None
+
+    ## written where the backend loads them from, only when it is configured to
+    if rollup_path:
+        write_claims_rollup(documents, rollup_path)
+    else:
+        print("ℹ️ ANALYTICS_ROLLUP_PATH isn't set, skipping the analytics rollup")
+    if columns_path:
+        write_claims_columns(documents, columns_path)
+    else:
+        print("ℹ️ CLAIMS_STORE_SNAPSHOT_PATH isn't set, skipping the claims columns snapshot")
     
     print(f"🔄 Uploading {len(documents)} CMS-1500 healthcare claim documents to '{index_name}' (batch size: {batch_size})")
     success_count, total_docs = upload_documents_with_tracking(
         search_client, documents, openai_client, batch_size, embedding_model
     )
 
+    if rollup_path and success_count < total_docs:
+        print(f"⚠️ The rollup covers all {total_docs} prepared claims; the backend won't answer from it while the index holds {success_count}")
+
     success_rate = (success_count / total_docs) * 100 if total_docs > 0 else 0
     elapsed_time = time.time() - start_time
     mins, secs = divmod(elapsed_time, 60)
@@ -438,6 +477,9 @@ if __name__ == "__main__":
     EXCEL_FILE_PATH = os.getenv("EXCEL_FILE_PATH", "50rowsrealisticdata_CLEANED.xlsx")
     INDEX_NAME = os.getenv("AZURE_SEARCH_INDEX_NAME", "healthcare_claims")
     EMBEDDING_MODEL = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYED_MODEL_NAME", "text-embedding-3-large")
+    ## the backend's own settings, so the outputs land where it loads them
+    ROLLUP_PATH = os.getenv("ANALYTICS_ROLLUP_PATH")
+    COLUMNS_PATH = os.getenv("CLAIMS_STORE_SNAPSHOT_PATH")
 
     openai_client = AzureOpenAI(
         api_key=AZURE_OPENAI_API_KEY,
@@ -453,6 +495,8 @@ if __name__ == "__main__":
         print("- ENDPOINT_URL")
         print("- AZURE_OPENAI_KEY")
         print("- EXCEL_FILE_PATH (optional, defaults to '50rowsrealisticdata_CLEANED.xlsx')")
+        print("- ANALYTICS_ROLLUP_PATH (optional, where to write the analytics rollup)")
+        print("- CLAIMS_STORE_SNAPSHOT_PATH (optional, where to write the claims columns snapshot)")
         exit(1)
 
     if not os.path.exists(EXCEL_FILE_PATH):
@@ -467,5 +511,7 @@ if __name__ == "__main__":
         openai_client=openai_client,
         index_name=INDEX_NAME,
         embedding_model=EMBEDDING_MODEL,
-        batch_size=25
+        batch_size=25,
+        rollup_path=ROLLUP_PATH,
+        columns_path=COLUMNS_PATH
     )
\ No newline at end of file
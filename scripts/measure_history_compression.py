@@ -0,0 +1,145 @@
+"""
+Measure what history message compression saves in storage and RU.
+
+Usage (from the repository root):
+
+    python -m scripts.measure_history_compression                    # synthetic messages, sizes only
+    python -m scripts.measure_history_compression --sample 500       # also real messages from the container
+    python -m scripts.measure_history_compression --cosmos           # also write/read RU against the container
+
+Sizes are the serialized document as Cosmos stores it. RU is measured by
+upserting and point-reading each message with and without compression
+under a throwaway user id, then deleting it.
+"""
+import os
+import json
+import uuid
+import random
+import asyncio
+import argparse
+from pathlib import Path
+from dotenv import load_dotenv
+
+load_dotenv(dotenv_path=Path('.') / '.env')
+
+from backend.history.compression import ContentCompression, decode_message
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.cosmosmetrics import track_operation
+from backend.history.partitioning import get_partition_strategy
+
+
+def synthetic_messages():
+    ## a tool message carrying search citations, the way conversation_internal stores message.context
+    random.seed(7)
+    citations = [
+        {
+            "content": f"Claim {i}: patient {random.randint(1000, 9999)} billed CPT {random.choice(['99213', '99214', '80053'])} "
+                       f"for ${random.uniform(50, 5000):.2f}, diagnosis {random.choice(['E11.9', 'I10', 'J45.909'])}. " * 6,
+            "id": str(uuid.uuid4()),
+            "title": f"CMS-1500 claim {i}",
+            "filepath": f"claims/claim-{i}.json",
+            "url": f"https://example.blob.core.windows.net/claims/claim-{i}.json",
+            "metadata": {"chunking": "none", "chunk_id": str(i)},
+            "chunk_id": str(i),
+        }
+        for i in range(20)
+    ]
+    answer = "Based on the claims data, the most frequently billed procedure is CPT 99213 [doc1]. " * 60
+    return [
+        ("tool citations", {"role": "tool", "content": json.dumps({"citations": citations, "intent": "[\"claims\"]"})}),
+        ("long answer", {"role": "assistant", "content": answer}),
+        ("short question", {"role": "user", "content": "What is the average claim amount?"}),
+    ]
+
+
+def document_size(document):
+    return len(json.dumps(document).encode('utf-8'))
+
+
+def create_client(compression):
+    account = os.getenv("AZURE_COSMOSDB_ACCOUNT")
+    if not account:
+        raise ValueError("AZURE_COSMOSDB_ACCOUNT is required")
+    return CosmosConversationClient(
+        cosmosdb_endpoint=f"https://{account}.documents.azure.com:443/",
+        credential=os.getenv("AZURE_COSMOSDB_ACCOUNT_KEY"),
+        database_name=os.getenv("AZURE_COSMOSDB_DATABASE"),
+        container_name=os.getenv("AZURE_COSMOSDB_CONVERSATIONS_CONTAINER"),
+        partition_strategy=get_partition_strategy(
+            os.getenv("HISTORY_STORAGE_PARTITION_STRATEGY", "client_ip"),
+            int(os.getenv("HISTORY_STORAGE_PARTITION_BUCKETS", 16)),
+        ),
+        content_compression=compression,
+    )
+
+
+async def measure_charges(client, input_message):
+    message = client.build_message(str(uuid.uuid4()), str(uuid.uuid4()), f"compression-probe-{uuid.uuid4()}", input_message)
+    partition_key = client.item_partition_key(message)
+    async with track_operation("compression_probe_write") as write_charge:
+        await client.container_client.upsert_item(message)
+    async with track_operation("compression_probe_read") as read_charge:
+        await client.container_client.read_item(item=message["id"], partition_key=partition_key)
+    await client.container_client.delete_item(item=message["id"], partition_key=partition_key)
+    return write_charge.request_charge, read_charge.request_charge
+
+
+def report_sizes(label, messages, compression):
+    raw_total = stored_total = 0
+    for name, input_message in messages:
+        plain = {"id": str(uuid.uuid4()), "type": "message", **input_message}
+        compressed = compression.encode_message(dict(plain))
+        assert decode_message(dict(compressed))["content"] == plain["content"]
+        raw, stored = document_size(plain), document_size(compressed)
+        raw_total += raw
+        stored_total += stored
+        if name:
+            print(f"   {name:<20}{raw:>12,}{stored:>12,}{(1 - stored / raw) * 100:>9.0f}%")
+    if raw_total:
+        print(f"   {label + ' total':<20}{raw_total:>12,}{stored_total:>12,}{(1 - stored_total / raw_total) * 100:>9.0f}%")
+
+
+async def main(args):
+    compression = ContentCompression(threshold=args.threshold, algorithm=args.algorithm)
+    messages = synthetic_messages()
+
+    print(f"📦 Document size in bytes ({compression.encoding}, threshold {args.threshold})")
+    print(f"   {'message':<20}{'plain':>12}{'stored':>12}{'saved':>10}")
+    report_sizes("synthetic", messages, compression)
+
+    if args.sample:
+        client = create_client(None)
+        try:
+            query = f"SELECT TOP {int(args.sample)} * FROM c WHERE c.type = 'message'"
+            sampled = [
+                (None, decode_message(item))
+                async for item in client.container_client.query_items(query=query, enable_cross_partition_query=True)
+            ]
+        finally:
+            await client.close()
+        report_sizes(f"{len(sampled)} stored", sampled, compression)
+
+    if args.cosmos:
+        plain_client, compressed_client = create_client(None), create_client(compression)
+        try:
+            print(f"\n📊 Request units per message")
+            print(f"   {'message':<20}{'write':>10}{'write zip':>11}{'read':>10}{'read zip':>10}")
+            for name, input_message in messages:
+                write, read = await measure_charges(plain_client, input_message)
+                compressed_write, compressed_read = await measure_charges(compressed_client, input_message)
+                print(f"   {name:<20}{write:>10.2f}{compressed_write:>11.2f}{read:>10.2f}{compressed_read:>10.2f}")
+        finally:
+            await plain_client.close()
+            await compressed_client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure history message compression savings")
+    parser.add_argument("--threshold", type=int, default=int(os.getenv("HISTORY_STORAGE_COMPRESSION_THRESHOLD", 4096)))
+    parser.add_argument("--algorithm", choices=["auto", "zstd", "gzip"],
+                        default=os.getenv("HISTORY_STORAGE_COMPRESSION_ALGORITHM", "auto"))
+    parser.add_argument("--sample", type=int, default=0, help="also measure this many stored messages")
+    parser.add_argument("--cosmos", action="store_true", help="measure write and read RU against the container")
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,137 @@
+"""
+Copy chat history from one Cosmos container to another that uses a different
+partition strategy, while the app keeps serving traffic.
+
+Usage (from the repository root):
+
+    python -m scripts.migrate_history_partitions \\
+        --source-container conversations --source-strategy client_ip \\
+        --target-container conversations-v2 --target-strategy principal --create-target
+
+Online migration:
+
+1. Create the target container (--create-target) and deploy the app with
+   AZURE_COSMOSDB_CONVERSATIONS_CONTAINER set to the target,
+   HISTORY_STORAGE_PARTITION_STRATEGY set to the target strategy and
+   AZURE_COSMOSDB_MIGRATION_SOURCE_CONTAINER set to the source. New writes go
+   to the target, reads merge both containers.
+2. Run this script. Documents the app already wrote or adopted are skipped.
+   Progress is checkpointed, so an interrupted run resumes where it stopped.
+3. Once it reports no failures, unset AZURE_COSMOSDB_MIGRATION_SOURCE_CONTAINER.
+
+Only the document layout changes. ``userId`` is copied as is, so moving from
+``client_ip`` to an identity based strategy cannot re-attribute legacy
+documents: the principal that wrote them was never recorded.
+"""
+import os
+import json
+import asyncio
+import argparse
+from pathlib import Path
+from dotenv import load_dotenv
+
+load_dotenv(dotenv_path=Path('.') / '.env')
+
+from azure.cosmos import PartitionKey, exceptions
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.indexingpolicy import HISTORY_INDEXING_POLICY
+from backend.history.partitioning import PARTITION_STRATEGIES, ClientIpPartitionStrategy, get_partition_strategy
+
+
+def create_client(container_name, strategy):
+    account = os.getenv("AZURE_COSMOSDB_ACCOUNT")
+    if not account:
+        raise ValueError("AZURE_COSMOSDB_ACCOUNT is required")
+    return CosmosConversationClient(
+        cosmosdb_endpoint=f"https://{account}.documents.azure.com:443/",
+        credential=os.getenv("AZURE_COSMOSDB_ACCOUNT_KEY"),
+        database_name=os.getenv("AZURE_COSMOSDB_DATABASE"),
+        container_name=container_name,
+        partition_strategy=strategy,
+    )
+
+
+def load_checkpoint(path):
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as checkpoint_file:
+            return json.load(checkpoint_file)
+    return {"continuation": None, "copied": 0, "skipped": 0, "failed": 0}
+
+
+def save_checkpoint(path, checkpoint):
+    if not path:
+        return
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(temp_path, path)
+
+
+async def copy_item(target, item, semaphore, checkpoint):
+    async with semaphore:
+        try:
+            await target.container_client.create_item(body=target.prepare_item(item))
+            checkpoint["copied"] += 1
+        except exceptions.CosmosResourceExistsError:
+            ## the app already wrote a newer copy, or an earlier run got here first
+            checkpoint["skipped"] += 1
+        except exceptions.CosmosHttpResponseError as e:
+            checkpoint["failed"] += 1
+            print(f"❌ Failed to copy {item.get('type')} {item.get('id')}: {e.message}")
+
+
+async def migrate(args):
+    source_strategy = get_partition_strategy(args.source_strategy, args.buckets)
+    target_strategy = get_partition_strategy(args.target_strategy, args.buckets)
+    if isinstance(source_strategy, ClientIpPartitionStrategy) != isinstance(target_strategy, ClientIpPartitionStrategy):
+        print("⚠️  Source and target identify users differently, copied documents keep their original userId")
+
+    source = create_client(args.source_container, source_strategy)
+    target = create_client(args.target_container, target_strategy)
+    try:
+        if args.create_target:
+            await target.database_client.create_container_if_not_exists(
+                id=args.target_container,
+                partition_key=PartitionKey(path=target_strategy.partition_key_path),
+                indexing_policy=HISTORY_INDEXING_POLICY,
+            )
+            print(f"🔧 Target container '{args.target_container}' partitioned on {target_strategy.partition_key_path}")
+
+        success, err = await target.ensure()
+        if not success:
+            raise ValueError(err)
+
+        checkpoint = load_checkpoint(args.checkpoint)
+        semaphore = asyncio.Semaphore(args.concurrency)
+        pages = source.container_client.read_all_items(max_item_count=args.page_size).by_page(checkpoint["continuation"])
+        async for page in pages:
+            items = [item async for item in page]
+            await asyncio.gather(*(copy_item(target, item, semaphore, checkpoint) for item in items))
+            checkpoint["continuation"] = pages.continuation_token
+            save_checkpoint(args.checkpoint, checkpoint)
+            print(f"   copied {checkpoint['copied']}, skipped {checkpoint['skipped']}, failed {checkpoint['failed']}")
+            if not checkpoint["continuation"]:
+                break
+
+        print(f"✅ Migration finished: {checkpoint['copied']} copied, {checkpoint['skipped']} already present, {checkpoint['failed']} failed")
+    finally:
+        await source.close()
+        await target.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy chat history into a container with a different partition strategy")
+    parser.add_argument("--source-container", default=os.getenv("AZURE_COSMOSDB_CONVERSATIONS_CONTAINER"))
+    parser.add_argument("--source-strategy", choices=PARTITION_STRATEGIES.keys(), default="client_ip")
+    parser.add_argument("--target-container", required=True)
+    parser.add_argument("--target-strategy", choices=PARTITION_STRATEGIES.keys(), default="principal")
+    parser.add_argument("--buckets", type=int, default=int(os.getenv("HISTORY_STORAGE_PARTITION_BUCKETS", 16)),
+                        help="bucket count for the hashed strategy")
+    parser.add_argument("--create-target", action="store_true", help="create the target container if it doesn't exist")
+    parser.add_argument("--concurrency", type=int, default=32, help="documents written at the same time")
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--checkpoint", default="history-migration.checkpoint.json",
+                        help="file recording progress so the copy can resume, empty to disable")
+    args = parser.parse_args()
+
+    asyncio.run(migrate(args))
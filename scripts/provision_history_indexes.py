@@ -0,0 +1,117 @@
+"""
+Apply the chat history indexing policy to the conversations container.
+
+Usage (from the repository root):
+
+    python -m scripts.provision_history_indexes            # show what would change
+    python -m scripts.provision_history_indexes --apply    # replace the policy
+
+The policy adds composite indexes for the get_conversations and
+get_messages query shapes and stops indexing message content and feedback
+(see backend/history/indexingpolicy.py). With --apply the script writes a
+representative message before and after the change and reports the write
+RU charged by each policy.
+"""
+import os
+import uuid
+import asyncio
+import argparse
+from pathlib import Path
+from dotenv import load_dotenv
+
+load_dotenv(dotenv_path=Path('.') / '.env')
+
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.cosmosmetrics import track_operation
+from backend.history.indexingpolicy import HISTORY_INDEXING_POLICY, indexing_policy_problems
+from backend.history.partitioning import PARTITION_STRATEGIES, get_partition_strategy
+
+INDEX_PROGRESS_HEADER = "x-ms-documentdb-collection-index-transformation-progress"
+
+
+def create_client(container_name, strategy):
+    account = os.getenv("AZURE_COSMOSDB_ACCOUNT")
+    if not account:
+        raise ValueError("AZURE_COSMOSDB_ACCOUNT is required")
+    return CosmosConversationClient(
+        cosmosdb_endpoint=f"https://{account}.documents.azure.com:443/",
+        credential=os.getenv("AZURE_COSMOSDB_ACCOUNT_KEY"),
+        database_name=os.getenv("AZURE_COSMOSDB_DATABASE"),
+        container_name=container_name,
+        enable_message_feedback=True,
+        partition_strategy=strategy,
+    )
+
+
+async def measure_write_charge(client, samples):
+    ## upsert a typical assistant answer a few times and return the average RU per write
+    user_id = f"index-probe-{uuid.uuid4()}"
+    conversation_id = str(uuid.uuid4())
+    content = "The claim was billed under CPT 99213 for an office visit. " * 40
+    charges = []
+    for _ in range(samples):
+        message = client.build_message(str(uuid.uuid4()), conversation_id, user_id, {"role": "assistant", "content": content})
+        async with track_operation("index_probe") as charge:
+            await client.container_client.upsert_item(message)
+        charges.append(charge.request_charge)
+        await client.container_client.delete_item(item=message["id"], partition_key=client.item_partition_key(message))
+    return sum(charges) / len(charges)
+
+
+async def wait_for_index_transformation(client):
+    while True:
+        headers = {}
+        await client.container_client.read(
+            populate_quota_info=True, response_hook=lambda response_headers, _: headers.update(response_headers)
+        )
+        progress = int(headers.get(INDEX_PROGRESS_HEADER, 100))
+        print(f"   index transformation {progress}%")
+        if progress >= 100:
+            return
+        await asyncio.sleep(5)
+
+
+async def provision(args):
+    client = create_client(args.container, get_partition_strategy(args.strategy, args.buckets))
+    try:
+        container_info = await client.container_client.read()
+        problems = indexing_policy_problems(container_info.get("indexingPolicy", {}))
+        if not problems:
+            print(f"✅ Container '{args.container}' already has the chat history indexing policy")
+            return
+
+        print(f"🔧 Container '{args.container}' indexing policy differs:")
+        for problem in problems:
+            print(f"   - {problem}")
+        if not args.apply:
+            print("Run again with --apply to replace it")
+            return
+
+        before = await measure_write_charge(client, args.samples)
+        await client.database_client.replace_container(
+            args.container,
+            partition_key=container_info["partitionKey"],
+            indexing_policy=HISTORY_INDEXING_POLICY,
+            default_ttl=container_info.get("defaultTtl"),
+        )
+        print("✅ Indexing policy replaced, waiting for the index transformation")
+        await wait_for_index_transformation(client)
+        after = await measure_write_charge(client, args.samples)
+
+        saving = (before - after) / before * 100 if before else 0
+        print(f"📊 Message write: {before:.2f} RU before, {after:.2f} RU after ({saving:.0f}% less)")
+    finally:
+        await client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Provision the chat history indexing policy")
+    parser.add_argument("--container", default=os.getenv("AZURE_COSMOSDB_CONVERSATIONS_CONTAINER"))
+    parser.add_argument("--strategy", choices=PARTITION_STRATEGIES.keys(),
+                        default=os.getenv("HISTORY_STORAGE_PARTITION_STRATEGY", "client_ip"))
+    parser.add_argument("--buckets", type=int, default=int(os.getenv("HISTORY_STORAGE_PARTITION_BUCKETS", 16)))
+    parser.add_argument("--apply", action="store_true", help="replace the container's indexing policy")
+    parser.add_argument("--samples", type=int, default=5, help="probe writes averaged for the RU comparison")
+    args = parser.parse_args()
+
+    asyncio.run(provision(args))
@@ -179,6 +179,10 @@ resource "azurerm_linux_web_app" "app" {
     ftps_state          = "FtpsOnly"
     app_command_line    = "python3 -m gunicorn app:app"
     http2_enabled       = false
+
+    # only route traffic to workers whose dependencies are warm, see /ready in app.py
+    health_check_path                 = "/ready"
+    health_check_eviction_time_in_min = 5
   }
 
   auth_settings_v2 {
@@ -0,0 +1,254 @@
+import re
+
+import pytest_asyncio
+from aiohttp import web
+
+## a stand-in for the subset of the Azure AI Search REST API the backend uses:
+## POST /indexes('<name>')/docs/search.post.search with search, filter, select,
+## orderby, top, skip, count and facets, paged with @search.nextPageParameters
+
+TOKEN_PATTERN = re.compile(r"\s*(?:(?P<string>'(?:[^']|'')*')|(?P<number>-?\d+(?:\.\d+)?)|(?P<name>[A-Za-z_][\w./]*)|(?P<punct>[(),:]))")
+COMPARISONS = {
+    "eq": lambda a, b: a == b,
+    "ne": lambda a, b: a != b,
+    "gt": lambda a, b: a is not None and b is not None and a > b,
+    "ge": lambda a, b: a is not None and b is not None and a >= b,
+    "lt": lambda a, b: a is not None and b is not None and a < b,
+    "le": lambda a, b: a is not None and b is not None and a <= b,
+}
+
+
+class FilterError(ValueError):
+    pass
+
+
+def tokenize(text):
+    tokens, position = [], 0
+    text = text.strip()
+    while position < len(text):
+        match = TOKEN_PATTERN.match(text, position)
+        if not match or match.end() == position:
+            raise FilterError(f"Can't parse filter at {text[position:]!r}")
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        position = match.end()
+    return tokens
+
+
+class FilterParser():
+    """OData $filter: comparisons, and/or/not, parentheses, search.in and collection/any(x: ...)."""
+
+    def __init__(self, text, filterable):
+        self.tokens = tokenize(text)
+        self.position = 0
+        self.filterable = filterable
+        ## range variables of the any() lambdas being parsed
+        self.variables = set()
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, value=None):
+        token = self.peek()
+        if value is not None and token[1] != value:
+            raise FilterError(f"Expected {value}, got {token[1]}")
+        self.position += 1
+        return token
+
+    def parse(self):
+        predicate = self.disjunction()
+        if self.position != len(self.tokens):
+            raise FilterError(f"Unexpected {self.peek()[1]}")
+        return predicate
+
+    def disjunction(self):
+        predicate = self.conjunction()
+        while self.peek()[1] == "or":
+            self.take()
+            left, right = predicate, self.conjunction()
+            predicate = lambda document, scope, left=left, right=right: left(document, scope) or right(document, scope)
+        return predicate
+
+    def conjunction(self):
+        predicate = self.negation()
+        while self.peek()[1] == "and":
+            self.take()
+            left, right = predicate, self.negation()
+            predicate = lambda document, scope, left=left, right=right: left(document, scope) and right(document, scope)
+        return predicate
+
+    def negation(self):
+        if self.peek()[1] == "not":
+            self.take()
+            inner = self.negation()
+            return lambda document, scope: not inner(document, scope)
+        return self.primary()
+
+    def value(self):
+        kind, text = self.take()
+        if kind == "string":
+            return lambda document, scope: text[1:-1].replace("''", "'")
+        if kind == "number":
+            number = float(text) if "." in text else int(text)
+            return lambda document, scope: number
+        if text == "null":
+            return lambda document, scope: None
+        if text in ("true", "false"):
+            return lambda document, scope: text == "true"
+        if kind == "name":
+            return self.field(text)
+        raise FilterError(f"Unexpected {text}")
+
+    def field(self, name):
+        def read(document, scope):
+            if name in scope:
+                return scope[name]
+            return document.get(name)
+        if name not in self.filterable and name not in self.variables and "/" not in name:
+            raise FilterError(f"Field {name} is not filterable")
+        return read
+
+    def primary(self):
+        kind, text = self.peek()
+        if text == "(":
+            self.take()
+            predicate = self.disjunction()
+            self.take(")")
+            return predicate
+        if text == "search.in":
+            self.take()
+            self.take("(")
+            subject = self.value()
+            self.take(",")
+            values = self.value()(None, {})
+            delimiters = " ,"
+            if self.peek()[1] == ",":
+                self.take()
+                delimiters = self.value()(None, {})
+            self.take(")")
+            allowed = {value for value in re.split(f"[{re.escape(delimiters)}]", values) if value}
+            return lambda document, scope: subject(document, scope) in allowed
+        if kind == "name" and text.endswith("/any"):
+            collection = text[:-len("/any")]
+            if collection not in self.filterable:
+                raise FilterError(f"Field {collection} is not filterable")
+            self.take()
+            self.take("(")
+            variable = self.take()[1]
+            self.take(":")
+            self.variables.add(variable)
+            inner = self.disjunction()
+            self.variables.discard(variable)
+            self.take(")")
+            return lambda document, scope: any(
+                inner(document, {**scope, variable: item}) for item in document.get(collection) or []
+            )
+
+        left = self.value()
+        operator = self.take()[1]
+        if operator not in COMPARISONS:
+            raise FilterError(f"Unknown operator {operator}")
+        right = self.value()
+        compare = COMPARISONS[operator]
+        return lambda document, scope: compare(left(document, scope), right(document, scope))
+
+
+class FakeSearchIndex():
+    def __init__(self, documents, key="id", filterable=None, sortable=None, facetable=None, page_size=50):
+        self.documents = documents
+        self.key = key
+        fields = {field for document in documents for field in document}
+        self.filterable = fields if filterable is None else set(filterable)
+        self.sortable = fields if sortable is None else set(sortable)
+        self.facetable = fields if facetable is None else set(facetable)
+        ## the real service returns at most 1000 documents a page (50 without $top)
+        self.page_size = page_size
+        self.requests = []
+
+    def search(self, body):
+        self.requests.append(body)
+        matches = list(self.documents)
+        if body.get("filter"):
+            predicate = FilterParser(body["filter"], self.filterable).parse()
+            matches = [document for document in matches if predicate(document, {})]
+
+        for clause in reversed([clause.strip() for clause in (body.get("orderby") or "").split(",") if clause.strip()]):
+            field, _, direction = clause.partition(" ")
+            if field == "search.score()":
+                ## every document scores the same here, and the sort is stable
+                continue
+            if field not in self.sortable:
+                raise FilterError(f"Field {field} is not sortable")
+            present = [document for document in matches if document.get(field) is not None]
+            missing = [document for document in matches if document.get(field) is None]
+            present.sort(key=lambda document: document[field], reverse=direction == "desc")
+            ## nulls sort first ascending, last descending
+            matches = present + missing if direction == "desc" else missing + present
+
+        response = {}
+        if body.get("count"):
+            response["@odata.count"] = len(matches)
+        if body.get("facets"):
+            facets = {}
+            for facet in body["facets"]:
+                field, _, options = facet.partition(",")
+                if field not in self.facetable:
+                    raise FilterError(f"Field {field} is not facetable")
+                limit = int(dict(option.split(":") for option in options.split(",") if option).get("count", 10))
+                counts = {}
+                for document in matches:
+                    if document.get(field) is not None:
+                        counts[document[field]] = counts.get(document[field], 0) + 1
+                buckets = sorted(counts.items(), key=lambda item: -item[1])[:limit]
+                facets[field] = [{"value": value, "count": count} for value, count in buckets]
+            response["@search.facets"] = facets
+
+        skip = body.get("skip") or 0
+        top = body.get("top")
+        requested = matches[skip:] if top is None else matches[skip:skip + top]
+        page = requested[:self.page_size]
+        select = [field.strip() for field in body["select"].split(",")] if body.get("select") else None
+        response["value"] = [
+            {"@search.score": 1.0, **{field: value for field, value in document.items() if select is None or field in select}}
+            for document in page
+        ]
+        if len(requested) > len(page):
+            next_page = dict(body, skip=skip + len(page))
+            if top is not None:
+                next_page["top"] = top - len(page)
+            response["@search.nextPageParameters"] = next_page
+            response["@odata.nextLink"] = "search.post.search"
+        return response
+
+
+class FakeSearchService():
+    def __init__(self):
+        self.indexes = {}
+        self.endpoint = None
+
+    def add_index(self, name, documents, **kwargs) -> FakeSearchIndex:
+        self.indexes[name] = FakeSearchIndex(documents, **kwargs)
+        return self.indexes[name]
+
+    async def handle(self, request):
+        match = re.match(r"^/indexes\('([^']+)'\)/docs/search\.post\.search$", request.path)
+        if request.method != "POST" or not match or match.group(1) not in self.indexes:
+            return web.json_response({"error": {"message": "Not found"}}, status=404)
+        try:
+            return web.json_response(self.indexes[match.group(1)].search(await request.json()))
+        except FilterError as e:
+            return web.json_response({"error": {"code": "InvalidRequestParameter", "message": str(e)}}, status=400)
+
+
+@pytest_asyncio.fixture
+async def search_service():
+    service = FakeSearchService()
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", service.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    service.endpoint = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+    yield service
+    await runner.cleanup()
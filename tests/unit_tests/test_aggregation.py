@@ -0,0 +1,107 @@
+import math
+
+import pytest
+import pytest_asyncio
+
+from backend.search import aggregation
+from backend.search.aggregation import AggregationPlanner
+from backend.search.gateway import SearchGateway
+
+CLAIMS = [
+    {"id": f"{i:03d}", "claimAmount": float(i * 10) if i % 5 else None, "claimType": ["auto", "home", "life"][i % 3]}
+    for i in range(1, 41)
+]
+AMOUNTS = [claim["claimAmount"] for claim in CLAIMS if claim["claimAmount"] is not None]
+
+
+@pytest_asyncio.fixture
+async def gateway():
+    gateway = SearchGateway(timeout=10)
+    yield gateway
+    await gateway.close()
+
+
+def planner(search_service, gateway, filter_str=None):
+    return AggregationPlanner(search_service.endpoint, "key", "claims", filter_str=filter_str, gateway=gateway)
+
+
+@pytest.mark.asyncio
+async def test_count_is_a_total_count_query(search_service, gateway):
+    index = search_service.add_index("claims", CLAIMS)
+    result = await planner(search_service, gateway).aggregate("claimAmount", "count")
+
+    assert result["result"] == len(AMOUNTS)
+    assert (result["strategy"], result["exact"]) == ("total_count", True)
+    assert [request["top"] for request in index.requests] == [0]
+
+
+@pytest.mark.asyncio
+async def test_min_and_max_read_one_document(search_service, gateway):
+    index = search_service.add_index("claims", CLAIMS)
+    minimum = await planner(search_service, gateway).aggregate("claimAmount", "min")
+    maximum = await planner(search_service, gateway).aggregate("claimAmount", "MAX")
+
+    assert (minimum["result"], maximum["result"]) == (min(AMOUNTS), max(AMOUNTS))
+    assert minimum["strategy"] == maximum["strategy"] == "order_by"
+    assert {request["orderby"] for request in index.requests if "orderby" in request} == {"claimAmount asc", "claimAmount desc"}
+    assert all(request["top"] <= 1 for request in index.requests)
+
+
+@pytest.mark.asyncio
+async def test_sum_and_avg_scan_every_page_once(search_service, gateway):
+    index = search_service.add_index("claims", CLAIMS, page_size=7)
+    total = await planner(search_service, gateway).aggregate("claimAmount", "sum")
+    average = await planner(search_service, gateway).aggregate("claimAmount", "avg")
+
+    assert total["result"] == sum(AMOUNTS)
+    assert average["result"] == pytest.approx(sum(AMOUNTS) / len(AMOUNTS))
+    assert total["exact"] and total["strategy"] == "scan"
+    ## the count comes with the first page rather than a query of its own
+    assert len(index.requests) == 2 * math.ceil(len(CLAIMS) / 7)
+
+
+@pytest.mark.asyncio
+async def test_filter_is_applied(search_service, gateway):
+    search_service.add_index("claims", CLAIMS)
+    result = await planner(search_service, gateway, filter_str="claimType eq 'auto'").aggregate("claimAmount", "sum")
+
+    assert result["result"] == sum(claim["claimAmount"] for claim in CLAIMS if claim["claimType"] == "auto" and claim["claimAmount"])
+
+
+@pytest.mark.asyncio
+async def test_falls_back_to_a_scan_when_the_field_is_not_sortable(search_service, gateway):
+    search_service.add_index("claims", CLAIMS, sortable=[])
+    result = await planner(search_service, gateway).aggregate("claimAmount", "max")
+
+    assert (result["result"], result["strategy"]) == (max(AMOUNTS), "scan")
+
+
+@pytest.mark.asyncio
+async def test_scan_past_the_limit_is_not_exact(search_service, gateway, monkeypatch):
+    monkeypatch.setattr(aggregation, "SCAN_LIMIT", 10)
+    search_service.add_index("claims", CLAIMS)
+    result = await planner(search_service, gateway).aggregate("claimAmount", "sum")
+
+    assert result["exact"] is False
+
+
+@pytest.mark.asyncio
+async def test_unknown_aggregation_and_no_values(search_service, gateway):
+    search_service.add_index("claims", CLAIMS)
+    assert "error" in await planner(search_service, gateway).aggregate("claimAmount", "mode")
+    assert "error" in await planner(search_service, gateway, filter_str="claimType eq 'none'").aggregate("claimAmount", "sum")
+
+
+@pytest.mark.asyncio
+async def test_group_counts_come_from_facets(search_service, gateway):
+    search_service.add_index("claims", CLAIMS)
+    grouped = await planner(search_service, gateway).group_counts("claimType")
+
+    assert grouped["groups"] == {"auto": 13, "home": 14, "life": 13}
+    assert grouped["total_documents"] == len(CLAIMS) and grouped["exact"]
+
+
+@pytest.mark.asyncio
+async def test_group_counts_need_a_facetable_field(search_service, gateway):
+    search_service.add_index("claims", CLAIMS, facetable=[])
+    assert await planner(search_service, gateway).group_counts("claimType") is None
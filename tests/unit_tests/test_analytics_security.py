@@ -0,0 +1,209 @@
+import json
+
+import pytest
+import pytest_asyncio
+
+from backend import utils
+from backend.analytics.columnar import ClaimsStore, ColumnsBuilder
+from backend.analytics.router import QueryRouter
+from backend.analytics.service import (
+    AggregationParams,
+    AnalyticsParams,
+    AnalyticsRequestError,
+    AnalyticsService,
+    AnalyticsUnavailableError,
+    DirectSearchParams,
+    LatencyTracker,
+    ResultCache,
+)
+from backend.analytics.tools import ToolRunner
+from backend.search import aggregation
+from backend.search.gateway import SearchGateway
+
+CLAIMS = [
+    {
+        "id": f"{i:03d}",
+        "claimAmount": float(i * 10),
+        "insuranceCompany": ["Aetna", "Cigna"][i % 2],
+        "permittedGroups": [["east"], ["west"], ["east", "west"]][i % 3],
+    }
+    for i in range(1, 31)
+]
+EAST = "permittedGroups/any(g:search.in(g, 'east'))"
+WEST = "permittedGroups/any(g:search.in(g, 'west'))"
+
+
+def permitted(group):
+    return [claim for claim in CLAIMS if group in claim["permittedGroups"]]
+
+
+@pytest_asyncio.fixture
+async def gateway(monkeypatch):
+    gateway = SearchGateway(timeout=10)
+    monkeypatch.setattr(utils, "search_gateway", gateway)
+    monkeypatch.setattr(aggregation, "search_gateway", gateway)
+    yield gateway
+    await gateway.close()
+
+
+def claims_store():
+    builder = ColumnsBuilder()
+    builder.add_page(CLAIMS)
+    store = ClaimsStore()
+    store._columns = builder.build("test")
+    return store
+
+
+def service(search_service, index=True):
+    return AnalyticsService(
+        claims_store(), (search_service.endpoint, "key", "claims") if index else None,
+        ResultCache(), LatencyTracker(slo_ms={}),
+    )
+
+
+def test_restricted_to_ands_the_security_filter():
+    params = AggregationParams.parse({"field": "claimAmount", "filter": "claimAmount gt 5"})
+
+    assert params.restricted_to(None) is params and not params.restricted
+    restricted = params.restricted_to(EAST)
+    assert restricted.restricted and restricted.filter == f"(claimAmount gt 5) and ({EAST})"
+    assert AggregationParams.parse({"field": "claimAmount"}).restricted_to(EAST).filter == EAST
+    assert restricted.cache_key() != params.cache_key() != params.restricted_to(WEST).cache_key()
+
+
+def test_the_request_body_cannot_restrict_or_unrestrict():
+    params = AggregationParams.parse({"field": "claimAmount", "_security_filter": "true"})
+
+    assert not params.restricted
+
+
+@pytest.mark.parametrize("filter_str", [
+    "claimAmount gt 0) or (claimAmount gt 0",
+    "claimAmount gt 0) or true or (true",
+    "(claimAmount gt 0",
+    "insuranceCompany eq 'Aetna",
+    "insuranceCompany eq 'Aetna'') or (true",
+])
+def test_filters_that_could_escape_the_restriction_are_rejected(filter_str):
+    with pytest.raises(AnalyticsRequestError, match="filter"):
+        AggregationParams.parse({"field": "claimAmount", "filter": filter_str})
+
+
+def test_parentheses_and_quotes_inside_literals_are_allowed():
+    params = AggregationParams.parse({"field": "claimAmount", "filter": "insuranceCompany eq 'O''Brien (East)'"})
+
+    assert params.restricted_to(EAST).filter == f"(insuranceCompany eq 'O''Brien (East)') and ({EAST})"
+
+
+@pytest.mark.asyncio
+async def test_an_injected_filter_only_returns_permitted_claims(search_service, gateway):
+    search_service.add_index("claims", CLAIMS)
+    analytics = service(search_service)
+    injected = "claimAmount gt 0) or (claimAmount gt 0"
+
+    with pytest.raises(AnalyticsRequestError):
+        DirectSearchParams.parse({"top_k": 100, "filter": injected})
+
+    ## built without validation, it is still caught before it reaches the index
+    params = DirectSearchParams.parse({"top_k": 100}).model_copy(update={"filter": injected})
+    with pytest.raises(AnalyticsRequestError):
+        params.restricted_to(EAST)
+
+    balanced = DirectSearchParams.parse({"top_k": 100, "filter": "(claimAmount gt 0) or (claimAmount gt 0)"})
+    pages = [page async for page in analytics.stream_direct_search(balanced.restricted_to(EAST))]
+    assert {document["id"] for page in pages for document in page["results"]} == {claim["id"] for claim in permitted("east")}
+
+
+@pytest.mark.asyncio
+async def test_restricted_aggregation_skips_the_claims_store(search_service, gateway):
+    index = search_service.add_index("claims", CLAIMS)
+    analytics = service(search_service)
+    params = AggregationParams.parse({"field": "claimAmount", "aggregation_type": "sum"})
+
+    everything, served = await analytics.answer("aggregation", params)
+    assert served["source"] == "claims_store" and not index.requests
+    assert everything["result"] == sum(claim["claimAmount"] for claim in CLAIMS)
+
+    east, served = await analytics.answer("aggregation", params.restricted_to(EAST))
+    assert served["source"] == "index" and not served["cached"]
+    assert east["result"] == sum(claim["claimAmount"] for claim in permitted("east"))
+    assert all(EAST in request["filter"] for request in index.requests)
+
+    west, served = await analytics.answer("aggregation", params.restricted_to(WEST))
+    assert not served["cached"]
+    assert west["result"] == sum(claim["claimAmount"] for claim in permitted("west"))
+
+
+@pytest.mark.asyncio
+async def test_restricted_group_by_only_counts_permitted_claims(search_service, gateway):
+    search_service.add_index("claims", CLAIMS)
+    params = AnalyticsParams.parse({"group_by_field": "insuranceCompany"}).restricted_to(WEST)
+
+    result, served = await service(search_service).answer("analytics", params)
+
+    assert served["source"] == "index"
+    counts = {row["group"]: row["count"] for row in result["results"]}
+    assert sum(counts.values()) == len(permitted("west"))
+
+
+@pytest.mark.asyncio
+async def test_restricted_direct_search(search_service, gateway):
+    search_service.add_index("claims", CLAIMS)
+    params = DirectSearchParams.parse({"top_k": 100, "filter": "insuranceCompany eq 'Aetna'"}).restricted_to(EAST)
+
+    pages = [page async for page in service(search_service).stream_direct_search(params)]
+
+    expected = {claim["id"] for claim in permitted("east") if claim["insuranceCompany"] == "Aetna"}
+    assert {document["id"] for page in pages for document in page["results"]} == expected
+    assert pages[0]["count"] == len(expected)
+
+
+@pytest.mark.asyncio
+async def test_restricted_without_an_index_is_refused(search_service):
+    params = AggregationParams.parse({"field": "claimAmount"}).restricted_to(EAST)
+
+    with pytest.raises(AnalyticsUnavailableError, match="Document-level security"):
+        await service(search_service, index=False).answer("aggregation", params)
+
+
+@pytest.mark.asyncio
+async def test_router_answers_restricted(search_service, gateway):
+    search_service.add_index("claims", CLAIMS)
+    router = QueryRouter(service(search_service))
+    messages = [{"role": "user", "content": "What is the total claim amount?"}]
+
+    routed = await router.route(messages, EAST)
+
+    assert routed.result["result"] == sum(claim["claimAmount"] for claim in permitted("east"))
+
+
+@pytest.mark.asyncio
+async def test_tools_run_restricted(search_service, gateway):
+    search_service.add_index("claims", CLAIMS)
+    runner = ToolRunner(service(search_service))
+
+    aggregated = json.loads(await runner.call(
+        "aggregate_claims", json.dumps({"field": "claimAmount", "aggregation_type": "count"}), WEST
+    ))
+    found = json.loads(await runner.call("find_claims", json.dumps({"select": "id", "top_k": 50}), WEST))
+
+    assert aggregated["result"] == len(permitted("west"))
+    assert found["count"] == len(permitted("west"))
+    assert {document["id"] for document in found["results"]} == {claim["id"] for claim in permitted("west")}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("name, arguments", [
+    ("aggregate_claims", {"field": "claimAmount", "aggregation_type": "count", "filter": "claimAmount gt 0) or (true"}),
+    ("group_claims", {"group_by_field": "insuranceCompany", "filter": "x) or (true"}),
+    ("find_claims", {"select": "id", "filter": "claimAmount gt 0) or (claimAmount gt 0"}),
+])
+async def test_tools_reject_a_filter_escaping_the_restriction(search_service, gateway, name, arguments):
+    index = search_service.add_index("claims", CLAIMS)
+    runner = ToolRunner(service(search_service))
+
+    result = json.loads(await runner.call(name, json.dumps(arguments), EAST))
+
+    assert "filter" in result["error"] and "results" not in result
+    assert not index.requests
+    assert runner.errors == 1
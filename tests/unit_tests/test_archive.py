@@ -0,0 +1,112 @@
+import asyncio
+import os
+
+import pytest
+import pytest_asyncio
+
+from backend.history.archive import ARCHIVED_FIELD, LAST_ACCESSED_FIELD, ConversationArchiver, LocalArchiveStore
+from backend.history.sqlitedbservice import SqliteConversationClient
+
+
+@pytest_asyncio.fixture
+async def client(tmp_path):
+    client = SqliteConversationClient(str(tmp_path / "history.db"))
+    yield client
+    await client.close()
+
+
+@pytest.fixture
+def archive_dir(tmp_path):
+    return tmp_path / "archive"
+
+
+@pytest.fixture
+def archiver(client, archive_dir):
+    return ConversationArchiver(client, LocalArchiveStore(str(archive_dir)), idle_days=30)
+
+
+def archive_files(archive_dir):
+    return [name for _, _, names in os.walk(archive_dir) for name in names]
+
+
+async def idle_conversation(client, user_id='alice', messages=3):
+    conversation = await client.create_conversation(user_id, title='old')
+    for i in range(messages):
+        await client.create_message(f"{conversation['id']}-m{i}", conversation['id'], user_id, {'role': 'user', 'content': str(i)})
+    await client.touch_conversation(user_id, conversation['id'], "2020-01-01T00:00:00")
+    return await client.get_conversation(user_id, conversation['id'])
+
+
+@pytest.mark.asyncio
+async def test_archive_and_rehydrate_round_trip(client, archiver, archive_dir):
+    conversation = await idle_conversation(client)
+
+    assert await archiver.archive_idle() == 1
+    stub = await client.get_conversation('alice', conversation['id'])
+    assert stub[ARCHIVED_FIELD]['messageCount'] == 3
+    assert await client.get_messages('alice', conversation['id']) == []
+    assert len(archive_files(archive_dir)) == 1
+    assert [message['content'] for message in await archiver.read_messages(stub)] == ["0", "1", "2"]
+
+    rehydrated = await archiver.rehydrate(stub)
+    assert ARCHIVED_FIELD not in rehydrated
+    assert LAST_ACCESSED_FIELD in rehydrated
+    assert [message['content'] for message in await client.get_messages('alice', conversation['id'])] == ["0", "1", "2"]
+    assert archive_files(archive_dir) == []
+    ## just opened, so not idle any more
+    assert await archiver.archive_idle() == 0
+
+
+@pytest.mark.asyncio
+async def test_archive_skips_conversation_changed_after_read(client, archiver, archive_dir):
+    conversation = await idle_conversation(client)
+    ## a message arrives between the idle query and the stub write
+    await client.create_message("late", conversation['id'], 'alice', {'role': 'user', 'content': "late"})
+
+    assert not await archiver.archive(conversation)
+    stored = await client.get_conversation('alice', conversation['id'])
+    assert ARCHIVED_FIELD not in stored
+    assert len(await client.get_messages('alice', conversation['id'])) == 4
+    assert archive_files(archive_dir) == []
+
+
+@pytest.mark.asyncio
+async def test_archive_deletes_only_archived_messages(client, archiver):
+    conversation = await idle_conversation(client)
+    real_replace = client.replace_conversation
+
+    async def replace_then_write(stub, etag):
+        result = await real_replace(stub, etag)
+        ## a message written after the stub but before the delete
+        message = client.build_message("late", conversation['id'], 'alice', {'role': 'user', 'content': "late"})
+        await client.execute_batch('alice', [{'op': 'upsert', 'item': message}])
+        return result
+
+    client.replace_conversation = replace_then_write
+    assert await archiver.archive(conversation)
+    assert [message['id'] for message in await client.get_messages('alice', conversation['id'])] == ["late"]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_rehydrates_both_succeed(client, archiver, archive_dir):
+    conversation = await idle_conversation(client)
+    await archiver.archive_idle()
+    stub = await client.get_conversation('alice', conversation['id'])
+
+    results = await asyncio.gather(archiver.rehydrate(dict(stub)), archiver.rehydrate(dict(stub)))
+    assert all(ARCHIVED_FIELD not in result for result in results)
+    assert len(await client.get_messages('alice', conversation['id'])) == 3
+    assert archive_files(archive_dir) == []
+
+    ## a rehydrate that starts after the blob is gone returns the rehydrated conversation
+    late = await archiver.rehydrate(dict(stub))
+    assert ARCHIVED_FIELD not in late
+
+
+@pytest.mark.asyncio
+async def test_discard_deletes_the_blob(client, archiver, archive_dir):
+    conversation = await idle_conversation(client)
+    await archiver.archive_idle()
+
+    await archiver.discard(await client.get_conversation('alice', conversation['id']))
+    assert archive_files(archive_dir) == []
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+from backend.analytics.columnar import ColumnsBuilder
+from conftest import FilterParser
+
+CLAIMS = [
+    {
+        "claimAmount": None if i % 7 == 0 else float(i * 25),
+        "patientState": [None, "CA", "NY", "TX", "O'Brien"][i % 5],
+        "insuranceCompany": ["Aetna", "Cigna", "Humana"][i % 3],
+        "isAggregationCandidate": None if i % 11 == 0 else bool(i % 2),
+        "serviceStartDate": f"2024-0{i % 9 + 1}-15T00:00:00Z" if i % 4 else None,
+    }
+    for i in range(60)
+]
+
+
+@pytest.fixture(scope="module")
+def columns():
+    builder = ColumnsBuilder()
+    builder.add_page(CLAIMS[:25])
+    builder.add_page(CLAIMS[25:])
+    return builder.build("test")
+
+
+def matching(filter_str):
+    predicate = FilterParser(filter_str, set(CLAIMS[0])).parse()
+    return [i for i, claim in enumerate(CLAIMS) if predicate(claim, {})]
+
+
+@pytest.mark.parametrize("filter_str", [
+    "claimAmount gt 500",
+    "claimAmount ge 500 and claimAmount lt 1000",
+    "claimAmount le 100 or claimAmount gt 1400",
+    "claimAmount eq null",
+    "claimAmount ne null",
+    "claimAmount ne 250",
+    "patientState eq 'CA'",
+    "patientState ne 'CA'",
+    "patientState eq null",
+    "patientState eq 'O''Brien'",
+    "patientState eq 'Nowhere'",
+    "not (patientState eq 'NY')",
+    "search.in(insuranceCompany, 'Aetna,Humana')",
+    "search.in(insuranceCompany, 'Aetna|Cigna', '|')",
+    "isAggregationCandidate eq true",
+    "isAggregationCandidate ne true",
+    "isAggregationCandidate eq null",
+    "(insuranceCompany eq 'Cigna' or patientState eq 'TX') and claimAmount gt 300",
+    "not claimAmount gt 500 and not (insuranceCompany eq 'Aetna')",
+])
+def test_mask_matches_odata_semantics(columns, filter_str):
+    mask = columns.filter(filter_str)
+    assert mask.dtype == np.bool_ and mask.shape == (len(CLAIMS),)
+    assert list(np.flatnonzero(mask)) == matching(filter_str)
+    assert columns.count(filter_str) == len(matching(filter_str))
+
+
+def test_date_comparisons(columns):
+    mask = columns.filter("serviceStartDate ge 2024-07-01 and serviceStartDate lt 2024-09-01T00:00:00Z")
+    expected = [
+        i for i, claim in enumerate(CLAIMS)
+        if claim["serviceStartDate"] and "2024-07" <= claim["serviceStartDate"][:7] < "2024-09"
+    ]
+    assert list(np.flatnonzero(mask)) == expected
+    assert list(np.flatnonzero(columns.filter("serviceStartDate eq null"))) == [
+        i for i, claim in enumerate(CLAIMS) if claim["serviceStartDate"] is None
+    ]
+
+
+def test_no_filter(columns):
+    assert columns.filter(None) is None
+    assert columns.filter("  ") is None
+    assert columns.count() == len(CLAIMS)
+
+
+def test_filter_on_a_slice(columns):
+    part = columns.slice(10, 40)
+    assert list(np.flatnonzero(part.filter("patientState eq 'NY'")) + 10) == [
+        i for i in matching("patientState eq 'NY'") if 10 <= i < 40
+    ]
+
+
+@pytest.mark.parametrize("filter_str", [
+    "claimAmount gt",
+    "claimAmount between 1",
+    "claimAmount gt 1 and",
+    "(claimAmount gt 1",
+    "claimAmount gt 1)",
+    "unknownField eq 1",
+    "claimAmount gt null",
+    "patientState gt 5",
+    "claimAmount gt 1 ; drop",
+])
+def test_invalid_filters_raise(columns, filter_str):
+    with pytest.raises(ValueError):
+        columns.filter(filter_str)
@@ -0,0 +1,88 @@
+import pytest
+import pytest_asyncio
+
+from backend import utils
+from backend.search.gateway import SearchGateway
+from backend.utils import stable_order_by, stream_direct_search_query
+
+## ten claims share each amount, so a sort on the amount alone has ties across every page boundary
+CLAIMS = [{"id": f"{i:03d}", "claimAmount": float(i % 4), "claimType": ["auto", "home"][i % 2]} for i in range(1, 58)]
+
+
+@pytest_asyncio.fixture
+async def gateway(monkeypatch):
+    gateway = SearchGateway(timeout=10)
+    monkeypatch.setattr(utils, "search_gateway", gateway)
+    yield gateway
+    await gateway.close()
+
+
+async def collect(search_service, **kwargs):
+    kwargs.setdefault("top_k", 1000)
+    return [page async for page in stream_direct_search_query(search_service.endpoint, "key", "claims", "*", **kwargs)]
+
+
+def test_stable_order_by_ends_on_the_key():
+    assert stable_order_by(None) == "search.score() desc,id asc"
+    assert stable_order_by("claimAmount desc") == "claimAmount desc,id asc"
+    assert stable_order_by("claimAmount desc, id desc") == "claimAmount desc,id desc"
+
+
+@pytest.mark.asyncio
+async def test_pages_come_from_one_query(search_service, gateway):
+    index = search_service.add_index("claims", CLAIMS, page_size=20)
+    pages = await collect(search_service, order_by="claimAmount desc", page_size=15)
+
+    assert [len(page["results"]) for page in pages] == [15, 15, 15, 12]
+    assert pages[0]["count"] == len(CLAIMS)
+    assert all("count" not in page for page in pages[1:])
+
+    ids = [document["id"] for page in pages for document in page["results"]]
+    expected = sorted(CLAIMS, key=lambda claim: (-claim["claimAmount"], claim["id"]))
+    assert ids == [claim["id"] for claim in expected]
+
+    ## one top=0 count, and the documents query followed through the service's continuation
+    documents = [request for request in index.requests if request["top"] != 0]
+    assert [request.get("skip") or 0 for request in documents] == [0, 20, 40]
+    assert all(request["orderby"] == "claimAmount desc,id asc" and not request.get("count") for request in documents)
+    assert sum(1 for request in index.requests if request["top"] == 0) == 1
+
+
+@pytest.mark.asyncio
+async def test_top_k_and_filter(search_service, gateway):
+    search_service.add_index("claims", CLAIMS, page_size=20)
+    pages = await collect(search_service, filter_str="claimType eq 'home'", top_k=10, page_size=4)
+
+    assert [len(page["results"]) for page in pages] == [4, 4, 2]
+    assert pages[0]["count"] == sum(1 for claim in CLAIMS if claim["claimType"] == "home")
+    assert all(document["claimType"] == "home" for page in pages for document in page["results"])
+
+
+@pytest.mark.asyncio
+async def test_no_matches_still_yields_the_count(search_service, gateway):
+    search_service.add_index("claims", CLAIMS)
+    pages = await collect(search_service, filter_str="claimType eq 'life'")
+
+    assert pages == [{"results": [], "count": 0}]
+
+
+@pytest.mark.asyncio
+async def test_falls_back_to_the_order_asked_for_when_the_key_is_not_sortable(search_service, gateway):
+    index = search_service.add_index("claims", CLAIMS, sortable=["claimAmount"], page_size=20)
+    pages = await collect(search_service, order_by="claimAmount asc", page_size=100)
+
+    assert len(pages) == 1 and len(pages[0]["results"]) == len(CLAIMS)
+    assert pages[0]["count"] == len(CLAIMS)
+    assert [document["claimAmount"] for document in pages[0]["results"]] == sorted(claim["claimAmount"] for claim in CLAIMS)
+    assert [request["orderby"] for request in index.requests if request["top"] != 0][-1] == "claimAmount asc"
+
+
+@pytest.mark.asyncio
+async def test_closing_early_stops_paging(search_service, gateway):
+    index = search_service.add_index("claims", CLAIMS, page_size=20)
+    stream = stream_direct_search_query(search_service.endpoint, "key", "claims", "*", top_k=1000, page_size=10)
+    first = await anext(stream)
+    await stream.aclose()
+
+    assert len(first["results"]) == 10 and first["count"] == len(CLAIMS)
+    assert len([request for request in index.requests if request["top"] != 0]) == 1
@@ -0,0 +1,158 @@
+import json
+import base64
+import asyncio
+
+import httpx
+import pytest
+import pytest_asyncio
+
+from backend.auth.graph import GRAPH_BASE_URL, GraphGroupResolver, token_subject
+
+MEMBER_OF = f"{GRAPH_BASE_URL}/me/transitiveMemberOf?$select=id"
+
+
+def make_token(oid, nonce="1"):
+    claims = base64.urlsafe_b64encode(json.dumps({"oid": oid, "nonce": nonce}).encode()).decode().rstrip("=")
+    return f"header.{claims}.signature"
+
+
+class FakeGraph():
+    """Pages of group ids per bearer token, and every request it was sent."""
+
+    def __init__(self, pages, status=200):
+        self.pages = pages
+        self.status = status
+        self.requests = []
+        self.release = None
+
+    async def handle(self, request):
+        self.requests.append(request)
+        if self.release is not None:
+            await self.release.wait()
+        if self.status != 200:
+            return httpx.Response(self.status, text="unavailable")
+        page = int(request.url.params.get("page", 0))
+        body = {"value": [{"id": group} for group in self.pages[page]]}
+        if page + 1 < len(self.pages):
+            body["@odata.nextLink"] = f"{MEMBER_OF}&page={page + 1}"
+        return httpx.Response(200, json=body)
+
+
+@pytest_asyncio.fixture
+async def graph():
+    graph = FakeGraph([["east", "west"]])
+    resolvers = []
+
+    def resolver(**kwargs):
+        resolvers.append(GraphGroupResolver(transport=httpx.MockTransport(graph.handle), **kwargs))
+        return resolvers[-1]
+
+    graph.resolver = resolver
+    yield graph
+    for resolver in resolvers:
+        await resolver.close()
+
+
+def test_token_subject_reads_the_oid():
+    assert token_subject(make_token("user-1")) == "user-1"
+    assert token_subject("opaque") != "opaque"
+
+
+@pytest.mark.asyncio
+async def test_groups_are_cached_for_the_ttl(graph):
+    resolver = graph.resolver(ttl=60)
+    token = make_token("user-1")
+
+    assert await resolver.groups(token) == ["east", "west"]
+    assert await resolver.groups(token) == ["east", "west"]
+
+    assert len(graph.requests) == 1
+    assert graph.requests[0].headers["Authorization"] == f"Bearer {token}"
+    assert (resolver.counts["misses"], resolver.counts["hits"]) == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_another_token_of_the_user_fetches_its_own_groups(graph):
+    resolver = graph.resolver(ttl=60)
+    await resolver.groups(make_token("user-1", nonce="1"))
+    await resolver.groups(make_token("user-1", nonce="2"))
+
+    assert len(graph.requests) == 2
+
+
+@pytest.mark.asyncio
+async def test_stale_groups_are_returned_while_they_refresh(graph):
+    resolver = graph.resolver(ttl=0, stale_ttl=60)
+    token = make_token("user-1")
+    await resolver.groups(token)
+    graph.pages = [["north"]]
+
+    assert await resolver.groups(token) == ["east", "west"]
+    assert resolver.counts["stale_hits"] == 1
+    await asyncio.gather(*resolver._pending.values())
+
+    assert await resolver.groups(token) == ["north"]
+    assert len(graph.requests) >= 2
+
+
+@pytest.mark.asyncio
+async def test_concurrent_lookups_share_one_fetch(graph):
+    resolver = graph.resolver()
+    graph.release = asyncio.Event()
+    token = make_token("user-1")
+
+    lookups = [asyncio.ensure_future(resolver.groups(token)) for _ in range(5)]
+    await asyncio.sleep(0.01)
+    graph.release.set()
+
+    assert await asyncio.gather(*lookups) == [["east", "west"]] * 5
+    assert len(graph.requests) == 1
+    assert resolver.counts["fetches"] == 1
+
+
+@pytest.mark.asyncio
+async def test_next_links_are_followed(graph):
+    graph.pages = [["a", "b"], ["c"], ["d"]]
+    resolver = graph.resolver()
+
+    assert await resolver.groups(make_token("user-1")) == ["a", "b", "c", "d"]
+    assert [request.url.params.get("page") for request in graph.requests] == [None, "1", "2"]
+
+
+@pytest.mark.asyncio
+async def test_a_next_link_off_graph_is_not_followed(graph):
+    async def handle(request):
+        graph.requests.append(request)
+        return httpx.Response(200, json={"value": [{"id": "a"}], "@odata.nextLink": "https://attacker.example/steal"})
+
+    resolver = GraphGroupResolver(transport=httpx.MockTransport(handle))
+    try:
+        assert await resolver.groups(make_token("user-1")) == []
+    finally:
+        await resolver.close()
+
+    assert [request.url.host for request in graph.requests] == ["graph.microsoft.com"]
+    assert resolver.counts["failures"] == 1
+
+
+@pytest.mark.asyncio
+async def test_a_failed_fetch_matches_no_groups(graph):
+    graph.status = 503
+    resolver = graph.resolver()
+
+    assert await resolver.groups(make_token("user-1")) == []
+    assert resolver.counts["failures"] == 1
+
+
+@pytest.mark.asyncio
+async def test_a_failed_refresh_keeps_the_stale_groups(graph):
+    resolver = graph.resolver(ttl=0, stale_ttl=60)
+    token = make_token("user-1")
+    await resolver.groups(token)
+    graph.status = 503
+
+    assert await resolver.groups(token) == ["east", "west"]
+    await asyncio.gather(*resolver._pending.values(), return_exceptions=True)
+
+    assert resolver.counts["failures"] == 1
+    assert await resolver.groups(token) == ["east", "west"]
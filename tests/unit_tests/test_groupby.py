@@ -0,0 +1,63 @@
+import functools
+
+import pytest
+import pytest_asyncio
+
+from backend.search.gateway import SearchGateway
+from backend.search.groupby import GroupByAccumulator, keyset_pages, scan_group_by
+
+CLAIMS = [{"id": f"{i:04d}", "claimType": ["auto", "home"][i % 2], "claimAmount": float(i)} for i in range(250)]
+
+
+@pytest_asyncio.fixture
+async def search(search_service):
+    gateway = SearchGateway(timeout=10)
+    yield functools.partial(gateway.search, search_service.endpoint, "key", "claims", search_text="*")
+    await gateway.close()
+
+
+def grouped(accumulator):
+    return {row["group"]: (row["count"], row["metrics"]["sum_claimAmount"]) for row in accumulator.results()}
+
+
+def expected():
+    return {
+        claim_type: (125, sum(claim["claimAmount"] for claim in CLAIMS if claim["claimType"] == claim_type))
+        for claim_type in ("auto", "home")
+    }
+
+
+@pytest.mark.asyncio
+async def test_keyset_scan_reads_every_document_once(search_service, search):
+    search_service.add_index("claims", CLAIMS, page_size=30)
+    accumulator = GroupByAccumulator("claimType", [("claimAmount", "sum")])
+
+    summary = await scan_group_by(search, accumulator)
+    assert (summary["strategy"], summary["exact"], summary["total_documents"]) == ("keyset_scan", True, len(CLAIMS))
+    assert accumulator.documents == len(CLAIMS)
+    assert grouped(accumulator) == expected()
+
+
+@pytest.mark.asyncio
+async def test_keyset_pages_continue_after_the_last_id(search_service, search):
+    index = search_service.add_index("claims", CLAIMS, page_size=30)
+    totals = {}
+    pages = [page async for page in keyset_pages(search, "claimType eq 'auto'", ["claimType"], batch_size=50, totals=totals)]
+
+    ids = [document["id"] for page in pages for document in page]
+    assert ids == [claim["id"] for claim in CLAIMS if claim["claimType"] == "auto"]
+    assert totals["count"] == 125
+    assert [request["filter"] for request in index.requests if not request.get("skip")] == [
+        "(claimType eq 'auto')", "(claimType eq 'auto') and (id gt '0098')",
+        "(claimType eq 'auto') and (id gt '0198')",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_falls_back_to_a_capped_scan_when_id_is_not_sortable(search_service, search):
+    search_service.add_index("claims", CLAIMS, sortable=[], filterable=[])
+    accumulator = GroupByAccumulator("claimType", [("claimAmount", "sum")])
+
+    summary = await scan_group_by(search, accumulator)
+    assert summary["strategy"] == "scan"
+    assert grouped(accumulator) == expected()
@@ -0,0 +1,129 @@
+import pytest
+import pytest_asyncio
+
+from backend.history.search import HistorySearchIndex, UserSearchIndex
+from backend.history.sqlitedbservice import SqliteConversationClient
+
+
+class CountingClient:
+    ## the SQLite client, counting the calls the search index makes
+    def __init__(self, client):
+        self.client = client
+        self.calls = {}
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            return attribute(*args, **kwargs)
+        return call
+
+
+@pytest_asyncio.fixture
+async def client(tmp_path):
+    client = SqliteConversationClient(str(tmp_path / "history.db"))
+    yield CountingClient(client)
+    await client.close()
+
+
+async def add_message(client, conversation_id, message_id, content, role='user'):
+    ## written the way the write-behind queue does with the conversation index on: no touch
+    message = client.build_message(message_id, conversation_id, 'alice', {'role': role, 'content': content})
+    await client.execute_batch('alice', [{'op': 'upsert', 'item': message}])
+
+
+def test_user_index_ranks_and_prefixes():
+    index = UserSearchIndex()
+    index.add("m1", "c1", "the quick brown fox")
+    index.add("m2", "c2", "lazy dogs sleep all day, dogs everywhere")
+    index.set_title("c1", "Animals")
+
+    assert [result["conversation_id"] for result in index.search("dogs")] == ["c2"]
+    assert [result["conversation_id"] for result in index.search("qui")] == ["c1"]
+    assert index.search("animals")[0]["title"] == "Animals"
+    index.remove_conversation("c2")
+    assert index.search("dogs") == []
+
+
+@pytest.mark.asyncio
+async def test_cold_start_is_one_query(client):
+    for i in range(5):
+        conversation = await client.create_conversation('alice', title=f"conversation {i}")
+        await add_message(client, conversation['id'], f"m{i}", f"needle number {i}")
+
+    results = await HistorySearchIndex(catch_up_interval=0).search(client, 'alice', "needle")
+    assert len(results) == 5
+    assert client.calls.get('get_changes') == 1
+    assert 'get_messages' not in client.calls and 'get_conversations' not in client.calls
+
+
+@pytest.mark.asyncio
+async def test_other_workers_writes_are_found_without_updated_at(client):
+    conversation = await client.create_conversation('alice', title="trip")
+    worker = HistorySearchIndex(catch_up_interval=0)
+    assert await worker.search(client, 'alice', "kyoto") == []
+
+    ## another worker adds a message and renames the conversation
+    await add_message(client, conversation['id'], "m1", "temples in kyoto")
+    await client.upsert_conversation({**await client.get_conversation('alice', conversation['id']), 'title': "japan"})
+
+    [result] = await worker.search(client, 'alice', "kyoto")
+    assert result["message_id"] == "m1"
+    assert result["title"] == "japan"
+
+
+@pytest.mark.asyncio
+async def test_catch_up_reads_only_changes_since_the_watermark(client):
+    conversation = await client.create_conversation('alice')
+    await add_message(client, conversation['id'], "m1", "first")
+    worker = HistorySearchIndex(catch_up_interval=0)
+    await worker.search(client, 'alice', "first")
+
+    seen = []
+    real_get_changes = client.client.get_changes
+
+    async def get_changes(user_id, since=None):
+        seen.append(since)
+        return await real_get_changes(user_id, since)
+
+    client.client.get_changes = get_changes
+    await worker.search(client, 'alice', "first")
+    assert seen and seen[0] is not None
+
+
+@pytest.mark.asyncio
+async def test_deletes_elsewhere_are_reconciled(client):
+    conversation = await client.create_conversation('alice')
+    await add_message(client, conversation['id'], "m1", "secret plans")
+    worker = HistorySearchIndex(catch_up_interval=0, reconcile_interval=3600)
+    assert len(await worker.search(client, 'alice', "secret")) == 1
+
+    await client.delete_messages(conversation['id'], 'alice')
+    await client.delete_conversation('alice', conversation['id'])
+    assert len(await worker.search(client, 'alice', "secret")) == 1
+
+    worker.reconcile_interval = 0
+    assert await worker.search(client, 'alice', "secret") == []
+
+
+@pytest.mark.asyncio
+async def test_archived_conversations_keep_only_their_title(client):
+    conversation = await client.create_conversation('alice', title="holiday")
+    await add_message(client, conversation['id'], "m1", "beaches")
+    worker = HistorySearchIndex(catch_up_interval=0)
+    assert len(await worker.search(client, 'alice', "beaches")) == 1
+
+    stored = await client.get_conversation('alice', conversation['id'])
+    await client.upsert_conversation({**stored, 'archived': {'blob': "x"}})
+    await client.delete_messages(conversation['id'], 'alice')
+    assert await worker.search(client, 'alice', "beaches") == []
+    assert len(await worker.search(client, 'alice', "holiday")) == 1
+
+    ## rehydrated: messages come back before the conversation loses its archived flag
+    await add_message(client, conversation['id'], "m1", "beaches")
+    assert await worker.search(client, 'alice', "beaches") == []
+    await client.upsert_conversation({key: value for key, value in stored.items() if key != 'archived'})
+    assert len(await worker.search(client, 'alice', "beaches")) == 1
@@ -0,0 +1,39 @@
+import pytest
+
+from backend.analytics.router import classify
+
+
+@pytest.mark.parametrize("text", [
+    "How many claims were there in 2023?",
+    "What is the total claim amount in 2024?",
+    "How many claims for provider 1234567890?",
+    "How many claims over 500 dollars?",
+    "What is the average claim amount above $1,000?",
+    "Which state has the most claims in 2023?",
+])
+def test_a_number_other_than_top_n_is_left_to_the_model(text):
+    assert classify(text) is None
+
+
+def test_top_n_is_routed():
+    routed = classify("Top 5 states with the highest total claim amount")
+
+    assert routed.route == "analytics"
+    assert (routed.params.group_by_field, routed.params.top_results) == ("patientState", 5)
+    assert (routed.params.metric_field, routed.params.metric_function) == ("claimAmount", "sum")
+
+
+@pytest.mark.parametrize("text, route, field, function", [
+    ("How many claims are there?", "aggregation", "claimAmount", "count"),
+    ("What is the total claim amount?", "aggregation", "claimAmount", "sum"),
+    ("What is the average amount paid?", "aggregation", "amountPaid", "avg"),
+])
+def test_unconditional_questions_are_routed(text, route, field, function):
+    routed = classify(text)
+
+    assert routed.route == route and routed.direct
+    assert (routed.params.field, routed.params.aggregation_type) == (field, function)
+
+
+def test_a_condition_word_is_left_to_the_model():
+    assert classify("How many denied claims are there?") is None
@@ -0,0 +1,118 @@
+import bisect
+import json
+import random
+
+import pytest
+
+from backend.search.sketches import QUANTILE_FUNCTIONS, DistinctSketch, QuantileSketch, error_bound
+
+STREAM_SIZE = 100_000
+
+
+def rank_of(sorted_values, value):
+    ## fraction of the values at or below value
+    return bisect.bisect_right(sorted_values, value) / len(sorted_values)
+
+
+def streams():
+    generator = random.Random(42)
+    return {
+        "uniform": [generator.uniform(0, 1000) for _ in range(STREAM_SIZE)],
+        "lognormal": [generator.lognormvariate(5, 1.5) for _ in range(STREAM_SIZE)],
+        "sorted": [float(i) for i in range(STREAM_SIZE)],
+        "repeated": [float(generator.randint(0, 20)) for _ in range(STREAM_SIZE)],
+    }
+
+
+@pytest.fixture(scope="module")
+def data():
+    return streams()
+
+
+@pytest.mark.parametrize("name", ["uniform", "lognormal", "sorted", "repeated"])
+def test_quantiles_stay_within_the_rank_error(data, name):
+    values = data[name]
+    sketch = QuantileSketch()
+    for value in values:
+        sketch.add(value)
+    ordered = sorted(values)
+
+    assert sketch.count == len(values)
+    assert (sketch.min, sketch.max) == (ordered[0], ordered[-1])
+    assert sum(len(level) for level in sketch.levels) <= 3 * sketch.k + len(sketch.levels) * 2
+    for q in QUANTILE_FUNCTIONS.values():
+        estimate = sketch.quantile(q)
+        ## the estimate's rank interval (ties span several ranks) must come within the bound of q
+        low = bisect.bisect_left(ordered, estimate) / len(ordered)
+        high = rank_of(ordered, estimate)
+        assert low - sketch.rank_error <= q <= high + sketch.rank_error, (name, q, low, high)
+
+
+def test_merged_sketches_keep_the_bound(data):
+    values = data["lognormal"]
+    parts = [QuantileSketch(seed=part) for part in range(8)]
+    for i, value in enumerate(values):
+        parts[i % 8].add(value)
+    merged = QuantileSketch()
+    for part in parts:
+        merged.merge(part)
+    ordered = sorted(values)
+
+    assert merged.count == len(values)
+    for q in QUANTILE_FUNCTIONS.values():
+        assert abs(rank_of(ordered, merged.quantile(q)) - q) <= merged.rank_error
+
+
+def test_small_and_empty_quantile_sketches():
+    sketch = QuantileSketch()
+    assert sketch.quantile(0.5) is None
+    for value in (3.0, 1.0, 2.0):
+        sketch.add(value)
+    ## below k values nothing is compacted, so quantiles are exact
+    assert [sketch.quantile(q) for q in (0, 0.5, 1)] == [1.0, 2.0, 3.0]
+
+
+def test_quantile_sketch_round_trips(data):
+    sketch = QuantileSketch()
+    for value in data["uniform"][:5000]:
+        sketch.add(value)
+    restored = QuantileSketch.from_dict(json.loads(json.dumps(sketch.to_dict())))
+    assert [restored.quantile(q) for q in (0.1, 0.5, 0.9)] == [sketch.quantile(q) for q in (0.1, 0.5, 0.9)]
+
+
+@pytest.mark.parametrize("distinct", [10, 1_000, 50_000, 200_000])
+def test_distinct_estimate_within_error(distinct):
+    sketch = DistinctSketch()
+    for i in range(distinct):
+        sketch.add(f"value-{i}")
+        ## repeats don't count
+        if i % 3 == 0:
+            sketch.add(f"value-{i}")
+
+    ## small counts use linear counting and are nearly exact; otherwise allow four standard errors
+    tolerance = 0.01 if distinct <= 1_000 else 4 * sketch.relative_error
+    assert abs(sketch.estimate() - distinct) <= max(1, tolerance * distinct)
+
+
+def test_distinct_sketches_merge_like_a_union():
+    left, right, union = DistinctSketch(), DistinctSketch(), DistinctSketch()
+    for i in range(30_000):
+        left.add(i)
+        union.add(i)
+    for i in range(20_000, 60_000):
+        right.add(i)
+        union.add(i)
+    left.merge(right)
+
+    assert left.registers == union.registers
+    assert abs(left.estimate() - 60_000) <= 4 * left.relative_error * 60_000
+    assert DistinctSketch.from_dict(json.loads(json.dumps(left.to_dict()))).estimate() == left.estimate()
+    with pytest.raises(ValueError):
+        left.merge(DistinctSketch(precision=10))
+
+
+def test_error_bounds():
+    assert error_bound("p95")["confidence"] == 0.99
+    assert error_bound("p95")["rank_error"] < 0.02
+    assert error_bound("distinct")["relative_standard_error"] == pytest.approx(0.0163, abs=1e-4)
+    assert error_bound("sum") is None
@@ -0,0 +1,132 @@
+import asyncio
+
+import pytest
+import pytest_asyncio
+
+from backend.history.sqlitedbservice import SqliteConversationClient
+
+
+@pytest_asyncio.fixture
+async def client(tmp_path):
+    client = SqliteConversationClient(str(tmp_path / "history.db"), enable_message_feedback=True)
+    yield client
+    await client.close()
+
+
+def user_message(content):
+    return {'role': 'user', 'content': content}
+
+
+@pytest.mark.asyncio
+async def test_ensure(client):
+    ok, _ = await client.ensure()
+    assert ok
+
+
+@pytest.mark.asyncio
+async def test_messages_are_returned_in_order_and_touch_the_conversation(client):
+    conversation = await client.create_conversation('alice', title='hello')
+    for i in range(3):
+        await client.create_message(f"m{i}", conversation['id'], 'alice', user_message(f"message {i}"))
+
+    messages = await client.get_messages('alice', conversation['id'])
+    assert [message['content'] for message in messages] == ["message 0", "message 1", "message 2"]
+    stored = await client.get_conversation('alice', conversation['id'])
+    assert stored['updatedAt'] == messages[-1]['createdAt']
+
+
+@pytest.mark.asyncio
+async def test_message_for_missing_conversation(client):
+    assert await client.create_message("m", "missing", 'alice', user_message("hi")) == "Conversation not found"
+    assert await client.get_messages('alice', "missing") == []
+
+
+@pytest.mark.asyncio
+async def test_conversations_are_scoped_to_their_user(client):
+    conversation = await client.create_conversation('alice')
+    assert await client.get_conversation('bob', conversation['id']) is None
+    assert await client.get_conversations('bob', limit=10) == []
+    assert await client.create_message("m", conversation['id'], 'bob', user_message("hi")) == "Conversation not found"
+
+
+@pytest.mark.asyncio
+async def test_get_conversations_sorts_and_pages(client):
+    ids = []
+    for i in range(5):
+        conversation = client.build_conversation('alice', title=str(i))
+        conversation['updatedAt'] = f"2024-01-0{i + 1}T00:00:00"
+        await client.upsert_conversation(conversation)
+        ids.append(conversation['id'])
+
+    newest_first = await client.get_conversations('alice', limit=2, offset=1)
+    assert [conversation['id'] for conversation in newest_first] == [ids[3], ids[2]]
+    oldest_first = await client.get_conversations('alice', limit=None, sort_order='ASC')
+    assert [conversation['id'] for conversation in oldest_first] == ids
+    assert [conversation['id'] async for conversation in client.iter_conversations('alice', page_size=2)] == ids[::-1]
+
+
+@pytest.mark.asyncio
+async def test_feedback_updates_message_and_conversation_map(client):
+    conversation = await client.create_conversation('alice')
+    await client.create_message("m1", conversation['id'], 'alice', user_message("hi"))
+
+    updated = await client.update_message_feedback('alice', "m1", "positive")
+    assert updated['feedback'] == "positive"
+    assert await client.update_message_feedback('bob', "m1", "negative") is False
+    stored = await client.get_conversation('alice', conversation['id'])
+    assert stored['messageFeedback'] == {"m1": "positive"}
+
+
+@pytest.mark.asyncio
+async def test_delete_messages_returns_deleted_ids(client):
+    conversation = await client.create_conversation('alice')
+    await client.create_message("m1", conversation['id'], 'alice', user_message("a"))
+    await client.create_message("m2", conversation['id'], 'alice', user_message("b"))
+
+    assert sorted(await client.delete_messages(conversation['id'], 'alice')) == ["m1", "m2"]
+    assert await client.delete_conversation('alice', conversation['id'])
+    assert await client.get_conversation('alice', conversation['id']) is None
+
+
+@pytest.mark.asyncio
+async def test_execute_batch_applies_write_behind_operations(client):
+    conversation = client.build_conversation('alice')
+    message = client.build_message("m1", conversation['id'], 'alice', user_message("hi"))
+    await client.execute_batch('alice', [
+        {'op': 'upsert', 'item': conversation},
+        {'op': 'upsert', 'item': message},
+        {'op': 'touch', 'id': conversation['id'], 'updatedAt': "2099-01-01T00:00:00"},
+    ])
+
+    stored = await client.get_conversation('alice', conversation['id'])
+    assert stored['updatedAt'] == "2099-01-01T00:00:00"
+    assert [message['id'] for message in await client.get_messages('alice', conversation['id'])] == ["m1"]
+
+
+@pytest.mark.asyncio
+async def test_failed_write_rolls_back(client):
+    conversation = client.build_conversation('alice')
+    with pytest.raises(KeyError):
+        await client.execute_batch('alice', [{'op': 'upsert', 'item': conversation}, {'op': 'upsert', 'item': {}}])
+    assert await client.get_conversation('alice', conversation['id']) is None
+
+
+@pytest.mark.asyncio
+async def test_concurrent_writes(client):
+    conversation = await client.create_conversation('alice')
+    await asyncio.gather(*(
+        client.create_message(f"m{i}", conversation['id'], 'alice', user_message(str(i))) for i in range(50)
+    ))
+    assert len(await client.get_messages('alice', conversation['id'])) == 50
+
+
+@pytest.mark.asyncio
+async def test_idle_conversations_skip_archived_and_recent(client):
+    idle, recent, archived = (client.build_conversation('alice') for _ in range(3))
+    idle['updatedAt'] = archived['updatedAt'] = "2020-01-01T00:00:00"
+    archived['archived'] = {'blob': "x"}
+    for conversation in (idle, recent, archived):
+        await client.upsert_conversation(conversation)
+
+    found = await client.get_idle_conversations("2021-01-01T00:00:00", limit=10)
+    assert [conversation['id'] for conversation in found] == [idle['id']]
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import os
+
+import pytest
+from azure.cosmos import exceptions
+
+from backend.history.writebehind import HistoryWriteBehindQueue, is_transient_error
+
+
+class FakeClient:
+    def __init__(self, failures=0, delay=0.0):
+        self.written = []
+        self.batches = []
+        self.failures = failures
+        self.delay = delay
+
+    async def execute_batch(self, user_id, operations):
+        await asyncio.sleep(self.delay)
+        if self.failures:
+            self.failures -= 1
+            raise exceptions.CosmosHttpResponseError(status_code=429, message="throttled")
+        self.batches.append(len(operations))
+        self.written.extend((user_id, operation) for operation in operations)
+
+
+def upsert(item_id):
+    return {'op': 'upsert', 'item': {'id': item_id}}
+
+
+def test_is_transient_error():
+    assert is_transient_error(exceptions.CosmosHttpResponseError(status_code=429))
+    assert is_transient_error(exceptions.CosmosHttpResponseError(status_code=503))
+    assert not is_transient_error(exceptions.CosmosHttpResponseError(status_code=400))
+    assert is_transient_error(ConnectionError())
+
+
+@pytest.mark.asyncio
+async def test_writes_land_in_enqueue_order_per_partition():
+    client = FakeClient()
+    queue = HistoryWriteBehindQueue(client, batch_size=3, flush_interval=0)
+    for i in range(10):
+        queue.enqueue('alice', upsert(f"a{i}"))
+        queue.enqueue('bob', upsert(f"b{i}"))
+
+    assert await queue.flush()
+    assert queue.pending_count == 0
+    for user in ('alice', 'bob'):
+        ids = [operation['item']['id'] for user_id, operation in client.written if user_id == user]
+        assert ids == [f"{user[0]}{i}" for i in range(10)]
+    assert max(client.batches) == 3
+
+
+@pytest.mark.asyncio
+async def test_transient_failure_is_retried_in_order():
+    client = FakeClient(failures=2)
+    queue = HistoryWriteBehindQueue(client, flush_interval=0, max_backoff=0.01)
+    queue.enqueue('alice', upsert("1"))
+    queue.enqueue_touch('alice', "1", "2024-01-01T00:00:00")
+
+    assert await queue.flush('alice')
+    assert [operation['op'] for _, operation in client.written] == ['upsert', 'touch']
+
+
+@pytest.mark.asyncio
+async def test_flush_is_bounded():
+    queue = HistoryWriteBehindQueue(FakeClient(delay=1.0), flush_interval=0)
+    queue.enqueue('alice', upsert("1"))
+
+    assert not await queue.flush('alice', timeout=0.01)
+    assert queue.pending_count == 1
+    await queue.close(timeout=0.01)
+
+
+@pytest.mark.asyncio
+async def test_full_queue_applies_backpressure_instead_of_spilling(tmp_path):
+    client = FakeClient(delay=0.01)
+    queue = HistoryWriteBehindQueue(client, batch_size=1, flush_interval=0, max_pending=2, spill_dir=str(tmp_path))
+
+    async def writer(i):
+        await queue.wait_for_capacity()
+        queue.enqueue('alice', upsert(str(i)))
+
+    for i in range(6):
+        await writer(i)
+        assert queue.pending_count <= 2
+
+    assert await queue.flush()
+    assert [operation['item']['id'] for _, operation in client.written] == [str(i) for i in range(6)]
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.asyncio
+async def test_close_spills_and_start_replays_in_order(tmp_path):
+    stuck = HistoryWriteBehindQueue(FakeClient(delay=10), flush_interval=0, spill_dir=str(tmp_path))
+    for i in range(3):
+        stuck.enqueue('alice', upsert(str(i)))
+    await stuck.close(timeout=0.01)
+    ## enqueued after close goes straight to the spill file, behind the rest
+    stuck.enqueue('alice', upsert("3"))
+
+    [spill_file] = os.listdir(tmp_path)
+    with open(tmp_path / spill_file) as f:
+        assert [json.loads(line)['operation']['item']['id'] for line in f] == ["0", "1", "2", "3"]
+
+    client = FakeClient()
+    queue = HistoryWriteBehindQueue(client, flush_interval=0, spill_dir=str(tmp_path))
+    await queue.start()
+    assert await queue.flush()
+    assert [operation['item']['id'] for _, operation in client.written] == ["0", "1", "2", "3"]
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.asyncio
+async def test_spill_is_bounded(tmp_path):
+    queue = HistoryWriteBehindQueue(FakeClient(), spill_dir=str(tmp_path), max_spill_bytes=200)
+    queue._closing = True
+    for i in range(20):
+        queue.enqueue('alice', upsert(str(i)))
+
+    [spill_file] = os.listdir(tmp_path)
+    assert os.path.getsize(tmp_path / spill_file) <= 200
+
+
+@pytest.mark.asyncio
+async def test_pending_upsert_is_visible_until_written():
+    queue = HistoryWriteBehindQueue(FakeClient(), flush_interval=0)
+    queue.enqueue_upsert('alice', {'id': 'conversation'})
+    assert queue.has_pending_upsert('alice', 'conversation')
+    assert not queue.has_pending_upsert('bob', 'conversation')
+    await queue.flush()
+    assert not queue.has_pending_upsert('alice', 'conversation')